@@ -0,0 +1,158 @@
+import os
+import json
+import time
+import argparse
+import tempfile
+import platform
+import multiprocessing
+
+import numpy as np
+
+from ecg_encoder_parameters import parameters as PARAM
+from ecg_encoder_profiling import EXECUTION_PROFILE
+
+
+def load_record(path, n_beats):
+    data = np.load(path).item()
+    data['beats'] = data['beats'][:n_beats]
+    return data
+
+
+def benchmark_config(args):
+    # runs in a fresh process: TensorFlow thread pools are per process
+    kind, path, n_beats, config = args
+    import ecg_encoder_tools as utils
+    from ecg_encoder import ECGEncoder
+
+    data = load_record(path, n_beats)
+    with tempfile.NamedTemporaryFile('w', suffix='.json', delete=False) as f:
+        json.dump(config, f)
+    try:
+        with ECGEncoder(
+            n_frames=PARAM['n_frames'],
+            n_channel=PARAM['n_channels'],
+            n_hidden_RNN=PARAM['n_hidden_RNN'],
+            reduction_ratio=PARAM['rr'],
+            frame_weights=PARAM['frame_weights'],
+            architecture=PARAM['architecture'],
+            n_parts=config['n_parts'] if kind == 'get_Z' else None,
+            n_towers=config.get('n_towers', 1),
+            summary_dir=tempfile.mkdtemp(),
+            execution_profile=f.name,
+            do_train=(kind == 'train')) as ecg_encoder:
+
+            if kind == 'get_Z':
+                ecg_encoder.get_Z(data, None, None, use_delta_coding=False)
+                start_time = time.time()
+                ecg_encoder.get_Z(data, None, None, use_delta_coding=False)
+                return len(data['beats'])/(time.time() - start_time)
+
+            windows = list(utils.step_generator(data,
+                n_frames=PARAM['n_frames'], overlap=0, get_data=True,
+                rr=PARAM['rr']))
+            b = config['batch_size']
+            batches = [utils.merge_batches(windows[s:s+b])
+                       for s in range(0, len(windows) - b + 1, b)]
+            assert batches, 'Record is too short for batch size {}'.format(b)
+            n_beats, start_time = 0, None
+            for i in range(config['n_steps'] + 2):
+                batch = batches[i % len(batches)]
+                if i == 2: # two warm-up steps
+                    start_time = time.time()
+                ecg_encoder.sess.run(ecg_encoder.train, feed_dict={
+                    ecg_encoder.inputs : batch['normal_data'],
+                    ecg_encoder.sequence_length : batch['sequence_length'],
+                    ecg_encoder.keep_prob : PARAM['keep_prob'],
+                    ecg_encoder.weight_decay : PARAM['weight_decay'],
+                    ecg_encoder.learn_rate : PARAM['learn_rate_start']})
+                if i >= 2:
+                    n_beats += len(batch['sequence_length'])
+            return n_beats/(time.time() - start_time)
+    finally:
+        os.remove(f.name)
+
+
+def run_isolated(kind, path, n_beats, configs, n_workers=1):
+    # n_workers > 1 runs copies of the same config at once, returns sum
+    ctx = multiprocessing.get_context('spawn')
+    results = []
+    for config in configs:
+        with ctx.Pool(n_workers, maxtasksperchild=1) as pool:
+            rate = sum(pool.map(benchmark_config,
+                [(kind, path, n_beats, config)]*n_workers))
+        print('{:<6} {} -> {:.1f} beats/s'.format(kind, config, rate))
+        results.append((rate, config))
+    return results
+
+
+def candidates(max_value):
+    values = [1]
+    while values[-1]*2 <= max_value:
+        values.append(values[-1]*2)
+    return sorted(set(values + [max_value]))
+
+
+def autotune(path, n_beats, n_steps, save_path):
+    n_cpu = os.cpu_count()
+    table = []
+
+    # session threads, measured on get_Z
+    configs = [{'intra_op_threads': a, 'inter_op_threads': e, 'n_parts': 10}
+               for a in candidates(n_cpu) for e in candidates(min(4, n_cpu))]
+    results = run_isolated('get_Z', path, n_beats, configs)
+    table += [('get_Z', r, c) for r, c in results]
+    best = dict(max(results, key=lambda r: r[0])[1])
+
+    # inference strip size
+    configs = [dict(best, n_parts=p) for p in [2, 5, 10, 20, 40]]
+    results = run_isolated('get_Z', path, n_beats, configs)
+    table += [('get_Z', r, c) for r, c in results]
+    best_rate, best = max(results, key=lambda r: r[0])
+
+    # concurrent encoding processes sharing the cores
+    best['encode_workers'] = 1
+    for w in candidates(n_cpu)[1:]:
+        config = dict(best, intra_op_threads=max(1, n_cpu//w), inter_op_threads=1)
+        rate, _ = run_isolated('get_Z', path, n_beats, [config], n_workers=w)[0]
+        table.append(('get_Z_x{}'.format(w), rate, config))
+        if rate > best_rate:
+            best_rate, best['encode_workers'] = rate, w
+
+    # training step
+    configs = [dict(best, batch_size=b, n_towers=t, n_steps=n_steps)
+               for b in [16, 32, 64, 128] for t in [1, 2, 4] if b % t == 0]
+    results = run_isolated('train', path, n_beats, configs)
+    table += [('train', r, c) for r, c in results]
+    train_best = max(results, key=lambda r: r[0])[1]
+    best['batch_size'] = train_best['batch_size']
+    best['n_towers'] = train_best['n_towers']
+
+    profile = {'intra_op_threads': best['intra_op_threads'],
+               'inter_op_threads': best['inter_op_threads'],
+               'n_parts': best['n_parts'],
+               'encode_workers': best['encode_workers'],
+               'batch_size': best['batch_size'],
+               'n_towers': best['n_towers'],
+               'host': platform.node(),
+               'cpu_count': n_cpu,
+               'results': [{'kind': k, 'beats_per_sec': r, 'config': c}
+                           for k, r, c in table]}
+    with open(save_path, 'w') as f:
+        json.dump(profile, f, indent=1)
+    print('Execution profile saved in file: %s' % save_path)
+    return profile
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+                    formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--record', type=str, required=True,
+        help='*.npy record used for the benchmarks')
+    parser.add_argument('--n_beats', type=int, default=3000,
+        help='beats of the record used by get_Z and training')
+    parser.add_argument('--n_steps', type=int, default=10,
+        help='timed training steps per configuration')
+    parser.add_argument('--save_path', type=str, default=EXECUTION_PROFILE)
+    args = parser.parse_args()
+
+    autotune(args.record, args.n_beats, args.n_steps, args.save_path)
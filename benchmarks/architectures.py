@@ -0,0 +1,124 @@
+""" Throughput against quality of the model architectures ('gru', 'conv').
+
+For every architecture, in a fresh process: trains --n_train_steps on the
+synthetic corpus (benchmarks.synthetic), reports training steps/s, the
+frame-weighted MSE on a held-out synthetic record (a seed the corpus does
+not use) and get_Z beats/s on it with the trained weights. Results are written as JSON:
+
+    python -m benchmarks.architectures --output architectures.json
+"""
+import os
+import json
+import time
+import argparse
+import tempfile
+import multiprocessing
+
+import numpy as np
+
+
+def encoder_params(architecture):
+    from ecg_encoder_parameters import parameters as PARAM
+    return dict(n_frames=PARAM['n_frames'],
+                n_channel=PARAM['n_channels'],
+                n_hidden_RNN=PARAM['n_hidden_RNN'],
+                reduction_ratio=PARAM['rr'],
+                frame_weights=PARAM['frame_weights'],
+                architecture=architecture)
+
+
+def held_out_batches(data, batch_size, n_batches):
+    import ecg_encoder_tools as utils
+    from ecg_encoder_parameters import parameters as PARAM
+    windows = list(utils.step_generator(data, n_frames=PARAM['n_frames'],
+        overlap=0, get_data=True, rr=PARAM['rr']))
+    return [utils.merge_batches(windows[s:s+batch_size])
+            for s in range(0, batch_size*n_batches, batch_size)
+            if s + batch_size <= len(windows)]
+
+
+def benchmark_architecture(args):
+    # runs in a fresh process: one graph per architecture
+    architecture, corpus_dir, n_train_steps, n_valid_batches = args
+    import ecg_encoder_tools as utils
+    from ecg_encoder_parameters import parameters as PARAM
+    from ecg_encoder import ECGEncoder
+    from benchmarks.synthetic import generate_record
+
+    valid_data = generate_record(n_beats=5000, seed=10**6)
+    loader = utils.LoadDataFileShuffling(batch_size=PARAM['batch_size'],
+        path_to_data=corpus_dir, gen=utils.step_generator,
+        gen_params=dict(n_frames=PARAM['n_frames'], overlap=0, get_data=True,
+                        rr=PARAM['rr']),
+        file_max_len=None, file_min_len=None)
+    valid = held_out_batches(valid_data, PARAM['batch_size'], n_valid_batches)
+    model_dir = tempfile.mkdtemp()
+    res = {'architecture': architecture}
+
+    with ECGEncoder(do_train=True, summary_dir=os.path.join(model_dir, 'summary'),
+                    **encoder_params(architecture)) as ecg_encoder:
+        batches_time = 0.
+        start_time = time.time()
+        for i in range(n_train_steps):
+            t = time.time()
+            batch = loader.get_batch()
+            batches_time += time.time() - t
+            ecg_encoder.sess.run(ecg_encoder.train, feed_dict={
+                ecg_encoder.inputs : batch['normal_data'],
+                ecg_encoder.sequence_length : batch['sequence_length'],
+                ecg_encoder.keep_prob : PARAM['keep_prob'],
+                ecg_encoder.weight_decay : PARAM['weight_decay'],
+                ecg_encoder.learn_rate : PARAM['learn_rate_start']})
+        res['train_steps_per_sec'] = n_train_steps/(time.time() - start_time - batches_time)
+
+        mse, n_beats = 0., 0
+        for batch in valid:
+            n = len(batch['sequence_length'])
+            mse += n*ecg_encoder.sess.run(ecg_encoder.mse, feed_dict={
+                ecg_encoder.inputs : batch['normal_data'],
+                ecg_encoder.sequence_length : batch['sequence_length'],
+                ecg_encoder.keep_prob : 1})
+            n_beats += n
+        res['valid_mse'] = mse/max(n_beats, 1)
+        ecg_encoder.saver.save(ecg_encoder.sess, os.path.join(model_dir, 'model'))
+
+    with ECGEncoder(do_train=False, n_parts=10,
+                    summary_dir=os.path.join(model_dir, 'summary'),
+                    **encoder_params(architecture)) as ecg_encoder:
+        ecg_encoder.load_model(model_dir)
+        ecg_encoder.get_Z(valid_data, None, None, use_delta_coding=False) # warm-up
+        start_time = time.time()
+        ecg_encoder.get_Z(valid_data, None, None, use_delta_coding=False)
+        res['encode_beats_per_sec'] = len(valid_data['beats'])/(time.time() - start_time)
+    return res
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+                    formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--corpus_dir', type=str, default='synthetic_corpus',
+        help='generated with benchmarks.synthetic if it does not exist')
+    parser.add_argument('--architectures', type=str, default='gru,conv')
+    parser.add_argument('--n_train_steps', type=int, default=500)
+    parser.add_argument('--n_valid_batches', type=int, default=20)
+    parser.add_argument('--output', type=str, default='architectures.json')
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.corpus_dir):
+        from benchmarks.synthetic import generate_corpus
+        generate_corpus(args.corpus_dir, n_records=8, beats_per_record=5000)
+
+    ctx = multiprocessing.get_context('spawn')
+    results = []
+    for architecture in args.architectures.split(','):
+        with ctx.Pool(1, maxtasksperchild=1) as pool:
+            results.append(pool.apply(benchmark_architecture, ((architecture,
+                args.corpus_dir, args.n_train_steps, args.n_valid_batches),)))
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=1)
+    print('{:<14}{:>14}{:>14}{:>12}'.format('architecture', 'train steps/s',
+                                            'encode beats/s', 'valid MSE'))
+    for r in results:
+        print('{:<14}{:>14.2f}{:>14.1f}{:>12.6f}'.format(r['architecture'],
+            r['train_steps_per_sec'], r['encode_beats_per_sec'], r['valid_mse']))
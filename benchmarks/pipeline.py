@@ -0,0 +1,232 @@
+""" End-to-end benchmark on a synthetic corpus (benchmarks.synthetic).
+
+Every stage runs in a fresh process, so its peak RSS is its own. Results
+are written as JSON (beats/s, MB/s of signal, peak RSS per stage) together
+with the git commit, so runs on different commits can be compared:
+
+    python -m benchmarks.pipeline --output before.json
+    python -m benchmarks.pipeline --output after.json --compare before.json
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import subprocess
+import contextlib
+import multiprocessing
+
+import numpy as np
+
+
+STAGES = ['step_generator', 'get_batch', 'train_step', 'get_Z', 'predict',
+          'clustering_store', 'clustering_kmeans', 'clustering_stats']
+
+
+def record_bytes(data):
+    import ecg_encoder_tools as utils
+    return sum(c.nbytes for c in utils.get_record_channels(data))
+
+
+def new_encoder(do_train, summary_dir, n_parts=None):
+    from ecg_encoder_parameters import parameters as PARAM
+    from ecg_encoder import ECGEncoder
+    return ECGEncoder(
+        n_frames=PARAM['n_frames'],
+        n_channel=PARAM['n_channels'],
+        n_hidden_RNN=PARAM['n_hidden_RNN'],
+        reduction_ratio=PARAM['rr'],
+        frame_weights=PARAM['frame_weights'],
+        architecture=PARAM['architecture'],
+        n_parts=n_parts,
+        summary_dir=summary_dir,
+        do_train=do_train)
+
+
+def batch_bytes(batch):
+    # float32 signal of the beats of a loader batch (padded to rr samples)
+    from ecg_encoder_parameters import parameters as PARAM
+    return int(batch['sequence_length'].sum())*PARAM['n_channels']*4
+
+
+def gen_params(get_events=False):
+    from ecg_encoder_parameters import parameters as PARAM
+    return dict(n_frames=PARAM['n_frames'], overlap=PARAM['n_frames']-1,
+                get_data=True, get_delta_coded_data=False,
+                get_events=get_events, rr=PARAM['rr'])
+
+
+def run_stage(args):
+    # runs in a fresh process, returns (n_beats, n_bytes, seconds)
+    stage, corpus_dir, work_dir, n_iter = args
+    import ecg_encoder_tools as utils
+    from ecg_encoder_parameters import parameters as PARAM
+    paths = utils.find_files(corpus_dir, '*.npy')
+
+    if stage == 'step_generator':
+        n_beats, n_bytes, start_time = 0, 0, time.time()
+        for path in paths:
+            data = np.load(path).item()
+            for batch in utils.step_generator(data, **gen_params(True)):
+                pass
+            n_beats += len(data['beats'])
+            n_bytes += record_bytes(data)
+        return n_beats, n_bytes, time.time() - start_time
+
+    if stage == 'get_batch':
+        start_time = time.time()
+        loader = utils.LoadDataFileShuffling(batch_size=PARAM['batch_size'],
+            path_to_data=corpus_dir, gen=utils.step_generator,
+            gen_params=dict(gen_params(), overlap=0), file_max_len=None,
+            file_min_len=None)
+        n_beats, n_bytes = 0, 0
+        for i in range(n_iter):
+            batch = loader.get_batch()
+            n_beats += len(batch['sequence_length'])
+            n_bytes += batch_bytes(batch)
+        return n_beats, n_bytes, time.time() - start_time
+
+    if stage == 'train_step':
+        loader = utils.LoadDataFileShuffling(batch_size=PARAM['batch_size'],
+            path_to_data=corpus_dir, gen=utils.step_generator,
+            gen_params=dict(gen_params(), overlap=0), file_max_len=None,
+            file_min_len=None)
+        batches = [loader.get_batch() for i in range(n_iter + 2)]
+        n_beats, n_bytes = 0, 0
+        with new_encoder(True, os.path.join(work_dir, 'summary')) as encoder:
+            for i, batch in enumerate(batches):
+                if i == 2: # two warm-up steps
+                    start_time = time.time()
+                encoder.sess.run(encoder.train, feed_dict={
+                    encoder.inputs : batch['normal_data'],
+                    encoder.sequence_length : batch['sequence_length'],
+                    encoder.keep_prob : PARAM['keep_prob'],
+                    encoder.weight_decay : PARAM['weight_decay'],
+                    encoder.learn_rate : PARAM['learn_rate_start']})
+                if i >= 2:
+                    n_beats += len(batch['sequence_length'])
+                    n_bytes += batch_bytes(batch)
+        return n_beats, n_bytes, time.time() - start_time
+
+    if stage in ['get_Z', 'predict']:
+        # get_Z runs the inference graph, predict the training one
+        with new_encoder(False, os.path.join(work_dir, 'summary'),
+                         10 if stage == 'get_Z' else None) as encoder:
+            start_time = time.time()
+            n_beats, n_bytes = 0, 0
+            for path in paths[:1] if stage == 'predict' else paths:
+                data = np.load(path).item()
+                if stage == 'get_Z':
+                    encoder.get_Z(data, os.path.join(work_dir,
+                        os.path.basename(path)[:-4] + '_Z.npy'), None, False)
+                else:
+                    encoder.predict(path, None, None, False)
+                n_beats += len(data['beats'])
+                n_bytes += record_bytes(data)
+        return n_beats, n_bytes, time.time() - start_time
+
+    # clustering stages read the Z-codes written by the get_Z stage
+    import clustering
+    from packed_labels import PackedLabels
+
+    def load_store():
+        states, labels, beats = [], [], []
+        for path in paths:
+            data = np.load(path).item()
+            states.append(np.load(os.path.join(work_dir,
+                os.path.basename(path)[:-4] + '_Z.npy')).astype(np.float32))
+            labels.append(PackedLabels.from_dense(data['events']))
+            beats.append(np.arange(len(data['beats'])))
+        return clustering.create_clustering_store(states, labels, paths, beats)
+
+    start_time = time.time()
+    store = load_store()
+    if stage == 'clustering_kmeans':
+        start_time = time.time()
+        clustering.get_cluster_labels(store, n_clusters=10)
+    elif stage == 'clustering_stats':
+        cluster_labels = np.random.randint(0, 10, len(store['beat']))
+        start_time = time.time()
+        with contextlib.redirect_stdout(open(os.devnull, 'w')):
+            clustering.print_clustering_stats(cluster_labels, store)
+    return len(store['beat']), store['state'].nbytes, time.time() - start_time
+
+
+def measure_stage(stage, corpus_dir, work_dir, n_iter):
+    ctx = multiprocessing.get_context('spawn')
+    with ctx.Pool(1, maxtasksperchild=1) as pool:
+        n_beats, n_bytes, seconds, peak_rss_mb = pool.apply(measured,
+            ((stage, corpus_dir, work_dir, n_iter),))
+    return {'beats': n_beats, 'seconds': seconds,
+            'beats_per_sec': n_beats/seconds,
+            'mb_per_sec': n_bytes/seconds/2**20,
+            'peak_rss_mb': peak_rss_mb}
+
+
+def measured(args):
+    import resource
+    result = run_stage(args)
+    return result + (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024,)
+
+
+def git_commit(repo_dir):
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+            cwd=repo_dir).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_results(results, baseline=None):
+    print('{:<20}{:>12}{:>10}{:>14}'.format('stage', 'beats/s', 'MB/s',
+                                            'peak RSS MB'))
+    for stage, r in results['stages'].items():
+        line = '{:<20}{:>12.1f}{:>10.2f}{:>14.1f}'.format(stage,
+            r['beats_per_sec'], r['mb_per_sec'], r['peak_rss_mb'])
+        if baseline is not None and stage in baseline['stages']:
+            b = baseline['stages'][stage]
+            line += '   x{:.2f} speed, x{:.2f} memory'.format(
+                r['beats_per_sec']/b['beats_per_sec'],
+                r['peak_rss_mb']/b['peak_rss_mb'])
+        print(line)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+                    formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--corpus_dir', type=str, default='synthetic_corpus',
+        help='generated with benchmarks.synthetic if it does not exist')
+    parser.add_argument('--work_dir', type=str, default='benchmark_work')
+    parser.add_argument('--n_records', type=int, default=8)
+    parser.add_argument('--beats_per_record', type=int, default=5000)
+    parser.add_argument('--n_iter', type=int, default=20,
+        help='batches for get_batch and train_step')
+    parser.add_argument('--stages', type=str, default=','.join(STAGES))
+    parser.add_argument('--output', type=str, default='benchmark.json')
+    parser.add_argument('--compare', type=str, default=None,
+        help='JSON of an earlier run to compare with')
+    args = parser.parse_args()
+
+    repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    sys.path.insert(0, repo_dir)
+    if not os.path.isdir(args.corpus_dir):
+        from benchmarks.synthetic import generate_corpus
+        generate_corpus(args.corpus_dir, args.n_records, args.beats_per_record)
+    os.makedirs(args.work_dir, exist_ok=True)
+
+    results = {'commit': git_commit(repo_dir), 'host': platform.node(),
+               'cpu_count': os.cpu_count(), 'n_records': args.n_records,
+               'beats_per_record': args.beats_per_record, 'stages': {}}
+    for stage in args.stages.split(','):
+        print('Running', stage)
+        results['stages'][stage] = measure_stage(stage, args.corpus_dir,
+                                                 args.work_dir, args.n_iter)
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=1)
+    baseline = None
+    if args.compare is not None:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_results(results, baseline)
@@ -0,0 +1,57 @@
+""" Import-time guard for the modules used by data-loading and encoding
+workers. Every module is imported in a fresh interpreter; the run fails if
+one of them pulls in a heavy dependency or takes longer than --max_seconds.
+
+    python -m benchmarks.startup
+"""
+import os
+import sys
+import json
+import argparse
+import subprocess
+
+
+# modules that must load without heavy dependencies
+DATA_PATH_MODULES = ['ecg_encoder_tools', 'ecg_encoder_cache', 'packed_labels',
+                     'cluster_model', 'ecg_encoder_profiling',
+                     'ecg_encoder_validation']
+HEAVY_MODULES = ['tensorflow', 'pandas', 'matplotlib', 'sklearn', 'scipy']
+
+PROBE = """
+import sys, time, json, resource
+start_time = time.perf_counter()
+import {module}
+print(json.dumps({{
+    'seconds': time.perf_counter() - start_time,
+    'max_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024,
+    'heavy': [m for m in {heavy} if m in sys.modules]}}))
+"""
+
+
+def measure(module, repo_dir):
+    out = subprocess.check_output([sys.executable, '-c',
+        PROBE.format(module=module, heavy=HEAVY_MODULES)], cwd=repo_dir)
+    return json.loads(out.decode().strip().splitlines()[-1])
+
+
+def main(max_seconds):
+    repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    failed = False
+    print('{:<28}{:>10}{:>12}  {}'.format('module', 'seconds', 'max RSS MB',
+                                          'heavy imports'))
+    for module in DATA_PATH_MODULES:
+        res = measure(module, repo_dir)
+        bad = res['heavy'] or res['seconds'] > max_seconds
+        failed = failed or bad
+        print('{:<28}{:>10.3f}{:>12.1f}  {}{}'.format(module, res['seconds'],
+            res['max_rss_mb'], ', '.join(res['heavy']) or '-',
+            '  <-- REGRESSION' if bad else ''))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+                    formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--max_seconds', type=float, default=1.0)
+    args = parser.parse_args()
+    sys.exit(main(args.max_seconds))
@@ -0,0 +1,84 @@
+""" Synthetic Holter corpus in the record layout of the real data: a dict
+with `beats`, channels written with ecg.utils.write_channels, `events`
+(n_beats x n_labels, 0/1) and `disease_name`. The signal is a sum of
+Gaussian P, QRS and T waves with a jittered RR interval and noise, so beat
+lengths and the number of beats per hour look like real recordings.
+
+    python -m benchmarks.synthetic --save_dir synthetic --n_records 16
+"""
+import os
+import argparse
+from multiprocessing import Pool
+
+import numpy as np
+
+
+SAMPLE_RATE = 175
+# (offset from R in seconds, width in seconds, amplitude) per wave
+WAVES = [(-0.20, 0.025, 0.15), (-0.03, 0.010, -0.10), (0.0, 0.012, 1.0),
+         (0.03, 0.010, -0.25), (0.25, 0.050, 0.30)]
+
+
+def generate_record(n_beats, n_channels=3, heart_rate=70, event_rate=0.01,
+    seed=0):
+    import ecg
+    from ecg.utils.diseases import holter_diseases_with_noise
+
+    rng = np.random.RandomState(seed)
+    rr = SAMPLE_RATE*60./heart_rate*(1 + 0.1*rng.randn(n_beats)).clip(0.6, 1.6)
+    beats = (np.cumsum(rr) + SAMPLE_RATE).astype(np.int64)
+    n_samples = int(beats[-1] + SAMPLE_RATE)
+    t = np.arange(n_samples)
+
+    gains = 0.5 + rng.rand(n_channels)
+    channels = [0.05*rng.randn(n_samples) for c in range(n_channels)]
+    for offset, width, amplitude in WAVES:
+        # every wave only touches +-4 widths around its beat
+        half = int(4*width*SAMPLE_RATE) + 1
+        centers = beats + int(offset*SAMPLE_RATE)
+        idx = (centers[:, None] + np.arange(-half, half + 1)).clip(0, n_samples - 1)
+        wave = amplitude*np.exp(-0.5*((idx - centers[:, None])/(width*SAMPLE_RATE))**2)
+        for c in range(n_channels):
+            np.add.at(channels[c], idx.ravel(), gains[c]*wave.ravel())
+    channels = [c.astype(np.float32) for c in channels]
+
+    names = np.array(holter_diseases_with_noise, dtype=object)
+    events = (rng.rand(n_beats, len(names)) < event_rate).astype(np.int8)
+    data = {'beats': beats, 'events': events, 'disease_name': names}
+    return ecg.utils.write_channels(data, channels)
+
+
+def write_record(args):
+    path, n_beats, n_channels, seed = args
+    np.save(path, generate_record(n_beats, n_channels, seed=seed))
+    return path
+
+
+def generate_corpus(save_dir, n_records=16, beats_per_record=20000,
+    n_channels=3, seed=0, n_workers=None):
+    """ Write n_records synthetic *.npy records to save_dir, the same seed
+    gives the same corpus. Returns the list of paths.
+    """
+    os.makedirs(save_dir, exist_ok=True)
+    jobs = [(os.path.join(save_dir, 'synthetic_{:04d}.npy'.format(i)),
+             beats_per_record, n_channels, seed + i) for i in range(n_records)]
+    with Pool(n_workers) as pool:
+        paths = pool.map(write_record, jobs)
+    print('Generated {} records of {} beats in {}'.format(n_records,
+        beats_per_record, save_dir))
+    return paths
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+                    formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--save_dir', type=str, required=True)
+    parser.add_argument('--n_records', type=int, default=16)
+    parser.add_argument('--beats_per_record', type=int, default=20000)
+    parser.add_argument('--n_channels', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--n_workers', type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    generate_corpus(args.save_dir, args.n_records, args.beats_per_record,
+                    args.n_channels, args.seed, args.n_workers)
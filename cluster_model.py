@@ -0,0 +1,83 @@
+import os
+
+import numpy as np
+
+
+CLUSTER_MODEL_VERSION = 1
+
+
+class ClusterModel(object):
+    """ Fitted cluster centroids plus the optional linear reduction applied to
+    Z-codes before clustering. Maps ECGEncoder.get_Z output to cluster ids.
+
+    Args:
+        centroids: array of shape [n_clusters, n_dims] in the reduced space.
+        reduction_mean: array of shape [2*hRNN] or None if no reduction.
+        reduction_components: array of shape [n_dims, 2*hRNN] or None.
+        cluster_ids: label of every centroid, None means 0..n_clusters-1.
+    """
+
+    def __init__(self, centroids, reduction_mean=None,
+        reduction_components=None, cluster_ids=None):
+
+        self.centroids = np.asarray(centroids, np.float32)
+        self.reduction_mean = None if reduction_mean is None \
+            else np.asarray(reduction_mean, np.float32)
+        self.reduction_components = None if reduction_components is None \
+            else np.asarray(reduction_components, np.float32)
+        self.cluster_ids = None if cluster_ids is None \
+            else np.asarray(cluster_ids, np.int32)
+        self.centroids_sq = np.sum(np.square(self.centroids), 1)
+
+    @property
+    def n_clusters(self):
+        return self.centroids.shape[0]
+
+    # --------------------------------------------------------------------------
+    def transform(self, Z):
+        Z = np.asarray(Z, np.float32)
+        if self.reduction_components is None:
+            return Z
+        return np.dot(Z - self.reduction_mean, self.reduction_components.T)
+
+    # --------------------------------------------------------------------------
+    def predict(self, Z, chunk_size=65536):
+        """ Return cluster id for every row of Z.
+
+        Distances are computed chunk by chunk as |c|^2 - 2*z.c (|z|^2 does not
+        change the argmin), so memory stays at chunk_size x n_clusters.
+        """
+        labels = np.empty([len(Z)], np.int32)
+        for s in range(0, len(Z), chunk_size):
+            z = self.transform(Z[s:s+chunk_size])
+            dists = self.centroids_sq[None, :] - 2*np.dot(z, self.centroids.T)
+            labels[s:s+chunk_size] = np.argmin(dists, 1)
+        return labels if self.cluster_ids is None else self.cluster_ids[labels]
+
+    # --------------------------------------------------------------------------
+    def save(self, path):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        arrays = {'version': np.array(CLUSTER_MODEL_VERSION),
+                  'centroids': self.centroids}
+        if self.reduction_components is not None:
+            arrays['reduction_mean'] = self.reduction_mean
+            arrays['reduction_components'] = self.reduction_components
+        if self.cluster_ids is not None:
+            arrays['cluster_ids'] = self.cluster_ids
+        with open(path, 'wb') as f:
+            np.savez(f, **arrays)
+        print('Cluster model saved in file: %s' % path)
+
+    # --------------------------------------------------------------------------
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as f:
+            version = int(f['version'])
+            if version != CLUSTER_MODEL_VERSION:
+                raise ValueError('Cluster model {} has version {}, expected {}'
+                    .format(path, version, CLUSTER_MODEL_VERSION))
+            return cls(f['centroids'],
+                       f['reduction_mean'] if 'reduction_mean' in f else None,
+                       f['reduction_components']
+                       if 'reduction_components' in f else None,
+                       f['cluster_ids'] if 'cluster_ids' in f else None)
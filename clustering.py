@@ -5,11 +5,11 @@ import importlib
 from random import shuffle
 
 import numpy as np
-import matplotlib.pyplot as plt
 import tqdm
-from sklearn.cluster import KMeans
 
 from ecg.utils import tools
+from cluster_model import ClusterModel
+from packed_labels import PackedLabels
 from ecg.utils.diseases import holter_diseases_with_noise as new_diseases
 
 cache_path = 'cluster_cache'
@@ -24,9 +24,8 @@ def get_file_pointers_for_cluster_centers(cluster_labels, clustering_data, clust
     for cluster_idx in cluster_indexes:
         #find z and file pointers for current cluster
         idx = np.argwhere(np.array(cluster_labels) == cluster_idx).ravel()
-        cluster_v = np.vstack([data['state'] for data in clustering_data])[idx]
-        cluster_pointers = np.vstack([np.hstack(data['fp']) 
-                            for data in clustering_data])[idx]
+        cluster_v = clustering_data['state'][idx]
+        cluster_pointers = get_file_pointers(clustering_data, idx)
         cluster_center = np.mean(cluster_v, 0)
 
         def find_central_z_idx(array, value):
@@ -40,10 +39,34 @@ def get_file_pointers_for_cluster_centers(cluster_labels, clustering_data, clust
     return file_pointers
 
 
+def get_file_pointers(clustering_data, idx):
+    return list(zip(clustering_data['path'][idx], clustering_data['beat'][idx]))
+
+
+def create_clustering_store(list_of_states, list_of_labels, list_of_paths,
+    list_of_beats):
+    # columnar Z store: one row per beat, labels stay bit-packed
+    return {'state': np.vstack(list_of_states).astype(np.float32),
+            'label': PackedLabels.concatenate(list_of_labels),
+            'path': np.concatenate([np.full(len(b), p, dtype=object)
+                                    for p, b in zip(list_of_paths, list_of_beats)]),
+            'beat': np.concatenate(list_of_beats).astype(np.int32)}
+
+
+def clustering_store_from_samples(list_of_samples):
+    # caches written before the columnar store hold a list of per-beat dicts
+    return create_clustering_store(
+        [d['state'][None, :] for d in list_of_samples],
+        [np.asarray(d['label'])[None, :] for d in list_of_samples],
+        [d['fp'][0] for d in list_of_samples],
+        [[d['fp'][1]] for d in list_of_samples])
+
+
 def display_dists_and_strength(snn, disease_labels, snn_str, snn_dists):
+    # disease_labels is PackedLabels
 
     pvc = new_diseases.index('PVC')
-    pvc_idx = np.where(disease_labels[:, pvc])[0]
+    pvc_idx = np.where(disease_labels.mask(pvc))[0]
 
     top_str_idx = snn[np.arange(len(snn)), np.argmax(snn_str, 1)]
     top_str_idx_pvc = top_str_idx[pvc_idx]
@@ -53,13 +76,13 @@ def display_dists_and_strength(snn, disease_labels, snn_str, snn_dists):
 
 
     print('Top str snn for pvc beats:')
-    for top_label in disease_labels[top_str_idx_pvc]:
-        print(new_diseases[np.where(top_label != 0)[0][0]])
+    for top_label in disease_labels[top_str_idx_pvc].first_label():
+        print(new_diseases[top_label] if top_label >= 0 else '(no label)')
     print()
 
     print('Top distance snn for pvc beats:')
-    for top_label in disease_labels[top_dist_idx_pvc]:
-        print(new_diseases[np.where(top_label != 0)[0][0]])
+    for top_label in disease_labels[top_dist_idx_pvc].first_label():
+        print(new_diseases[top_label] if top_label >= 0 else '(no label)')
     print()
 
     unique_snn = np.unique(snn[pvc_idx])
@@ -67,11 +90,19 @@ def display_dists_and_strength(snn, disease_labels, snn_str, snn_dists):
         len(pvc_idx), len(unique_snn), len(np.intersect1d(pvc_idx, unique_snn))))
 
 
-def get_cluster_labels(clustering_data, n_clusters, use_snn_clustering=False):
+def get_cluster_labels(clustering_data, n_clusters, use_snn_clustering=False,
+    n_components=None):
     print('Starting clusterting with {} clusters.'.format(n_clusters))
 
-    hidden_states = np.vstack([d['state'] for d in clustering_data]).astype(np.float32)
-    disease_labels = np.vstack([d['label'] for d in clustering_data]).astype(np.int32)
+    hidden_states = clustering_data['state']
+
+    reduction_mean, reduction_components = None, None
+    if n_components is not None:
+        from sklearn.decomposition import PCA
+        print('Reducing Z to {} components with PCA'.format(n_components))
+        pca = PCA(n_components=n_components).fit(hidden_states)
+        reduction_mean, reduction_components = pca.mean_, pca.components_
+        hidden_states = pca.transform(hidden_states).astype(np.float32)
 
     if use_snn_clustering:
         print('Clustering algorithm: SNN')
@@ -79,34 +110,43 @@ def get_cluster_labels(clustering_data, n_clusters, use_snn_clustering=False):
                                 hidden_states, n_clusters, dist_func='l2norm')
     else:
         print('Clustering algorithm: KMeans')
+        from sklearn.cluster import KMeans
         model = KMeans(n_clusters=n_clusters, max_iter=1000)
         cluster_labels = model.fit_predict(hidden_states)
     print('Clustering finished.')
     cluster_idx = set(cluster_labels)
-    return cluster_labels, cluster_idx
+
+    # SNN has no centroids of its own, new beats go to the nearest cluster mean
+    cluster_ids = np.array(sorted(cluster_idx))
+    centroids = model.cluster_centers_ if not use_snn_clustering else \
+        np.stack([hidden_states[cluster_labels == c].mean(0) for c in cluster_ids])
+    cluster_model = ClusterModel(centroids, reduction_mean, reduction_components,
+        cluster_ids=None if not use_snn_clustering else cluster_ids)
+    return cluster_labels, cluster_idx, cluster_model
 
 def print_clustering_stats(cluster_labels, clustering_data):
 
-    clustering_data = np.vstack([d['label'] for d in clustering_data])
+    disease_labels = clustering_data['label']
 
     print('\nSummary disease count:')
-    for i, disease_count in enumerate(np.sum(clustering_data, 0)):
+    for i, disease_count in enumerate(disease_labels.counts()):
         if disease_count:
             print('Disease: {}, count: {}, ratio: {}'.format(
-                new_diseases[i], disease_count, disease_count/len(clustering_data)))
-
+                new_diseases[i], disease_count, disease_count/len(disease_labels)))
 
+    cluster_sizes = np.bincount(cluster_labels)
+    cluster_counts = disease_labels.counts_by(cluster_labels, len(cluster_sizes))
     for label in set(cluster_labels):
-        cluster_data = clustering_data[cluster_labels == label]
-        summary_labels = np.sum(cluster_data, 0)
-        print('\nCluster {} with size {}.'.format(label, len(cluster_data)))
+        summary_labels = cluster_counts[label]
+        print('\nCluster {} with size {}.'.format(label, cluster_sizes[label]))
         print('Diseases in cluster:')
         for i, disease_count in enumerate(summary_labels):
             if disease_count:
                 print('{}, count: {}, ratio: {}'.format(
-                    new_diseases[i], disease_count, disease_count/len(cluster_data)))
+                    new_diseases[i], disease_count, disease_count/cluster_sizes[label]))
 
 def plot_beats(file_pointers, save_path, caching=True, skip_prob=0):
+    import matplotlib.pyplot as plt
     print('Creating plots...')
     tools.maybe_create_dirs(save_path)
     if caching:
@@ -158,20 +198,116 @@ def plot_beats(file_pointers, save_path, caching=True, skip_prob=0):
 
 def plot_clusters(clustering_data, cluster_labels, save_path):
 
-    clustering_data = np.asarray(clustering_data)
-    cluster_data = {}
+    n_samples = len(cluster_labels)
     for label in set(cluster_labels):
-        cluster_data[label] = clustering_data[cluster_labels == label]
-    for label, data in cluster_data.items():
-        skip_prob = min(100*len(data)/len(clustering_data), 0.999)
+        idx = np.where(cluster_labels == label)[0]
+        skip_prob = min(100*len(idx)/n_samples, 0.999)
         print('\nPlotting cluster with label {}, with total size of {}. Skip prob: {}.'.format(
-            label, len(data), skip_prob))
+            label, len(idx), skip_prob))
         plot_beats(
-                   file_pointers=np.vstack([d['fp'] for d in data]),
-                   save_path=os.path.join(save_path, '{}_{}total'.format(label, len(data))),
+                   file_pointers=get_file_pointers(clustering_data, idx),
+                   save_path=os.path.join(save_path, '{}_{}total'.format(label, len(idx))),
                    caching=True,
                    skip_prob=skip_prob)
 
+def share_clustering_arrays(clustering_data, path):
+    # vstack states and labels once and keep them as memory-mapped .npy files,
+    # so every sweep worker reads the same pages instead of its own copy
+    tools.maybe_create_dirs(path)
+    states_path = os.path.join(path, 'states.npy')
+    labels_path = os.path.join(path, 'labels.npy')
+    np.save(states_path, clustering_data['state'])
+    np.save(labels_path, clustering_data['label'].bits)
+    return states_path, labels_path, clustering_data['label'].n_labels
+
+
+def extend_centers(hidden_states, centers, n_clusters, rng, n_candidates=20000):
+    # warm start for a larger k: keep the previous centers and add the missing
+    # ones with k-means++ (D^2) sampling over a subsample of the states
+    sample = hidden_states[np.sort(rng.choice(len(hidden_states),
+                           min(n_candidates, len(hidden_states)), replace=False))]
+    centers = list(centers)
+    if not centers:
+        centers.append(sample[rng.randint(len(sample))])
+    while len(centers) < n_clusters:
+        c = np.asarray(centers)
+        dists = (np.sum(np.square(sample), 1)[:, None]
+                 - 2*np.dot(sample, c.T) + np.sum(np.square(c), 1)[None, :])
+        dists = np.maximum(dists.min(1), 0)
+        p = dists/dists.sum() if dists.sum() > 0 else None
+        centers.append(sample[rng.choice(len(sample), p=p)])
+    return np.asarray(centers, dtype=np.float32)
+
+
+def cluster_purity(cluster_labels, disease_labels, n_clusters):
+    # fraction of beats that carry the dominant disease of their cluster
+    counts = disease_labels.counts_by(cluster_labels, n_clusters)
+    return counts.max(1).sum()/len(cluster_labels)
+
+
+def fit_n_clusters_chain(args):
+    # worker: fits an increasing chain of k, each warm-started from the previous
+    states_path, labels_path, n_labels, chain, silhouette_sample, seed = args
+    from sklearn.cluster import KMeans
+    from sklearn.metrics import silhouette_score
+    import time
+
+    hidden_states = np.load(states_path, mmap_mode='r')
+    disease_labels = PackedLabels(np.load(labels_path, mmap_mode='r'), n_labels)
+    rng = np.random.RandomState(seed)
+
+    rows = []
+    centers = np.empty([0, hidden_states.shape[1]], np.float32)
+    for n_clusters in chain:
+        start_time = time.time()
+        init = extend_centers(hidden_states, centers, n_clusters, rng)
+        model = KMeans(n_clusters=n_clusters, init=init, n_init=1, max_iter=1000)
+        cluster_labels = model.fit_predict(hidden_states)
+        centers = model.cluster_centers_.astype(np.float32)
+        silhouette = silhouette_score(hidden_states, cluster_labels,
+            sample_size=min(silhouette_sample, len(hidden_states)),
+            random_state=seed)
+        rows.append({'n_clusters': n_clusters,
+                     'inertia': model.inertia_,
+                     'silhouette': silhouette,
+                     'purity': cluster_purity(cluster_labels, disease_labels,
+                                              n_clusters),
+                     'time': time.time() - start_time})
+    return rows
+
+
+def sweep_n_clusters(clustering_data, n_clusters_range, n_workers,
+    silhouette_sample=10000, save_dir=None):
+    from multiprocessing import Pool
+
+    print('Sweeping n_clusters over {}.'.format(list(n_clusters_range)))
+    states_path, labels_path, n_labels = share_clustering_arrays(clustering_data,
+        cache_path + '_shared')
+
+    # contiguous chains of k so that warm starts reuse close solutions
+    n_clusters_range = sorted(n_clusters_range)
+    n_workers = max(1, min(n_workers, len(n_clusters_range)))
+    chains = [[int(k) for k in c]
+              for c in np.array_split(n_clusters_range, n_workers)]
+    jobs = [(states_path, labels_path, n_labels, chain, silhouette_sample, i)
+            for i, chain in enumerate(chains)]
+    with Pool(n_workers) as pool:
+        rows = [row for chain_rows in pool.map(fit_n_clusters_chain, jobs)
+                for row in chain_rows]
+    rows.sort(key=lambda r: r['n_clusters'])
+
+    columns = ['n_clusters', 'inertia', 'silhouette', 'purity', 'time']
+    lines = ['\t'.join(columns)]
+    for r in rows:
+        lines.append('{n_clusters}\t{inertia:.3f}\t{silhouette:.4f}'
+                     '\t{purity:.4f}\t{time:.1f}'.format(**r))
+    print('\n' + '\n'.join(lines))
+    if save_dir is not None:
+        tools.maybe_create_dirs(save_dir)
+        with open(os.path.join(save_dir, 'n_clusters_sweep.tsv'), 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+    return rows
+
 if __name__ == '__main__':
 
     parser = argparse.ArgumentParser(
@@ -180,26 +316,49 @@ if __name__ == '__main__':
     parser.add_argument(
                         '--n_clusters', type=int,
                         default=10, help='number of clusters')
+    parser.add_argument(
+                        '--sweep', type=str, default=None,
+                        help='sweep n_clusters as start:stop[:step] instead '
+                             'of a single clustering')
+    parser.add_argument(
+                        '--n_workers', type=int,
+                        default=os.cpu_count(), help='processes for the sweep')
+    parser.add_argument(
+                        '--silhouette_sample', type=int,
+                        default=10000, help='beats sampled for silhouette')
     parser.add_argument(
                         '--save_dir', type=str,
                         help='dir to save plots in', required=True)
+    parser.add_argument(
+                        '--n_components', type=int, default=None,
+                        help='reduce Z with PCA before clustering')
+    parser.add_argument(
+                        '--save_model', type=str, default=None,
+                        help='path to save the fitted cluster model (.npz)')
+    parser.add_argument(
+                        '--memory_profile', type=str, default=None,
+                        help='path of a per-stage memory report (JSON)')
     parser.add_argument(
                     '--use_snn', default=False,
                      dest='use_snn', action='store_true')
     args = parser.parse_args()
+    from ecg_encoder_profiling import memory_profiler
+    if args.memory_profile is not None:
+        memory_profiler.start()
+    memory_profiler.reset('clustering')
 
     def create_clustering_data():
-        # should return a list of dicts with the following keys:
-        # `fp` - tuple, pointer to file (file_name, beat_idx)
-        # `state` - 1-d numpy array which represents embedding (z-code, whatever) 
-        # `label` - 1-d numpy array which represents diseases associated with state
+        # should return a columnar store (see create_clustering_store) with keys:
+        # `path`, `beat` - pointer to file (file_name, beat_idx) for every row
+        # `state` - 2-d numpy array which represents embeddings (z-code, whatever)
+        # `label` - PackedLabels which represents diseases associated with state
         from ecg_encoder_parameters import parameters as PARAM
         import ecg_encoder_tools as utils
         from ecg_encoder import ECGEncoder
         import ecg
 
         # Get Z-code
-        list_of_samples = []
+        list_of_states, list_of_labels, list_of_beats = [], [], []
         path_to_Z = 'predictions/'
         path_to_data = '/data/Work/processed_ecg/valid_files/'
 
@@ -209,28 +368,43 @@ if __name__ == '__main__':
             file_name = ecg.utils.get_file_name(path)
             data = np.load(path).item()
             names = data['disease_name']
-            events = tools.remove_redundant_events(data['events'], names,
-                new_diseases)
+            events = PackedLabels.from_dense(tools.remove_redundant_events(
+                data['events'], names, new_diseases))
             Z = np.load(path_to_Z+file_name+'_Z.npy')
             print('Z shape',Z.shape)
             print('beats',data['beats'].shape)
             s = PARAM['n_frames'] // 2
             e = data['beats'].shape[0] - 1 - PARAM['n_frames'] // 2 - 10*20*2
-            for i in range(s, e):
-                sample = {}
-                sample['fp'] = (path, i)
-                sample['label'] = events[i,:]
-                sample['state'] = Z[i,:]
-                list_of_samples.append(sample)
-        
-        print('number of samples =', len(list_of_samples))
-        return list_of_samples
+            list_of_states.append(Z[s:e,:])
+            list_of_labels.append(events[s:e])
+            list_of_beats.append(np.arange(s, e))
+
+        clustering_data = create_clustering_store(list_of_states,
+            list_of_labels, paths, list_of_beats)
+        print('number of samples =', len(clustering_data['beat']))
+        return clustering_data
 
     clustering_data = tools.run_with_caching(create_clustering_data, cache_path)
-    print('Clustering data size: {}'.format(len(clustering_data)))
+    if isinstance(clustering_data, list):
+        clustering_data = clustering_store_from_samples(clustering_data)
+    print('Clustering data size: {}'.format(len(clustering_data['beat'])))
+    memory_profiler.lap('clustering/store')
+    if args.sweep is not None:
+        sweep_range = range(*[int(v) for v in args.sweep.split(':')])
+        sweep_n_clusters(clustering_data, sweep_range, args.n_workers,
+                         args.silhouette_sample, args.save_dir)
+        sys.exit()
     n_clusters = args.n_clusters
-    cluster_labels, cluster_idx = get_cluster_labels(clustering_data, n_clusters, args.use_snn)
+    cluster_labels, cluster_idx, cluster_model = get_cluster_labels(
+        clustering_data, n_clusters, args.use_snn, args.n_components)
+    memory_profiler.lap('clustering/fit')
+    if args.save_model is not None:
+        cluster_model.save(args.save_model)
     print_clustering_stats(cluster_labels, clustering_data)
+    memory_profiler.lap('clustering/stats')
     plot_clusters(clustering_data, cluster_labels, args.save_dir)
+    memory_profiler.lap('clustering/plot')
+    if args.memory_profile is not None:
+        memory_profiler.write_report(args.memory_profile)
     # file_pointers = get_file_pointers_for_cluster_centers(cluster_labels, clustering_data, cluster_idx)
     # plot_beats(file_pointers, args.save_dir)
\ No newline at end of file
@@ -8,6 +8,10 @@ import numpy as np
 from tqdm import tqdm
 
 import ecg_encoder_tools as utils
+from ecg_encoder_profiling import StageTimer, OpTracer, EXECUTION_PROFILE,\
+    load_execution_profile, memory_profiler
+from ecg_encoder_input import make_input_batch
+from ecg_encoder_checkpoint import AsyncCheckpointWriter
 
 
 
@@ -15,7 +19,31 @@ import ecg_encoder_tools as utils
 class ECGEncoder(object):
 
     def __init__(self, n_frames, n_channel, n_hidden_RNN, reduction_ratio,
-        frame_weights, do_train, n_parts=None):
+        frame_weights, do_train, n_parts=None, input_pipeline=None, n_towers=1,
+        summary_dir=None, n_threads=None, execution_profile=EXECUTION_PROFILE,
+        architecture='gru', inter_op_threads=None):
+        """
+        Args:
+            architecture: 'gru' for the recurrent frame compressor and
+                decoders, 'conv' for dilated convolutions over the samples of
+                a beat and non-autoregressive decoders. Z has the same shape
+                in both, their checkpoints are not interchangeable.
+            n_threads: intra- and inter-op thread pool size of the session.
+                If None, the thread counts come from execution_profile (saved
+                by autotune.py) when it exists, else TensorFlow defaults.
+            inter_op_threads: inter-op pool size when it should differ from
+                n_threads, e.g. 1 for processes sharing the cores.
+            summary_dir: directory for the summary writer, by default a new
+                numbered subdirectory of summary/.
+            n_towers: number of data-parallel towers sharing the variables.
+                The batch is split between towers and their gradients are
+                averaged every step. Batch size must be divisible by n_towers.
+            input_pipeline: None to feed batches through placeholders, or dict
+                of ecg_encoder_input.make_input_batch arguments (file_pattern,
+                batch_size, ...) to read TFRecord shards with queue runners
+                started with the session. Feeding inputs and sequence_length
+                still overrides it.
+        """
 
         self.n_frames = n_frames
         self.n_channel = n_channel
@@ -23,23 +51,48 @@ class ECGEncoder(object):
         self.reduction_ratio = reduction_ratio
         self.frame_weights = frame_weights
         self.n_parts = n_parts
+        self.input_pipeline = input_pipeline
+        self.n_towers = n_towers
+        assert architecture in ['gru', 'conv'], 'Unknown architecture ' + architecture
+        self.architecture = architecture
         if n_parts == None:
             self.create_graph()
         else:
             self.create_inference_graph()
         if do_train: self.create_optimizer_graph(self.cost)
-        os.makedirs('summary', exist_ok=True)
-        sub_d = len(os.listdir('summary'))
-        self.train_writer = tf.summary.FileWriter(logdir = 'summary/'+str(sub_d))
+        if summary_dir is None:
+            os.makedirs('summary', exist_ok=True)
+            sub_d = len(os.listdir('summary'))
+            summary_dir = 'summary/'+str(sub_d)
+        self.train_writer = tf.summary.FileWriter(logdir = summary_dir)
         self.merged = tf.summary.merge_all()
 
         config = tf.ConfigProto()
         config.gpu_options.allow_growth = True
+        intra_op_threads = n_threads
+        if inter_op_threads is None:
+            inter_op_threads = n_threads
+        profile = load_execution_profile(execution_profile) \
+            if n_threads is None else None
+        if profile is not None:
+            print('Use execution profile {}'.format(execution_profile))
+            intra_op_threads = profile['intra_op_threads']
+            inter_op_threads = profile['inter_op_threads']
+        if intra_op_threads is not None:
+            config.intra_op_parallelism_threads = intra_op_threads
+            config.inter_op_parallelism_threads = inter_op_threads
         self.sess = tf.Session(config = config)
         self.sess.run(tf.global_variables_initializer())
+        self.coord, self.queue_runners = None, []
+        if self.input_pipeline is not None:
+            self.coord = tf.train.Coordinator()
+            self.queue_runners = tf.train.start_queue_runners(self.sess,
+                                                              self.coord)
 
         self.saver = tf.train.Saver(var_list=tf.global_variables(),
                                     max_to_keep = 1000)
+        self.tracer = None
+        self.checkpoint_writer = None
         
     # --------------------------------------------------------------------------
     def __enter__(self):
@@ -48,6 +101,9 @@ class ECGEncoder(object):
 
     # --------------------------------------------------------------------------
     def __exit__(self, exc_type, exc_val, exc_tb):
+        if self.coord is not None:
+            self.coord.request_stop()
+            self.coord.join(self.queue_runners)
         tf.reset_default_graph()
         if self.sess is not None:
             self.sess.close()
@@ -63,11 +119,46 @@ class ECGEncoder(object):
         self.weight_decay,\
         self.learn_rate = self.input_graph() # inputs shape is #b*n_f x h1 x c1
 
+        if self.n_towers == 1:
+            self.Z, self.r_inputs = self.tower_graph(self.inputs,
+                self.sequence_length)
+        else:
+            tower_inputs = tf.split(self.inputs, self.n_towers, 0)
+            tower_sequence_length = tf.split(self.sequence_length, self.n_towers, 0)
+            towers = []
+            for t in range(self.n_towers):
+                with tf.variable_scope(tf.get_variable_scope(), reuse=t > 0),\
+                    tf.name_scope('tower_{}'.format(t)):
+                    towers.append(self.tower_graph(tower_inputs[t],
+                        tower_sequence_length[t]))
+            self.Z = tf.concat([Z for Z, _ in towers], 0)
+            self.r_inputs = tf.concat([r for _, r in towers], 0)
+
+        self.cost = self.create_cost_graph(original=self.inputs,
+            recovered=self.r_inputs, Z=self.Z, frame_weights=self.frame_weights)
+
+        # per-beat reconstruction error over the samples of every beat only,
+        # beat_length (unpadded, seq_l) defaults to sequence_length
+        self.beat_length = tf.placeholder_with_default(self.sequence_length,
+            shape=[None], name='beat_length') # b*n_f
+        self.beat_mse = self.beat_errors(self.inputs, self.r_inputs,
+                                         self.beat_length) # b*n_f
+
+        if self.n_towers > 1:
+            self.tower_costs = [self.frame_mse(tower_inputs[t], r)
+                + self.L2_loss + 0.001*tf.reduce_mean(tf.square(Z))
+                for t, (Z, r) in enumerate(towers)]
+        
+        print('Done!')
+
+    # --------------------------------------------------------------------------
+    def tower_graph(self, inputs, sequence_length):
+        # inputs shape is #b*n_f x h1 x c1
         # Encoder
-        convo = self.convo_graph(self.inputs) #b*n_f x h2 x c2
+        convo = self.convo_graph(inputs) #b*n_f x h2 x c2
         print('convo', convo)
 
-        seq_l = tf.cast((self.sequence_length/self.reduction_ratio), tf.int32)
+        seq_l = tf.cast((sequence_length/self.reduction_ratio), tf.int32)
         frame_embs = self.compress_frames(convo, seq_l, n_layers=2) # b*n_f x hRNN
         print('frame_embs', frame_embs)# b x n_f x hRNN
 
@@ -78,7 +169,7 @@ class ECGEncoder(object):
 
 
 
-        self.Z = tf.concat([Z_l, Z_r], axis=1) # b x 2*hRNN
+        Z = tf.concat([Z_l, Z_r], axis=1) # b x 2*hRNN
 
 
         
@@ -91,15 +182,10 @@ class ECGEncoder(object):
             seq_lengths=seq_l, n_layers=1) #b*n_f x h2 x c2
         print('r_convo', r_convo)
 
-        self.r_inputs = self.deconvo_graph(r_convo) #b*n_f x h1 x c1
-        print('r_inputs', self.r_inputs)
-
+        r_inputs = self.deconvo_graph(r_convo) #b*n_f x h1 x c1
+        print('r_inputs', r_inputs)
 
-
-        self.cost = self.create_cost_graph(original=self.inputs,
-            recovered=self.r_inputs, Z=self.Z, frame_weights=self.frame_weights)
-        
-        print('Done!')
+        return Z, r_inputs
 
     # --------------------------------------------------------------------------
     def create_inference_graph(self):
@@ -109,20 +195,20 @@ class ECGEncoder(object):
         self.sequence_length,\
         self.keep_prob,\
         self.weight_decay,\
-        self.learn_rate = self.input_graph() # inputs shape is # n_f*n_p x h1 x c1
-        self.inputs = tf.reshape(self.inputs, [self.n_frames*self.n_parts, -1, self.n_channel])
+        self.learn_rate = self.input_graph() # inputs shape is # n_beats x h1 x c1
 
-        # Encoder
-        convo = self.convo_graph(self.inputs) # n_f*n_p x h2 x c2
+        # Encoder, the number of beats of a strip is not fixed: n_parts only
+        # sets the strip size get_Z uses by default
+        convo = self.convo_graph(self.inputs) # n_beats x h2 x c2
         # print('convo', convo)
 
         seq_l = tf.cast((self.sequence_length/self.reduction_ratio), tf.int32)
-        frame_embs = self.compress_frames(convo, seq_l, n_layers=2) # n_f*n_p x hRNN
+        frame_embs = self.compress_frames(convo, seq_l, n_layers=2) # n_beats x hRNN
 
-        frame_embs = tf.reshape(frame_embs,[1, self.n_frames*self.n_parts, self.n_hidden_RNN])
-        # print('frame_embs', frame_embs)# 1 x n_p*n_f x hRNN
-        n_Z = (self.n_parts-1)*self.n_frames + 1
-        b_frame_embs = tf.concat([frame_embs[:,i:i+self.n_frames,:] for i in range(n_Z)], 0) # n_Z x n_f x hRNN
+        # all windows of n_f consecutive beats with one gather
+        n_Z = tf.shape(frame_embs)[0] - self.n_frames + 1
+        window_idx = tf.range(n_Z)[:, None] + tf.range(self.n_frames)[None, :] # n_Z x n_f
+        b_frame_embs = tf.gather(frame_embs, window_idx) # n_Z x n_f x hRNN
         # print('b_frame_embs',b_frame_embs)
         Z_l, Z_r = self.encode_to_Z(b_frame_embs) #n_Z x hRNN
         self.Z = tf.concat([Z_l, Z_r], axis=1) # n_Z x 2*hRNN
@@ -132,12 +218,23 @@ class ECGEncoder(object):
     # --------------------------------------------------------------------------
     def input_graph(self):
         print('\tinput_graph')
-        inputs = tf.placeholder(tf.float32,
-            shape=[None, None, self.n_channel],
-            name='inputs') #b*n_f x h x c (h is variable value)
+        if self.input_pipeline is None:
+            inputs = tf.placeholder(tf.float32,
+                shape=[None, None, self.n_channel],
+                name='inputs') #b*n_f x h x c (h is variable value)
+
+            sequence_length = tf.placeholder(tf.int32, shape=[None],
+                name='sequence_length') # b*n_f
+        else:
+            next_inputs, next_sequence_length = make_input_batch(
+                n_frames=self.n_frames, n_channel=self.n_channel,
+                **self.input_pipeline)
+            inputs = tf.placeholder_with_default(next_inputs,
+                shape=[None, None, self.n_channel],
+                name='inputs') #b*n_f x h x c (h is variable value)
 
-        sequence_length = tf.placeholder(tf.int32, shape=[None],
-            name='sequence_length') # b*n_f
+            sequence_length = tf.placeholder_with_default(next_sequence_length,
+                shape=[None], name='sequence_length') # b*n_f
 
         keep_prob = tf.placeholder(tf.float32, name='keep_prob')
 
@@ -154,17 +251,17 @@ class ECGEncoder(object):
     def convo_graph(self, inputs):
         print('\tconvo_graph')
         with tf.variable_scope('convo_graph'):
-            convo1 = self.conv_1d(inputs,
+            convo1 = self.conv_1d(inputs, name='conv_1d',
                 kernelShape=[2, 3, 16],
                 strides=2,
                 activation=tf.nn.elu,
                 keep_prob=self.keep_prob)
-            convo2 = self.conv_1d(convo1,
+            convo2 = self.conv_1d(convo1, name='conv_1d_1',
                 kernelShape=[2, 16, 32],
                 strides=2,
                 activation=tf.nn.elu,
                 keep_prob=self.keep_prob)
-            convo3 = self.conv_1d(convo2,
+            convo3 = self.conv_1d(convo2, name='conv_1d_2',
                 kernelShape=[2, 32, 64],
                 strides=2,
                 activation=tf.nn.elu,
@@ -173,9 +270,10 @@ class ECGEncoder(object):
 
 
     # --------------------------------------------------------------------------
-    def conv_1d(self, inputs, kernelShape, strides=1, activation = None, keep_prob = None):
+    def conv_1d(self, inputs, kernelShape, strides=1, activation = None, keep_prob = None,
+        name=None):
         print('\t\tconv_1d')
-        with tf.variable_scope(None, 'conv_1d') as sc:
+        with tf.variable_scope(name, 'conv_1d') as sc:
             # inputs to convo need [batch, in_width, in_channels]
             # kernels shape must be [filter_width, in_channels, out_channels]
             kernel = tf.get_variable('kernel', shape=kernelShape,
@@ -193,6 +291,8 @@ class ECGEncoder(object):
 
     # --------------------------------------------------------------------------
     def compress_frames(self, inputs, sequence_length, n_layers):
+        if self.architecture == 'conv':
+            return self.compress_frames_conv(inputs, sequence_length)
         print('\tcompress_frames')
         with tf.variable_scope('compress_frames'):
             # inputs b*n_f x h x c (h is variable value)
@@ -251,8 +351,9 @@ class ECGEncoder(object):
     def decode_from_Z(self, encoded_states):
         print('\tdecode_from_Z')
         Z_l, Z_r = encoded_states
-        r_frames_l = self.dRNN(Z_l, n_hidden=self.n_hidden_RNN, scope='decode_Z_l') # b x n_f//2 x hRNN
-        r_frames_r = self.dRNN(Z_r, n_hidden=self.n_hidden_RNN, scope='decode_Z_r') # b x n_f//2 x hRNN
+        decode = self.dense_decode_Z if self.architecture == 'conv' else self.dRNN
+        r_frames_l = decode(Z_l, n_hidden=self.n_hidden_RNN, scope='decode_Z_l') # b x n_f//2 x hRNN
+        r_frames_r = decode(Z_r, n_hidden=self.n_hidden_RNN, scope='decode_Z_r') # b x n_f//2 x hRNN
         r_frames_r = tf.reverse(r_frames_r, axis=[1]) # b x n_f//2 x hRNN
         r_frames = tf.concat([r_frames_l, r_frames_r], axis=1) # b x n_f x hRNN
         return r_frames       
@@ -278,6 +379,8 @@ class ECGEncoder(object):
 
     # --------------------------------------------------------------------------
     def decompress_frames(self, encoded_state, seq_lengths, n_layers):
+        if self.architecture == 'conv':
+            return self.decompress_frames_conv(encoded_state, seq_lengths)
         print('\tdecompress_frames')
         # first step is zero-vectors
 
@@ -294,19 +397,92 @@ class ECGEncoder(object):
             return recover
 
 
+    # --------------------------------------------------------------------------
+    def dilated_conv(self, inputs, filters, dilation, name):
+        # 'same' padded convolution with kernel 3 and elu, inputs b x h x c
+        with tf.variable_scope(name):
+            kernel = tf.get_variable('kernel',
+                shape=[3, inputs.shape[-1].value, filters],
+                initializer=tf.contrib.layers.xavier_initializer())
+            bias = tf.get_variable('bias', shape=[filters],
+                initializer=tf.constant_initializer(0.0))
+            convo = tf.nn.convolution(inputs, kernel, padding='SAME',
+                dilation_rate=[dilation])
+            return tf.nn.elu(tf.nn.bias_add(convo, bias))
+
+
+    # --------------------------------------------------------------------------
+    def compress_frames_conv(self, inputs, sequence_length):
+        # inputs b*n_f x h x c, every step of h is computed at once
+        print('\tcompress_frames_conv')
+        with tf.variable_scope('compress_frames_conv'):
+            convo = inputs
+            for i, d in enumerate([1, 2, 4, 8]):
+                convo = self.dilated_conv(convo, self.n_hidden_RNN, d,
+                    name='dilated_conv_{}'.format(i)) # b*n_f x h x hRNN
+
+            # mean and max over the samples of every beat
+            mask = tf.sequence_mask(sequence_length, tf.shape(convo)[1],
+                dtype=tf.float32)[:, :, None]
+            mean = tf.reduce_sum(convo*mask, 1)/tf.maximum(tf.reduce_sum(mask, 1), 1)
+            maximum = tf.reduce_max(convo + (mask - 1)*1e4, 1)
+            frame_embs = tf.layers.dense(tf.concat([mean, maximum], 1),
+                self.n_hidden_RNN, name='projection')
+            return tf.nn.dropout(frame_embs, keep_prob=self.keep_prob) # b*n_f x hRNN
+
+
+    # --------------------------------------------------------------------------
+    def dense_decode_Z(self, encoded_state, n_hidden, scope):
+        # non-autoregressive dRNN: all n_f//2 frame embeddings at once
+        print('\t\t'+scope)
+        with tf.variable_scope(scope):
+            hidden = tf.layers.dense(encoded_state, n_hidden,
+                activation=tf.nn.elu, name='hidden')
+            frames = tf.layers.dense(hidden, (self.n_frames//2)*n_hidden,
+                name='frames')
+            return tf.reshape(frames, [-1, self.n_frames//2, n_hidden])
+
+
+    # --------------------------------------------------------------------------
+    def decompress_frames_conv(self, encoded_state, seq_lengths):
+        # non-autoregressive decompress_frames: the frame embedding and the
+        # position inside the beat at every step, then dilated convolutions
+        print('\tdecompress_frames_conv')
+        n_positions = 8
+        with tf.variable_scope('decompress_frames_conv'):
+            max_len = tf.reduce_max(seq_lengths)
+            t = tf.cast(tf.range(max_len), tf.float32)[None, :]/\
+                tf.cast(tf.maximum(seq_lengths, 1), tf.float32)[:, None] # b*n_f x h
+            k = tf.range(1, n_positions + 1, dtype=tf.float32)
+            position = tf.concat([t[:, :, None],
+                tf.sin(np.pi*t[:, :, None]*k)], 2) # b*n_f x h x n_positions+1
+            state = tf.tile(encoded_state[:, None, :], tf.stack([1, max_len, 1]))
+            convo = tf.concat([state, position], 2)
+            convo.set_shape([None, None, self.n_hidden_RNN + n_positions + 1])
+            for i, d in enumerate([1, 2, 4]):
+                convo = self.dilated_conv(convo, self.n_hidden_RNN, d,
+                    name='dilated_conv_{}'.format(i))
+            # zero past the end of a beat, as the recurrent decoder outputs
+            mask = tf.sequence_mask(seq_lengths, max_len, dtype=tf.float32)
+            return convo*mask[:, :, None] # b*n_f x h x hRNN
+
+
     # --------------------------------------------------------------------------
     def deconvo_graph(self, inputs):
         # inputs [b, h, c]
         print('\tdeconvo_graph')
-        deconvo1 = self.deconv_1d(inputs=inputs, filters=32, kernel_size=2, strides=2)
-        deconvo2 = self.deconv_1d(inputs=deconvo1, filters=16, kernel_size=2, strides=2)
-        deconvo3 = self.deconv_1d(inputs=deconvo2, filters=3, kernel_size=2, strides=2)
+        deconvo1 = self.deconv_1d(inputs=inputs, filters=32, kernel_size=2, strides=2,
+            name='deconv_1d')
+        deconvo2 = self.deconv_1d(inputs=deconvo1, filters=16, kernel_size=2, strides=2,
+            name='deconv_1d_1')
+        deconvo3 = self.deconv_1d(inputs=deconvo2, filters=3, kernel_size=2, strides=2,
+            name='deconv_1d_2')
         return deconvo3
 
 
     # --------------------------------------------------------------------------
     def deconv_1d(self, inputs, filters, kernel_size, strides, activation = None,
-        keep_prob = None):
+        keep_prob = None, name=None):
         """
         Args:
             inputs: tensor of shape [batch, width, in_channels]
@@ -317,8 +493,10 @@ class ECGEncoder(object):
         """
         print('\t\tdeconv_1d')
         inputs = tf.expand_dims(inputs, 2)
-        with tf.variable_scope(None, 'deconv_1d') as sc:
+        with tf.variable_scope(name, 'deconv_1d') as sc:
+            # fixed layer name, so towers after the first reuse the variables
             convo = tf.layers.conv2d_transpose(inputs=inputs,
+                name='conv2d_transpose',
                 filters=filters,
                 kernel_size=[kernel_size,1],
                 strides=[strides, 1],
@@ -335,9 +513,7 @@ class ECGEncoder(object):
     def create_cost_graph(self, original, recovered, Z, frame_weights):
         print('\tcreate_cost_graph')
 
-        a = tf.reduce_mean(tf.square(original - recovered), [1,2]) # b*n_f
-        b = tf.reduce_mean(tf.reshape(a, [-1, self.n_frames]), 0) #n_f
-        self.mse = tf.reduce_mean(b*self.frame_weights)
+        self.mse = self.frame_mse(original, recovered)
 
         self.L2_loss = self.weight_decay*sum([tf.reduce_mean(tf.square(var))
             for var in tf.trainable_variables()])
@@ -350,16 +526,72 @@ class ECGEncoder(object):
         return self.mse + self.L2_loss + self.Z_L2_loss
 
 
+    # --------------------------------------------------------------------------
+    def frame_mse(self, original, recovered):
+        a = self.beat_errors(original, recovered) # b*n_f
+        b = tf.reduce_mean(tf.reshape(a, [-1, self.n_frames]), 0) #n_f
+        return tf.reduce_mean(b*self.frame_weights)
+
+
+    # --------------------------------------------------------------------------
+    def beat_errors(self, original, recovered, lengths=None):
+        # mean squared error of every beat (b*n_f), over the padded length
+        # or, with lengths, only over the first lengths[i] samples of beat i
+        square = tf.square(original - recovered) # b*n_f x h x c
+        if lengths is None:
+            return tf.reduce_mean(square, [1,2])
+        mask = tf.sequence_mask(lengths, tf.shape(square)[1], dtype=tf.float32)
+        n = tf.cast(tf.maximum(lengths, 1)*tf.shape(square)[2], tf.float32)
+        return tf.reduce_sum(square*mask[:, :, None], [1,2])/n
+
+
     # --------------------------------------------------------------------------
     def create_optimizer_graph(self, cost):
         print('create_optimizer_graph')
         with tf.variable_scope('optimizer_graph'):
             optimizer = tf.train.AdamOptimizer(self.learn_rate)
-            self.train = optimizer.minimize(cost)
+            if self.n_towers == 1:
+                self.train = optimizer.minimize(cost)
+            else:
+                # synchronous data parallelism: average tower gradients
+                tower_grads = [optimizer.compute_gradients(c)
+                               for c in self.tower_costs]
+                avg_grads = []
+                for grads_and_vars in zip(*tower_grads):
+                    grads = [g for g, _ in grads_and_vars if g is not None]
+                    if grads:
+                        avg_grads.append((tf.add_n(grads)/len(grads),
+                                          grads_and_vars[0][1]))
+                self.train = optimizer.apply_gradients(avg_grads)
 
         
+    #---------------------------------------------------------------------------
+    def set_tracing(self, iterations, save_dir='traces'):
+        """ Trace sess.run at the given iterations of train_, predict and
+        get_Z. Pass iterations=None to switch tracing off.
+        """
+        self.tracer = None if iterations is None \
+            else OpTracer(iterations, save_dir)
+
+    #---------------------------------------------------------------------------
+    def run(self, fetches, feed_dict, tag, iteration):
+        if self.tracer is not None and iteration in self.tracer.iterations:
+            return self.tracer.run(self.sess, fetches, feed_dict, tag, iteration)
+        return self.sess.run(fetches, feed_dict=feed_dict)
+
+    #---------------------------------------------------------------------------
+    def set_async_checkpointing(self, keep_last=5, keep_every=None, keep_best=1):
+        """ Save checkpoints from a background thread with a retention policy,
+        see ecg_encoder_checkpoint.AsyncCheckpointWriter.
+        """
+        self.checkpoint_writer = AsyncCheckpointWriter(tf.global_variables(),
+            keep_last=keep_last, keep_every=keep_every, keep_best=keep_best)
+
     #---------------------------------------------------------------------------  
     def save_model(self, path = 'beat_detector_model', step = None):
+        if self.checkpoint_writer is not None:
+            self.checkpoint_writer.save(self.sess, path, step)
+            return
         p = self.saver.save(self.sess, path, global_step = step)
         print("\tModel saved in file: %s" % p)
 
@@ -376,41 +608,111 @@ class ECGEncoder(object):
 
     #---------------------------------------------------------------------------
     def train_(self, data_loader,  keep_prob, weight_decay, learn_rate_start,
-        learn_rate_end, n_iter, save_model_every_n_iter, path_to_model):
+        learn_rate_end, n_iter, save_model_every_n_iter, path_to_model,
+        summary_every_n_iter=1, report_every_n_iter=100, timing_log_path=None,
+        validator=None):
+        """ Train the model.
+
+        data_loader may be None when the encoder was built with input_pipeline,
+        then batches come from the graph and only hyperparameters are fed.
+        It may also be a list of loaders (one shard per tower), their batches
+        are merged with utils.merge_batches.
+
+        Every iteration is split into timed stages (get_batch, feed_dict,
+        sess_run or sess_run_summary, add_summary). Each report_every_n_iter
+        iterations their rolling p50/p95 and samples per second are written
+        to train_writer and appended as JSON lines to timing_log_path
+        (summary dir by default). self.merged is evaluated only every
+        summary_every_n_iter iterations.
+
+        validator is an ecg_encoder_validation.ConcurrentValidator watching
+        path_to_model; its results feed the checkpoint retention and stop
+        training early when its patience runs out.
+
+        Returns list of (iteration, seconds since start, MSE) recorded at
+        every summary iteration.
+        """
         print('\n\n\n\t----==== Training ====----')
         #try to load model
         try:
             self.load_model(os.path.dirname(path_to_model))
         except:
             print('Can not load model {0}, starting new train'.format(path_to_model))
-            
+
+        if timing_log_path is None:
+            timing_log_path = os.path.join(self.train_writer.get_logdir(),
+                                           'timing.jsonl')
+        if validator is not None and self.checkpoint_writer is not None:
+            self.checkpoint_writer.keep_unscored = True
+        timer = StageTimer(memory_prefix='training')
+        history = []
+
         start_time = time.time()
         b = math.log(learn_rate_start/learn_rate_end, n_iter) 
         a = learn_rate_start*math.pow(1, b)
         for current_iter in tqdm(range(n_iter)):
+            timer.reset()
             learn_rate = a/math.pow((current_iter+1), b)
-            batch = data_loader.get_batch()
-            feedDict = {self.inputs : batch['normal_data'],
-                        self.sequence_length : batch['sequence_length'],
-                        self.keep_prob : keep_prob,
+            feedDict = {self.keep_prob : keep_prob,
                         self.weight_decay : weight_decay,
                         self.learn_rate : learn_rate}
-            _, summary = self.sess.run([self.train, self.merged], feed_dict=feedDict)
-            self.train_writer.add_summary(summary, current_iter)
+            if data_loader is None:
+                n_samples = self.input_pipeline['batch_size']*self.n_frames
+            else:
+                batch = utils.merge_batches([l.get_batch() for l in data_loader])\
+                    if isinstance(data_loader, list) else data_loader.get_batch()
+                timer.lap('get_batch')
+                feedDict[self.inputs] = batch['normal_data']
+                feedDict[self.sequence_length] = batch['sequence_length']
+                n_samples = len(batch['sequence_length'])
+            timer.lap('feed_dict')
+            if current_iter % summary_every_n_iter == 0:
+                _, summary, mse = self.run([self.train, self.merged, self.mse],
+                                           feedDict, 'train', current_iter)
+                timer.lap('sess_run_summary')
+                history.append((current_iter, time.time() - start_time, float(mse)))
+                self.train_writer.add_summary(summary, current_iter)
+                timer.lap('add_summary')
+            else:
+                self.run(self.train, feedDict, 'train', current_iter)
+                timer.lap('sess_run')
+            timer.end_iter(n_samples)
+
+            if (current_iter+1) % report_every_n_iter == 0:
+                report = timer.report()
+                timer.write_summary(self.train_writer, current_iter, report)
+                timer.write_log(timing_log_path, current_iter, report)
 
             if (current_iter+1) % save_model_every_n_iter == 0:
                 self.save_model(path = path_to_model, step = current_iter+1)
+                timer.lap('checkpoint')
+
+            if validator is not None:
+                validator.poll(self.checkpoint_writer)
+                if validator.should_stop():
+                    print('\nEarly stopping, best validation step {}'.format(
+                        validator.best_step))
+                    break
 
         self.save_model(path = path_to_model, step = current_iter+1)
+        if self.checkpoint_writer is not None:
+            self.checkpoint_writer.close()
+            print('Training blocked by checkpointing --- %s seconds ---'
+                % self.checkpoint_writer.blocked_time)
+        if validator is not None:
+            validator.close(self.checkpoint_writer)
         print('\nTrain finished!')
         print("Training time --- %s seconds ---" % (time.time() - start_time))
+        timer.print_report()
+        return history
 
 
     # --------------------------------------------------------------------------
     def predict(self, path_to_file, path_to_save, path_to_model, use_delta_coding):
 
         print('\n\n\n\t----==== Predicting ====----')
-        self.load_model(path_to_model)
+        if path_to_model is not None:
+            self.load_model(path_to_model)
         
         data = np.load(path_to_file).item()
 
@@ -434,7 +736,7 @@ class ECGEncoder(object):
                         self.sequence_length : batch['sequence_length'],
                         self.keep_prob : 1}
             start_time = time.time()
-            res = self.sess.run(self.r_inputs, feed_dict=feedDict) #n_f x h x c
+            res = self.run(self.r_inputs, feedDict, 'predict', current_iter) #n_f x h x c
             forward_pass_time = forward_pass_time + (time.time() - start_time)
 
             result = np.empty([0,self.n_channel])
@@ -455,23 +757,33 @@ class ECGEncoder(object):
         return list_of_res
 
     # --------------------------------------------------------------------------
-    def get_Z(self, data, path_to_save, path_to_model, use_delta_coding):
+    def get_Z(self, data, path_to_save, path_to_model, use_delta_coding,
+        n_parts=None):
         """ Return Z-code for all beat in data.
 
         Args:
             data: may be either path to *.npy file or dict with data
+            path_to_model: None to keep the current weights
+            n_parts: strip size in n_frames (self.n_parts by default). The
+                last strip is shorter, so a value larger than the record
+                encodes it with one sess.run.
         """
-        self.load_model(path_to_model)
+        n_parts = self.n_parts if n_parts is None else n_parts
+        if path_to_model is not None:
+            self.load_model(path_to_model)
 
+        memory_profiler.reset('encoding')
         data = np.load(data).item() if isinstance(data, str) else data
+        memory_profiler.lap('encoding/load')
 
         gen = utils.step_generator(data,
-                   n_frames = (self.n_parts-1)*self.n_frames+1,
+                   n_frames = (n_parts-1)*self.n_frames+1,
                    overlap = self.n_frames-1,
                    get_data = not use_delta_coding,
                    get_delta_coded_data = use_delta_coding,
                    rr = self.reduction_ratio,
-                   get_events = False)
+                   get_events = False,
+                   cover_all = True)
         
         result = np.empty([0, 2*self.n_hidden_RNN])
 
@@ -485,18 +797,24 @@ class ECGEncoder(object):
                         self.sequence_length : batch['sequence_length'],
                         self.keep_prob : 1}
             start_time = time.time()
-            res = self.sess.run(self.Z, feed_dict=feedDict) # (n_p-1)*n_f+1 x 2*hRNN
+            res = self.run(self.Z, feedDict, 'get_Z', current_iter) # (n_p-1)*n_f+1 x 2*hRNN
             forward_pass_time = forward_pass_time + (time.time() - start_time)
             result = np.concatenate((result, res), 0)
         print('result shape', result.shape)
+        memory_profiler.lap('encoding/forward')
 
-        # zero padding
+        # one Z-code per window of n_f beats, the last mark ends the last beat
         n_beats = len(data['beats'])
+        assert result.shape[0] == max(n_beats - self.n_frames, 0), \
+            'Encoded {} windows of {} beats'.format(result.shape[0], n_beats)
+
+        # zero padding
         end_pad = n_beats - self.n_frames//2 - result.shape[0]
         result = np.concatenate(
             (np.zeros([self.n_frames//2, 2*self.n_hidden_RNN]),
             result,
             np.zeros([end_pad, 2*self.n_hidden_RNN])), axis=0)
+        memory_profiler.lap('encoding/padding')
 
         if path_to_save is not None:
             np.save(path_to_save, result)
@@ -504,6 +822,62 @@ class ECGEncoder(object):
 
         return result
 
+    # --------------------------------------------------------------------------
+    def score_beats(self, data, path_to_model, use_delta_coding, batch_size=32):
+        """ Return reconstruction error (length-masked MSE) for all beat in
+        data, NaN for beats of the incomplete last window.
+
+        Windows do not overlap, so every beat is reconstructed once, in the
+        frame position it has in its window. Only the per-beat errors leave
+        the graph, reconstructions are never fetched. Needs the training
+        graph (n_parts=None).
+
+        Args:
+            data: may be either path to *.npy file or dict with data
+            batch_size: windows per sess.run
+        """
+        if path_to_model is not None:
+            self.load_model(path_to_model)
+
+        data = np.load(data).item() if isinstance(data, str) else data
+        gen = utils.step_generator(data,
+                   n_frames = self.n_frames,
+                   overlap = 0,
+                   get_data = not use_delta_coding,
+                   get_delta_coded_data = use_delta_coding,
+                   rr = self.reduction_ratio,
+                   get_events = False)
+        key = 'delta_coded_data' if use_delta_coding else 'normal_data'
+
+        scores = np.full(len(data['beats']), np.nan, np.float32)
+        n_scored = 0
+        for current_iter in it.count():
+            windows = list(it.islice(gen, batch_size))
+            if not windows:
+                break
+            batch = utils.merge_batches(windows)
+            feedDict = {self.inputs : batch[key],
+                        self.sequence_length : batch['sequence_length'],
+                        self.beat_length : np.concatenate([w['seq_l'] for w in windows]),
+                        self.keep_prob : 1}
+            res = self.run(self.beat_mse, feedDict, 'score_beats', current_iter)
+            scores[n_scored:n_scored + len(res)] = res
+            n_scored += len(res)
+        return scores
+
+    # --------------------------------------------------------------------------
+    def get_cluster_ids(self, data, cluster_model, path_to_model, use_delta_coding):
+        """ Return cluster id for all beat in data, -1 for zero-padded beats.
+
+        Args:
+            data: may be either path to *.npy file or dict with data
+            cluster_model: cluster_model.ClusterModel fitted on Z-codes
+        """
+        Z = self.get_Z(data, None, path_to_model, use_delta_coding)
+        cluster_ids = cluster_model.predict(Z)
+        cluster_ids[~np.any(Z != 0, 1)] = -1
+        return cluster_ids
+
 
 # testing #####################################################################################################################
 if __name__ == '__main__':
@@ -522,3 +896,16 @@ if __name__ == '__main__':
                     1, 0.9, 0.8, 0.7, 0.6, 0.5, 0.4, 0.3, 0.2, 0.1],
         n_parts=3, do_train=False)
 
+    # towers share the variables: as many trainable variables as with one
+    tf.reset_default_graph()
+    n_variables = []
+    for n_towers in [1, 2]:
+        with ECGEncoder(n_frames=20, n_channel=3, n_hidden_RNN=128,
+            reduction_ratio=8,
+            frame_weights=[0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1,
+                        1, 0.9, 0.8, 0.7, 0.6, 0.5, 0.4, 0.3, 0.2, 0.1],
+            n_towers=n_towers, summary_dir='summary/towers', do_train=True):
+            n_variables.append(len(tf.trainable_variables()))
+    print('trainable variables with 1 and 2 towers', n_variables)
+    assert n_variables[0] == n_variables[1]
+
@@ -0,0 +1,90 @@
+import os
+import heapq
+import argparse
+
+import numpy as np
+
+import ecg_encoder_tools as utils
+
+
+class TopKAnomalies(object):
+    """ Bounded min-heap of the k highest (score, record, beat) seen so far. """
+
+    def __init__(self, k):
+        self.k = k
+        self.heap = []
+
+    # --------------------------------------------------------------------------
+    def push_record(self, record, scores):
+        # scores: per-beat scores of one record, NaN are skipped
+        valid = np.flatnonzero(~np.isnan(scores))
+        if len(valid) > self.k: # only the record's own top k can enter
+            valid = valid[np.argpartition(scores[valid], -self.k)[-self.k:]]
+        for beat in valid:
+            item = (float(scores[beat]), record, int(beat))
+            if len(self.heap) < self.k:
+                heapq.heappush(self.heap, item)
+            elif item > self.heap[0]:
+                heapq.heapreplace(self.heap, item)
+
+    # --------------------------------------------------------------------------
+    def result(self):
+        # list of (score, record, beat), most anomalous first
+        return sorted(self.heap, reverse=True)
+
+
+def score_corpus(ecg_encoder, paths, k, use_delta_coding, path_to_save=None,
+    batch_size=32):
+    """ Score every beat of the records in paths, keep the top k.
+
+    Per-record scores are saved as <path_to_save>/<record>_scores.npy when
+    path_to_save is given, so only one record's scores are in memory.
+    """
+    top = TopKAnomalies(k)
+    for path in paths:
+        scores = ecg_encoder.score_beats(path, None, use_delta_coding, batch_size)
+        top.push_record(path, scores)
+        if path_to_save is not None:
+            np.save(os.path.join(path_to_save,
+                os.path.splitext(os.path.basename(path))[0] + '_scores.npy'), scores)
+    return top.result()
+
+
+if __name__ == '__main__':
+    from ecg_encoder_parameters import parameters as PARAM
+    from ecg_encoder import ECGEncoder
+
+    parser = argparse.ArgumentParser(
+                    formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--path_to_data', type=str, required=True)
+    parser.add_argument('--path_to_model', type=str, required=True,
+        help='checkpoint dir')
+    parser.add_argument('--k', type=int, default=100)
+    parser.add_argument('--batch_size', type=int, default=32,
+        help='windows per sess.run')
+    parser.add_argument('--save_dir', type=str, default=None,
+        help='dir for per-record scores')
+    parser.add_argument('--output', type=str, default='anomalies.tsv')
+    args = parser.parse_args()
+
+    if args.save_dir is not None:
+        os.makedirs(args.save_dir, exist_ok=True)
+    with ECGEncoder(
+        n_frames=PARAM['n_frames'],
+        n_channel=PARAM['n_channels'],
+        n_hidden_RNN=PARAM['n_hidden_RNN'],
+        reduction_ratio=PARAM['rr'],
+        frame_weights=PARAM['frame_weights'],
+        architecture=PARAM['architecture'],
+        do_train=False) as ecg_encoder:
+
+        ecg_encoder.load_model(args.path_to_model)
+        top = score_corpus(ecg_encoder,
+            utils.find_files(args.path_to_data, '*.npy'), args.k,
+            PARAM['use_delta_coding'], args.save_dir, args.batch_size)
+
+    with open(args.output, 'w') as f:
+        f.write('score\trecord\tbeat\n')
+        for score, record, beat in top:
+            f.write('{:.6f}\t{}\t{}\n'.format(score, record, beat))
+    print('Top {} anomalous beats saved in file: {}'.format(len(top), args.output))
@@ -0,0 +1,147 @@
+import os
+import json
+from multiprocessing import Pool
+
+import numpy as np
+
+import ecg_encoder_tools as utils
+from packed_labels import PackedLabels
+
+
+INDEX_FILE = 'index.json'
+
+
+def record_name(path):
+    return os.path.splitext(os.path.basename(path))[0]
+
+
+def write_compact_record(cache_dir, name, record):
+    # record: compact record (ecg_encoder_tools.compact_record)
+    p = os.path.join(cache_dir, name)
+    np.save(p + '.samples.npy', np.asarray(record['samples'], np.float16))
+    np.save(p + '.beats.npy', np.asarray(record['beats'], np.int64))
+    if 'events' in record:
+        events = record['events']
+        if not isinstance(events, PackedLabels):
+            events = PackedLabels.from_dense(events)
+        np.save(p + '.events.npy', events.bits)
+        with open(p + '.meta.json', 'w') as f:
+            json.dump({'n_labels': events.n_labels,
+                       'disease_name': [str(d) for d in record['disease_name']]}, f)
+
+
+def decode_record(args):
+    # decode one *.npy record into memory-mappable samples and beats files,
+    # events are stored bit-packed next to them with the disease names
+    path, cache_dir = args
+
+    record = utils.compact_record(np.load(path).item()) # samples: n_samples x c
+    name = record_name(path)
+    write_compact_record(cache_dir, name, record)
+    return {'path': path, 'name': name, 'n_samples': len(record['samples']),
+            'n_beats': len(record['beats'])}
+
+
+def load_cached_record(cache_dir, name):
+    """ Compact record (see ecg_encoder_tools.compact_record) with
+    memory-mapped samples, only beats and events are read into memory.
+    """
+    p = os.path.join(cache_dir, name)
+    record = {'samples': np.load(p + '.samples.npy', mmap_mode='r'),
+              'beats': np.load(p + '.beats.npy')}
+    if os.path.isfile(p + '.meta.json'):
+        with open(p + '.meta.json') as f:
+            meta = json.load(f)
+        record['events'] = PackedLabels(np.load(p + '.events.npy'),
+                                        meta['n_labels'])
+        record['disease_name'] = np.asarray(meta['disease_name'], dtype=object)
+    return record
+
+
+def build_window_cache(path_to_data, cache_dir, n_workers=None):
+    """ Decode every record of path_to_data once into cache_dir.
+
+    Each record becomes <name>.samples.npy (float16, n_samples x n_channels)
+    and <name>.beats.npy, listed in index.json. The files are independent of
+    n_frames, rr and delta coding, so trainings with different parameters
+    can share one cache through memory mapping.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    paths = utils.find_files(path_to_data, '*.npy')
+    with Pool(n_workers) as pool:
+        records = pool.map(decode_record, [(p, cache_dir) for p in paths])
+    with open(os.path.join(cache_dir, INDEX_FILE), 'w') as f:
+        json.dump(records, f, indent=1)
+    print('Cached {} records, {} beats in {}'.format(len(records),
+        sum(r['n_beats'] for r in records), cache_dir))
+    return records
+
+
+def load_cache_index(cache_dir):
+    with open(os.path.join(cache_dir, INDEX_FILE)) as f:
+        return json.load(f)
+
+
+class WindowCacheLoader:
+    """ Batch loader over a window cache built by build_window_cache.
+
+    get_batch() returns the same dict as LoadDataFileShuffling.get_batch:
+    windows of n_frames beats, every beat zero-padded to a multiple of rr,
+    drawn from random records (in proportion to their beat count) at random
+    positions. Records are memory-mapped, so processes reading the same
+    cache share its pages.
+    """
+
+    def __init__(self, cache_dir, batch_size, n_frames, rr,
+        use_delta_coding=False, seed=None):
+
+        self.batch_size = batch_size
+        self.n_frames = n_frames
+        self.rr = rr
+        self.use_delta_coding = use_delta_coding
+        self.rng = np.random.RandomState(seed)
+
+        records = [r for r in load_cache_index(cache_dir)
+                   if r['n_beats'] > n_frames + 1]
+        self.samples = [np.load(os.path.join(cache_dir, r['name'] + '.samples.npy'),
+                                mmap_mode='r') for r in records]
+        self.beats = [np.load(os.path.join(cache_dir, r['name'] + '.beats.npy'))
+                      for r in records]
+        n_beats = np.array([r['n_beats'] for r in records], np.float64)
+        self.p = n_beats/n_beats.sum()
+
+    ############################################################################
+    def get_window(self, record, start_beat):
+        # list of n_frames arrays h x c
+        beats = self.beats[record][start_beat:start_beat + self.n_frames + 1]
+        samples = self.samples[record]
+        start = beats[0]
+        if self.use_delta_coding:
+            # same as step_generator: x[i] - x[i-1], zero for the first sample
+            part = np.asarray(samples[max(start - 1, 0):beats[-1]], np.float32)
+            part = np.diff(part, axis=0) if start > 0 else \
+                np.concatenate([np.zeros_like(part[:1]), np.diff(part, axis=0)], 0)
+        else:
+            part = np.asarray(samples[start:beats[-1]])
+        return [part[b - start:e - start] for b, e in zip(beats[:-1], beats[1:])]
+
+    ############################################################################
+    def get_batch(self):
+        records = self.rng.choice(len(self.p), self.batch_size, p=self.p)
+        frames = []
+        for r in records:
+            start_beat = self.rng.randint(0, len(self.beats[r]) - self.n_frames - 1)
+            frames += self.get_window(r, start_beat)
+
+        seq_l = np.array([len(f) for f in frames], np.int32)
+        sequence_length = ((seq_l + self.rr - 1)//self.rr*self.rr).astype(np.int32)
+        data = np.zeros([len(frames), sequence_length.max(),
+                         self.samples[0].shape[1]], np.float16)
+        for i, f in enumerate(frames):
+            data[i, :len(f), :] = f
+
+        key = 'delta_coded_data' if self.use_delta_coding else 'normal_data'
+        batch = {'normal_data': None, 'delta_coded_data': None, 'events': None,
+                 'sequence_length': sequence_length, 'seq_l': seq_l}
+        batch[key] = data
+        return batch
@@ -0,0 +1,152 @@
+import os
+import glob
+import time
+import queue
+import threading
+
+import tensorflow as tf
+
+
+class AsyncCheckpointWriter(object):
+    """ Writes checkpoints in a background thread.
+
+    save() only copies the variables to host memory (one sess.run) and
+    queues them; the writer thread restores them into a private graph and
+    saves a regular checkpoint with the same variable names, so
+    ECGEncoder.load_model reads it as before.
+
+    Retention keeps the last keep_last checkpoints, every checkpoint whose
+    step is a multiple of keep_every, and the keep_best checkpoints with the
+    lowest loss passed to report_loss(). With keep_unscored, checkpoints
+    without a reported loss are kept until they are scored.
+
+    An error of the writer thread is raised again by the next save() or
+    close().
+
+    Args:
+        var_list: variables to save, usually tf.global_variables().
+        keep_unscored: True when a validator reports the losses,
+            ECGEncoder.train_ sets it when it gets a validator.
+        max_pending: snapshots allowed in the queue before save() blocks.
+    """
+
+    def __init__(self, var_list, keep_last=5, keep_every=None, keep_best=1,
+        max_pending=1, keep_unscored=False):
+
+        self.var_list = var_list
+        self.keep_last = keep_last
+        self.keep_every = keep_every
+        self.keep_best = keep_best
+        self.keep_unscored = keep_unscored
+
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            self.placeholders, variables = [], {}
+            for v in var_list:
+                ph = tf.placeholder(v.dtype.base_dtype, v.shape)
+                variables[v.op.name] = tf.Variable(ph, trainable=False)
+                self.placeholders.append(ph)
+            self.initializers = [v.initializer for v in variables.values()]
+            self.saver = tf.train.Saver(var_list=variables, max_to_keep=None)
+        self.sess = tf.Session(graph=self.graph)
+
+        self.saved = [] # list of (step, checkpoint path)
+        self.losses = {} # step -> validation loss
+        self.lock = threading.Lock()
+        self.queue = queue.Queue(maxsize=max_pending)
+        self.blocked_time = 0.
+        self.write_time = 0.
+        self.error = None
+        self.thread = threading.Thread(target=self.write_loop, daemon=True)
+        self.thread.start()
+
+    # --------------------------------------------------------------------------
+    def save(self, sess, path, step):
+        start_time = time.time()
+        self.raise_error()
+        values = sess.run(self.var_list)
+        self.queue.put((path, step, values))
+        self.blocked_time += time.time() - start_time
+
+    # --------------------------------------------------------------------------
+    def raise_error(self):
+        if self.error is not None:
+            raise RuntimeError('Checkpoint writer failed') from self.error
+
+    # --------------------------------------------------------------------------
+    def write_loop(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                self.queue.task_done()
+                break
+            path, step, values = item
+            start_time = time.time()
+            try:
+                feed_dict = dict(zip(self.placeholders, values))
+                self.sess.run(self.initializers, feed_dict=feed_dict)
+                p = self.saver.save(self.sess, path, global_step=step,
+                                    write_meta_graph=False)
+                with self.lock:
+                    self.saved = [(s, q) for s, q in self.saved if s != step]
+                    self.saved.append((step, p))
+                    self.apply_retention()
+            except Exception as e:
+                # keep draining the queue, save() and close() raise it
+                if self.error is None:
+                    self.error = e
+                self.queue.task_done()
+                continue
+            self.write_time += time.time() - start_time
+            print("\tModel saved in file: %s" % p)
+            self.queue.task_done()
+
+    # --------------------------------------------------------------------------
+    def report_loss(self, step, loss):
+        """ Validation loss of the checkpoint saved at step. """
+        with self.lock:
+            self.losses[step] = loss
+            self.apply_retention()
+
+    # --------------------------------------------------------------------------
+    def best_step(self):
+        with self.lock:
+            steps = [s for s, _ in self.saved if s in self.losses]
+            return min(steps, key=self.losses.get) if steps else None
+
+    # --------------------------------------------------------------------------
+    def apply_retention(self):
+        # called with self.lock held
+        if not self.saved:
+            return
+        steps = [s for s, _ in self.saved]
+        keep = set(steps[-self.keep_last:]) if self.keep_last else set()
+        if self.keep_every:
+            keep |= {s for s in steps if s % self.keep_every == 0}
+        if self.keep_best:
+            scored = sorted((s for s in steps if s in self.losses),
+                            key=self.losses.get)
+            keep |= set(scored[:self.keep_best])
+        if self.keep_unscored:
+            # checkpoints not validated yet may still be best
+            keep |= {s for s in steps if s not in self.losses}
+
+        for s, p in self.saved:
+            if s not in keep:
+                for f in glob.glob(p + '.*'):
+                    os.remove(f)
+        self.saved = [(s, p) for s, p in self.saved if s in keep]
+        model_dir = os.path.dirname(self.saved[-1][1]) or '.'
+        tf.train.update_checkpoint_state(model_dir,
+            model_checkpoint_path=self.saved[-1][1],
+            all_model_checkpoint_paths=[p for _, p in self.saved])
+
+    # --------------------------------------------------------------------------
+    def close(self):
+        """ Wait until all queued checkpoints are written. """
+        start_time = time.time()
+        self.queue.put(None)
+        self.thread.join()
+        self.blocked_time += time.time() - start_time
+        self.sess.close()
+        self.raise_error()
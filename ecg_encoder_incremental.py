@@ -0,0 +1,159 @@
+import os
+import json
+import hashlib
+import multiprocessing
+
+
+Z_INDEX = 'z_index.json'
+
+
+def file_hash(path, block_size=2**20):
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+def checkpoint_id(path_to_model):
+    # checkpoint name and hash of its .index file, resolved like
+    # ECGEncoder.load_model (file or latest checkpoint of a directory)
+    import tensorflow as tf
+    load_path = os.path.splitext(path_to_model)[0] \
+        if os.path.isfile(path_to_model) else tf.train.latest_checkpoint(path_to_model)
+    return '{}:{}'.format(os.path.basename(load_path),
+                          file_hash(load_path + '.index'))
+
+
+class ZIndex(object):
+    """ Keys of the Z-codes stored in path_to_save, in z_index.json.
+
+    A record's key is its content hash, the checkpoint id and the encoding
+    parameters (n_frames, rr, n_hidden_RNN, use_delta_coding). Content
+    hashes are remembered with the file's mtime and size, so unchanged
+    files are not read again.
+    """
+
+    def __init__(self, path_to_save):
+        self.path = os.path.join(path_to_save, Z_INDEX)
+        self.records = {}
+        if os.path.isfile(self.path):
+            with open(self.path) as f:
+                self.records = json.load(f)
+
+    # --------------------------------------------------------------------------
+    def content_hash(self, path):
+        entry = self.records.get(path, {})
+        stat = os.stat(path)
+        if entry.get('mtime') == stat.st_mtime and entry.get('size') == stat.st_size:
+            return entry['sha1']
+        return file_hash(path)
+
+    # --------------------------------------------------------------------------
+    def is_current(self, path, key, path_to_Z):
+        return self.records.get(path, {}).get('key') == key \
+            and os.path.isfile(path_to_Z)
+
+    # --------------------------------------------------------------------------
+    def update(self, path, key, sha1):
+        stat = os.stat(path)
+        self.records[path] = {'key': key, 'sha1': sha1,
+                              'mtime': stat.st_mtime, 'size': stat.st_size}
+
+    # --------------------------------------------------------------------------
+    def save(self):
+        with open(self.path, 'w') as f:
+            json.dump(self.records, f, indent=1)
+
+
+def z_path(path_to_save, path):
+    return os.path.join(path_to_save,
+        os.path.splitext(os.path.basename(path))[0] + '_Z.npy')
+
+
+ENCODE_WORKER = {}
+
+
+def init_encode_worker(encoder_params, summary_dir, path_to_model, n_threads):
+    # one ECGEncoder per worker process, kept for all its records
+    from ecg_encoder import ECGEncoder
+    ecg_encoder = ECGEncoder(do_train=False, n_threads=n_threads,
+        inter_op_threads=1,
+        summary_dir=os.path.join(summary_dir, 'encode_{}'.format(os.getpid())),
+        **encoder_params)
+    ecg_encoder.load_model(path_to_model)
+    ENCODE_WORKER['ecg_encoder'] = ecg_encoder
+
+
+def encode_record(args):
+    path, path_to_Z, use_delta_coding = args
+    ENCODE_WORKER['ecg_encoder'].get_Z(path, path_to_Z, None, use_delta_coding)
+    return path
+
+
+def encode_corpus(ecg_encoder, paths, path_to_save, path_to_model,
+    use_delta_coding, n_workers=1):
+    """ get_Z for the records of paths whose stored Z-codes are missing or
+    were computed from another file content, checkpoint or parameters.
+
+    With n_workers > 1 the records are encoded by that many spawned
+    processes with cpu_count//n_workers intra-op threads each (see the
+    encode_workers of autotune.py), built with the parameters of
+    ecg_encoder.
+
+    Z-codes are saved as <path_to_save>/<record>_Z.npy, as before.
+    Returns dict with the reused and recomputed record paths.
+    """
+    os.makedirs(path_to_save, exist_ok=True)
+    index = ZIndex(path_to_save)
+    params = {'checkpoint': checkpoint_id(path_to_model),
+              'n_frames': ecg_encoder.n_frames,
+              'rr': ecg_encoder.reduction_ratio,
+              'n_hidden_RNN': ecg_encoder.n_hidden_RNN,
+              'use_delta_coding': bool(use_delta_coding)}
+
+    res = {'reused': [], 'recomputed': []}
+    stale = {}
+    for path in paths:
+        sha1 = index.content_hash(path)
+        key = json.dumps(dict(params, sha1=sha1), sort_keys=True)
+        if index.is_current(path, key, z_path(path_to_save, path)):
+            res['reused'].append(path)
+            index.update(path, key, sha1) # mtime may have changed
+        else:
+            stale[path] = (key, sha1)
+
+    def done(path):
+        index.update(path, *stale[path])
+        index.save() # an interrupted run keeps what it encoded
+        res['recomputed'].append(path)
+
+    jobs = [(path, z_path(path_to_save, path), use_delta_coding)
+            for path in stale]
+    if n_workers > 1 and len(jobs) > 1:
+        encoder_params = dict(n_frames=ecg_encoder.n_frames,
+            n_channel=ecg_encoder.n_channel,
+            n_hidden_RNN=ecg_encoder.n_hidden_RNN,
+            reduction_ratio=ecg_encoder.reduction_ratio,
+            frame_weights=ecg_encoder.frame_weights,
+            architecture=ecg_encoder.architecture,
+            n_parts=ecg_encoder.n_parts)
+        n_threads = max(1, os.cpu_count()//n_workers)
+        # spawn: the parent process already owns a TF session
+        ctx = multiprocessing.get_context('spawn')
+        with ctx.Pool(n_workers, init_encode_worker, (encoder_params,
+            ecg_encoder.train_writer.get_logdir(), path_to_model,
+            n_threads)) as pool:
+            for path in pool.imap_unordered(encode_record, jobs):
+                done(path)
+    else:
+        if jobs:
+            ecg_encoder.load_model(path_to_model)
+        for path, path_to_Z, _ in jobs:
+            ecg_encoder.get_Z(path, path_to_Z, None, use_delta_coding)
+            done(path)
+    index.save()
+
+    print('Z-codes: {} records reused, {} recomputed'.format(
+        len(res['reused']), len(res['recomputed'])))
+    return res
@@ -0,0 +1,111 @@
+import os
+import glob
+import argparse
+from multiprocessing import Pool
+
+import numpy as np
+import tensorflow as tf
+
+import ecg_encoder_tools as utils
+
+
+def window_to_example(window, key):
+    # window[key] shape is [n_frames, max_len, n_channel], already padded to rr
+    data = window[key].astype(np.float16)
+    feature = {
+        'data': tf.train.Feature(bytes_list=tf.train.BytesList(
+            value=[data.tobytes()])),
+        'max_len': tf.train.Feature(int64_list=tf.train.Int64List(
+            value=[data.shape[1]])),
+        'sequence_length': tf.train.Feature(int64_list=tf.train.Int64List(
+            value=window['sequence_length'].tolist()))}
+    return tf.train.Example(features=tf.train.Features(feature=feature))
+
+
+def write_shard(args):
+    paths, path_to_shard, n_frames, rr, use_delta_coding = args
+    key = 'delta_coded_data' if use_delta_coding else 'normal_data'
+    n_windows = 0
+    with tf.python_io.TFRecordWriter(path_to_shard) as writer:
+        for path in paths:
+            data = np.load(path).item()
+            gen = utils.step_generator(data,
+                       n_frames = n_frames,
+                       overlap = 0,
+                       get_data = not use_delta_coding,
+                       get_delta_coded_data = use_delta_coding,
+                       rr = rr,
+                       get_events = False)
+            for window in gen:
+                writer.write(window_to_example(window, key).SerializeToString())
+                n_windows += 1
+    return n_windows
+
+
+def write_tfrecord_shards(path_to_data, save_dir, n_shards, n_frames, rr,
+    use_delta_coding=False, n_workers=None):
+    """ Convert a directory of *.npy records into n_shards TFRecord files of
+    beat windows (one tf.train.Example per window of n_frames beats).
+    """
+    os.makedirs(save_dir, exist_ok=True)
+    paths = utils.find_files(path_to_data, '*.npy')
+    jobs = [(paths[s::n_shards],
+             os.path.join(save_dir, 'shard_{:05d}.tfrecord'.format(s)),
+             n_frames, rr, use_delta_coding) for s in range(n_shards)]
+    with Pool(n_workers) as pool:
+        n_windows = pool.map(write_shard, jobs)
+    print('Wrote {} windows from {} files to {} shards in {}'.format(
+        sum(n_windows), len(paths), n_shards, save_dir))
+
+
+def make_input_batch(file_pattern, n_frames, n_channel, batch_size,
+    n_readers=4, shuffle_buffer=1000, n_threads=4, capacity=2):
+    """ Queue-runner pipeline over TFRecord shards written by
+    write_tfrecord_shards.
+
+    n_readers TFRecordReaders read shuffled shard files into a
+    RandomShuffleQueue of serialized windows; n_threads parse them and
+    batch_size windows are padded to the longest beat of the batch. Returns
+    tensors (inputs, sequence_length) with the same shapes as the ECGEncoder
+    placeholders: [b*n_f, h, c] and [b*n_f]. The queue runners must be
+    started with tf.train.start_queue_runners.
+    """
+    files = tf.train.string_input_producer(sorted(glob.glob(file_pattern)),
+                                           shuffle=True)
+    windows = tf.RandomShuffleQueue(capacity=shuffle_buffer,
+        min_after_dequeue=shuffle_buffer//2, dtypes=[tf.string], shapes=[[]])
+    tf.train.add_queue_runner(tf.train.QueueRunner(windows,
+        [windows.enqueue(tf.TFRecordReader().read(files)[1])
+         for i in range(n_readers)]))
+
+    features = tf.parse_single_example(windows.dequeue(), features={
+        'data': tf.FixedLenFeature([], tf.string),
+        'max_len': tf.FixedLenFeature([], tf.int64),
+        'sequence_length': tf.FixedLenFeature([n_frames], tf.int64)})
+    data = tf.cast(tf.decode_raw(features['data'], tf.float16), tf.float32)
+    data = tf.reshape(data, tf.stack([n_frames,
+        tf.cast(features['max_len'], tf.int32), n_channel]))
+    sequence_length = tf.cast(features['sequence_length'], tf.int32)
+    data.set_shape([n_frames, None, n_channel])
+
+    data, sequence_length = tf.train.batch([data, sequence_length],
+        batch_size=batch_size, num_threads=n_threads,
+        capacity=capacity*batch_size, dynamic_pad=True)
+    return (tf.reshape(data, tf.stack([-1, tf.shape(data)[2], n_channel])),
+            tf.reshape(sequence_length, [-1]))
+
+
+if __name__ == '__main__':
+    from ecg_encoder_parameters import parameters as PARAM
+
+    parser = argparse.ArgumentParser(
+                    formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--path_to_data', type=str, required=True)
+    parser.add_argument('--save_dir', type=str, required=True)
+    parser.add_argument('--n_shards', type=int, default=64)
+    parser.add_argument('--n_workers', type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    write_tfrecord_shards(args.path_to_data, args.save_dir, args.n_shards,
+        n_frames=PARAM['n_frames'], rr=PARAM['rr'],
+        use_delta_coding=PARAM['use_delta_coding'], n_workers=args.n_workers)
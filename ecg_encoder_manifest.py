@@ -0,0 +1,82 @@
+import os
+import json
+import argparse
+from multiprocessing import Pool
+
+import numpy as np
+
+import ecg_encoder_tools as utils
+
+
+MANIFEST_FILE = 'manifest.json'
+BEAT_LEN_BINS = list(range(0, 410, 10)) # samples, last bin is >= 400
+
+
+def record_stats(args):
+    # statistics of one *.npy record, path relative to path_to_data
+    path_to_data, path = args
+    full_path = os.path.join(path_to_data, path)
+    data = np.load(full_path).item()
+    beats = np.asarray(data['beats'])
+    beat_len = np.clip(np.diff(beats), 0, BEAT_LEN_BINS[-1])
+    hist, _ = np.histogram(beat_len, BEAT_LEN_BINS + [BEAT_LEN_BINS[-1] + 1])
+    return {'path': path,
+            'mtime': os.path.getmtime(full_path),
+            'size': os.path.getsize(full_path),
+            'n_samples': len(utils.get_record_channels(data)[0]),
+            'n_beats': len(beats),
+            'beat_len_hist': hist.tolist()}
+
+
+def build_manifest(path_to_data, n_workers=None):
+    """ Write (or update) path_to_data/manifest.json.
+
+    Every record is listed with its path (relative to path_to_data), mtime,
+    size, sample and beat counts and a histogram of beat lengths over
+    BEAT_LEN_BINS. Only records that are new or whose mtime or size changed
+    are read again; removed records are dropped.
+    """
+    old = {r['path']: r for r in (load_manifest(path_to_data) or {'records': []})['records']}
+    paths = sorted(os.path.relpath(p, path_to_data)
+                   for p in utils.find_files(path_to_data, '*.npy'))
+
+    def is_current(path):
+        full_path = os.path.join(path_to_data, path)
+        return path in old and old[path]['mtime'] == os.path.getmtime(full_path) \
+            and old[path]['size'] == os.path.getsize(full_path)
+
+    changed = [p for p in paths if not is_current(p)]
+    with Pool(n_workers) as pool:
+        new = {r['path']: r for r in pool.map(record_stats,
+                                              [(path_to_data, p) for p in changed])}
+    records = [new[p] if p in new else old[p] for p in paths]
+
+    manifest = {'beat_len_bins': BEAT_LEN_BINS,
+                'n_beats': sum(r['n_beats'] for r in records),
+                'n_samples': sum(r['n_samples'] for r in records),
+                'records': records}
+    with open(os.path.join(path_to_data, MANIFEST_FILE), 'w') as f:
+        json.dump(manifest, f, indent=1)
+    print('Manifest of {} records ({} read, {} removed), {} beats'.format(
+        len(records), len(changed), len(set(old) - set(paths)),
+        manifest['n_beats']))
+    return manifest
+
+
+def load_manifest(path_to_data):
+    # None if path_to_data has no manifest
+    path = os.path.join(path_to_data, MANIFEST_FILE)
+    if not os.path.isfile(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+                    formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--path_to_data', type=str, required=True)
+    parser.add_argument('--n_workers', type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    build_manifest(args.path_to_data, args.n_workers)
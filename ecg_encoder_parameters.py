@@ -4,15 +4,24 @@ parameters = {
     'n_frames':20,
     'rr':8,
     'n_hidden_RNN':256,
+    'architecture':'gru', #'gru' or 'conv' (convolutional compressor, non-autoregressive decoders)
     'keep_prob':1,
     'weight_decay':0.00001,
     'learn_rate_start':0.01,
     'learn_rate_end':0.0001,
     'use_delta_coding':False,
-    'use_chunked_data':False,
     'file_max_len':None, #175*3600*2
     'file_min_len':None, #175*3600
+    'loader_memory_budget':None, #bytes of records kept by the loader, None if no limit
+    'loader_mmap_dir':None, #read records memory-mapped from this cache dir
     'verbose':True,
+    'memory_profile':None, #path of a per-stage memory report, None to disable
+    'summary_every_n_iter':1,
+    'n_towers':1,
+    'keep_last_checkpoints':5,
+    'keep_every_n_checkpoint_steps':None,
+    'keep_best_checkpoints':1,
+    'early_stopping_patience':None,
     'frame_weights':[0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1,
                     1, 0.9, 0.8, 0.7, 0.6, 0.5, 0.4, 0.3, 0.2, 0.1]
 }
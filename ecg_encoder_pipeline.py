@@ -0,0 +1,307 @@
+""" Staged, resumable encode -> cluster -> plot pipeline.
+
+    index -> encode -> z_store -> reduction -> clustering -> stats
+                                                          -> plotting
+
+Every stage runs in its own process and passes data to the next ones
+through files in work_dir; the Z store and the reduced states are .npy
+files read memory-mapped. records.json lists the records of the manifest,
+only they are encoded and clustered. pipeline_state.json records, for every stage,
+the configuration it ran with and a signature of its inputs, so a stage
+is skipped when its outputs exist and neither changed. index and encode
+are incremental by themselves (manifest, Z index) and always run.
+Stages whose dependencies are done run concurrently.
+
+    python ecg_encoder_pipeline.py --path_to_data data/ --path_to_model models/ \
+        --work_dir pipeline --n_clusters 50
+"""
+import os
+import json
+import hashlib
+import argparse
+import contextlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+import numpy as np
+
+
+STATE_FILE = 'pipeline_state.json'
+
+
+def work_path(config, name):
+    return os.path.join(config['work_dir'], name)
+
+
+def load_z_store(config):
+    # columnar store (see clustering.create_clustering_store) over mmap files
+    from packed_labels import PackedLabels
+    with open(work_path(config, 'z_store.json')) as f:
+        meta = json.load(f)
+    path_idx = np.load(work_path(config, 'z_store.path_idx.npy'), mmap_mode='r')
+    return {'state': np.load(work_path(config, 'z_store.state.npy'), mmap_mode='r'),
+            'label': PackedLabels(np.load(work_path(config, 'z_store.label.npy'),
+                                          mmap_mode='r'), meta['n_labels']),
+            'path': np.asarray(meta['paths'], dtype=object)[path_idx],
+            'beat': np.load(work_path(config, 'z_store.beat.npy'), mmap_mode='r')}
+
+
+################################################################################
+def manifest_paths(config):
+    with open(work_path(config, 'records.json')) as f:
+        return json.load(f)
+
+
+def run_index(config):
+    from ecg_encoder_manifest import build_manifest
+    manifest = build_manifest(config['path_to_data'], config['n_workers'])
+    paths = sorted(os.path.join(config['path_to_data'], r['path'])
+                   for r in manifest['records'])
+    # rewritten only when the records change, later stages compare its hash
+    path = work_path(config, 'records.json')
+    if not os.path.isfile(path) or manifest_paths(config) != paths:
+        with open(path, 'w') as f:
+            json.dump(paths, f, indent=1)
+
+
+def run_encode(config):
+    from ecg_encoder_parameters import parameters as PARAM
+    from ecg_encoder_incremental import encode_corpus
+    from ecg_encoder_profiling import load_execution_profile
+    from ecg_encoder import ECGEncoder
+
+    n_workers = config['encode_workers']
+    if n_workers is None:
+        profile = load_execution_profile()
+        n_workers = profile['encode_workers'] if profile is not None else 1
+    with ECGEncoder(
+        n_frames=PARAM['n_frames'],
+        n_channel=PARAM['n_channels'],
+        n_hidden_RNN=PARAM['n_hidden_RNN'],
+        reduction_ratio=PARAM['rr'],
+        frame_weights=PARAM['frame_weights'],
+        architecture=PARAM['architecture'],
+        n_parts=config['n_parts'],
+        summary_dir=work_path(config, 'summary'),
+        do_train=False) as ecg_encoder:
+
+        encode_corpus(ecg_encoder, manifest_paths(config),
+                      work_path(config, 'Z'), config['path_to_model'],
+                      PARAM['use_delta_coding'], n_workers)
+
+
+def run_z_store(config):
+    # rows: beats with a Z-code (get_Z pads the ends with zeros) of the
+    # records of the manifest, not of everything encoded in Z/ before
+    from ecg.utils import tools
+    from ecg.utils.diseases import holter_diseases_with_noise as new_diseases
+    from ecg_encoder_incremental import z_path
+    from packed_labels import PackedLabels
+
+    z_dir = work_path(config, 'Z')
+    paths = manifest_paths(config)
+    states, labels, beats, path_idx = [], [], [], []
+    for i, path in enumerate(paths):
+        Z = np.load(z_path(z_dir, path))
+        beat = np.flatnonzero(np.any(Z != 0, 1))
+        data = np.load(path).item()
+        events = tools.remove_redundant_events(data['events'],
+            data['disease_name'], new_diseases)
+        states.append(Z[beat].astype(np.float32))
+        labels.append(PackedLabels.from_dense(events[beat]))
+        beats.append(beat.astype(np.int32))
+        path_idx.append(np.full(len(beat), i, np.int32))
+
+    label = PackedLabels.concatenate(labels)
+    np.save(work_path(config, 'z_store.state.npy'), np.vstack(states))
+    np.save(work_path(config, 'z_store.label.npy'), label.bits)
+    np.save(work_path(config, 'z_store.beat.npy'), np.concatenate(beats))
+    np.save(work_path(config, 'z_store.path_idx.npy'), np.concatenate(path_idx))
+    with open(work_path(config, 'z_store.json'), 'w') as f:
+        json.dump({'n_labels': label.n_labels, 'paths': paths}, f)
+    print('Z store of {} beats from {} records'.format(len(label), len(paths)))
+
+
+def run_reduction(config):
+    states = load_z_store(config)['state']
+    if config['n_components'] is None:
+        mean, components = np.zeros(0), np.zeros((0, 0))
+        reduced = states
+    else:
+        from sklearn.decomposition import PCA
+        pca = PCA(n_components=config['n_components']).fit(states)
+        mean, components = pca.mean_, pca.components_
+        reduced = pca.transform(states).astype(np.float32)
+    np.save(work_path(config, 'reduced.npy'), reduced)
+    np.savez(work_path(config, 'reduction.npz'), mean=mean,
+             components=components)
+
+
+def run_clustering(config):
+    import clustering
+    from cluster_model import ClusterModel
+
+    reduced = np.load(work_path(config, 'reduced.npy'), mmap_mode='r')
+    cluster_labels, _, model = clustering.get_cluster_labels({'state': reduced},
+        config['n_clusters'], config['use_snn'])
+    reduction = np.load(work_path(config, 'reduction.npz'))
+    has_reduction = reduction['mean'].size > 0
+    ClusterModel(model.centroids,
+        reduction['mean'] if has_reduction else None,
+        reduction['components'] if has_reduction else None,
+        model.cluster_ids).save(work_path(config, 'cluster_model.npz'))
+    np.save(work_path(config, 'cluster_labels.npy'), cluster_labels)
+
+
+def run_stats(config):
+    import clustering
+    cluster_labels = np.load(work_path(config, 'cluster_labels.npy'))
+    with open(work_path(config, 'stats.txt'), 'w') as f, \
+        contextlib.redirect_stdout(f):
+        clustering.print_clustering_stats(cluster_labels, load_z_store(config))
+
+
+def run_plotting(config):
+    import clustering
+    cluster_labels = np.load(work_path(config, 'cluster_labels.npy'))
+    clustering.plot_clusters(load_z_store(config), cluster_labels,
+                             work_path(config, 'plots'))
+    open(work_path(config, 'plots.done'), 'w').close()
+
+
+# name, function, dependencies, outputs, config keys, always run
+STAGES = [
+    ('index', run_index, [], ['records.json'], ['path_to_data'], True),
+    ('encode', run_encode, ['index'], ['Z/z_index.json'],
+        ['path_to_model', 'n_parts'], True),
+    ('z_store', run_z_store, ['index', 'encode'], ['z_store.json',
+        'z_store.state.npy', 'z_store.label.npy', 'z_store.beat.npy',
+        'z_store.path_idx.npy'], [], False),
+    ('reduction', run_reduction, ['z_store'], ['reduced.npy', 'reduction.npz'],
+        ['n_components'], False),
+    ('clustering', run_clustering, ['reduction'], ['cluster_labels.npy',
+        'cluster_model.npz'], ['n_clusters', 'use_snn'], False),
+    ('stats', run_stats, ['clustering'], ['stats.txt'], [], False),
+    ('plotting', run_plotting, ['clustering'], ['plots.done'], [], False),
+]
+
+
+################################################################################
+def run_stage(name, func, config):
+    # in the stage process, with memory_profile a report per stage:
+    # <memory_profile>_<name>.json with the laps of the stage itself
+    # (encoding/*, ...) and name, from the last of them to the end
+    from ecg_encoder_profiling import memory_profiler
+    if config.get('memory_profile') is not None:
+        memory_profiler.start()
+        memory_profiler.reset(name)
+    func(config)
+    if config.get('memory_profile') is not None:
+        memory_profiler.lap(name)
+        memory_profiler.write_report('{}_{}.json'.format(
+            os.path.splitext(config['memory_profile'])[0], name))
+
+
+def file_signature(path):
+    # content hash of small files, mtime and size of large ones
+    stat = os.stat(path)
+    if stat.st_size < 2**20:
+        with open(path, 'rb') as f:
+            return hashlib.sha1(f.read()).hexdigest()
+    return '{}:{}'.format(stat.st_mtime, stat.st_size)
+
+
+def stage_signature(config, stage):
+    name, _, deps, _, keys, _ = stage
+    outputs = {s[0]: s[3] for s in STAGES}
+    inputs = {p: file_signature(work_path(config, p))
+              for d in deps for p in outputs[d]
+              if os.path.isfile(work_path(config, p))}
+    return {'config': {k: config[k] for k in keys}, 'inputs': inputs}
+
+
+def run_pipeline(config, stages=None, force=False):
+    """ Run the stages (all by default) with their dependencies, skipping
+    the up-to-date ones. Returns dict stage -> 'done' or 'skipped'.
+    """
+    os.makedirs(config['work_dir'], exist_ok=True)
+    state_path = work_path(config, STATE_FILE)
+    state = {}
+    if os.path.isfile(state_path):
+        with open(state_path) as f:
+            state = json.load(f)
+
+    by_name = {s[0]: s for s in STAGES}
+    wanted = set()
+    def add(name):
+        wanted.add(name)
+        for d in by_name[name][2]:
+            add(d)
+    for name in stages or by_name:
+        add(name)
+
+    status = {}
+    running = {}
+    ctx = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=config['n_concurrent'],
+                             mp_context=ctx) as executor:
+        while len(status) < len(wanted):
+            for name in [s[0] for s in STAGES if s[0] in wanted]:
+                stage = by_name[name]
+                if name in status or name in running or \
+                    any(status.get(d) is None for d in stage[2]):
+                    continue
+                signature = stage_signature(config, stage)
+                up_to_date = not force and not stage[5] \
+                    and state.get(name) == signature \
+                    and all(os.path.isfile(work_path(config, p)) for p in stage[3])
+                if up_to_date:
+                    print('[{}] up to date'.format(name))
+                    status[name] = 'skipped'
+                    continue
+                print('[{}] running'.format(name))
+                running[name] = (executor.submit(run_stage, name, stage[1],
+                                                 config), signature)
+            if not running:
+                continue
+            done, _ = wait([f for f, _ in running.values()],
+                           return_when=FIRST_COMPLETED)
+            for name in [n for n, (f, _) in running.items() if f in done]:
+                future, signature = running.pop(name)
+                future.result() # raises if the stage failed
+                status[name] = 'done'
+                state[name] = signature
+                with open(state_path, 'w') as f:
+                    json.dump(state, f, indent=1)
+                print('[{}] done'.format(name))
+    return status
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+                    formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--path_to_data', type=str, required=True)
+    parser.add_argument('--path_to_model', type=str, required=True,
+        help='checkpoint dir')
+    parser.add_argument('--work_dir', type=str, default='pipeline')
+    parser.add_argument('--n_parts', type=int, default=10)
+    parser.add_argument('--n_components', type=int, default=None)
+    parser.add_argument('--n_clusters', type=int, default=50)
+    parser.add_argument('--use_snn', default=False, action='store_true')
+    parser.add_argument('--n_workers', type=int, default=os.cpu_count(),
+        help='processes for record indexing')
+    parser.add_argument('--encode_workers', type=int, default=None,
+        help='processes for encoding, encode_workers of the execution '
+             'profile (autotune.py) by default')
+    parser.add_argument('--n_concurrent', type=int, default=2,
+        help='stages running at once')
+    parser.add_argument('--stages', type=str, default=None,
+        help='comma separated stages to bring up to date, all by default')
+    parser.add_argument('--force', default=False, action='store_true')
+    parser.add_argument('--memory_profile', type=str, default=None,
+        help='path prefix of per-stage memory reports (JSON)')
+    args = parser.parse_args()
+
+    config = vars(args)
+    stages = args.stages.split(',') if args.stages else None
+    run_pipeline(config, stages, args.force)
@@ -0,0 +1,296 @@
+import os
+import sys
+import json
+import time
+import resource
+import tracemalloc
+import collections
+
+import numpy as np
+
+
+EXECUTION_PROFILE = 'execution_profile.json'
+
+
+def load_execution_profile(path=EXECUTION_PROFILE):
+    # profile saved by autotune.py, None if there is none
+    if path is None or not os.path.isfile(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+class StageTimer(object):
+    """ Low-overhead per-stage timer for the training loop.
+
+    Call reset() at the start of an iteration and lap(name) after every
+    stage; each lap stores the time since the previous one. Only the last
+    `window` durations per stage are kept for the rolling statistics.
+    With memory_prefix set, reset() and lap(name) are also passed to
+    memory_profiler as stage memory_prefix/name.
+    """
+
+    def __init__(self, window=1000, memory_prefix=None):
+        self.window = window
+        self.memory_prefix = memory_prefix
+        self.durations = collections.OrderedDict()
+        self.samples = collections.deque(maxlen=window)
+        self.iter_times = collections.deque(maxlen=window)
+        self.iter_start = self.last = time.perf_counter()
+
+    # --------------------------------------------------------------------------
+    def reset(self):
+        if self.memory_prefix is not None:
+            memory_profiler.reset(self.memory_prefix)
+        self.iter_start = self.last = time.perf_counter()
+
+    # --------------------------------------------------------------------------
+    def lap(self, name):
+        now = time.perf_counter()
+        if name not in self.durations:
+            self.durations[name] = collections.deque(maxlen=self.window)
+        self.durations[name].append(now - self.last)
+        if self.memory_prefix is not None:
+            memory_profiler.lap(self.memory_prefix + '/' + name)
+        self.last = time.perf_counter()
+
+    # --------------------------------------------------------------------------
+    def end_iter(self, n_samples):
+        self.samples.append(n_samples)
+        self.iter_times.append(time.perf_counter() - self.iter_start)
+
+    # --------------------------------------------------------------------------
+    def report(self):
+        """ Return dict with p50/p95/mean ms per stage and samples per second. """
+        res = collections.OrderedDict()
+        for name, d in self.durations.items():
+            d = np.asarray(d)*1000
+            res[name] = {'p50_ms': float(np.percentile(d, 50)),
+                         'p95_ms': float(np.percentile(d, 95)),
+                         'mean_ms': float(d.mean()),
+                         'count': len(d)}
+        total_time = sum(self.iter_times)
+        res['samples_per_sec'] = sum(self.samples)/total_time \
+            if total_time > 0 else 0.
+        res['iter_per_sec'] = len(self.iter_times)/total_time \
+            if total_time > 0 else 0.
+        return res
+
+    # --------------------------------------------------------------------------
+    def write_summary(self, writer, step, report=None):
+        import tensorflow as tf
+        report = self.report() if report is None else report
+        values = []
+        for name, stats in report.items():
+            if isinstance(stats, dict):
+                values += [tf.Summary.Value(tag='timing/{}_{}'.format(name, k),
+                    simple_value=v) for k, v in stats.items() if k != 'count']
+            else:
+                values.append(tf.Summary.Value(tag='timing/' + name,
+                    simple_value=stats))
+        writer.add_summary(tf.Summary(value=values), step)
+
+    # --------------------------------------------------------------------------
+    def write_log(self, path, step, report=None):
+        # one JSON object per line
+        report = self.report() if report is None else report
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with open(path, 'a') as f:
+            f.write(json.dumps({'step': step, 'time': time.time(),
+                                'stages': report}) + '\n')
+
+    # --------------------------------------------------------------------------
+    def print_report(self, report=None):
+        report = self.report() if report is None else report
+        print('\n{:<20}{:>10}{:>10}{:>10}'.format('stage', 'p50 ms', 'p95 ms',
+                                                  'mean ms'))
+        for name, stats in report.items():
+            if isinstance(stats, dict):
+                print('{:<20}{:>10.2f}{:>10.2f}{:>10.2f}'.format(name,
+                    stats['p50_ms'], stats['p95_ms'], stats['mean_ms']))
+        print('samples/s {:.1f}, iter/s {:.2f}'.format(
+            report['samples_per_sec'], report['iter_per_sec']))
+
+
+def rss_mb():
+    # current resident set size, the high-water mark where /proc is missing
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1])*resource.getpagesize()/2**20
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024
+
+
+class MemoryProfiler(object):
+    """ Opt-in per-stage memory report, used through the memory_profiler
+    instance of this module.
+
+    Stages are marked like in StageTimer: reset(prefix) starts a pass over
+    the stages of prefix (training, encoding, ...) and lap(name) closes
+    stage name. For every stage the report keeps the number of calls, the
+    highest tracemalloc peak and RSS seen at its end, the high-water RSS and
+    how much it grew inside the stage. For the first n_snapshots passes of
+    every prefix the allocation sites (file:line) that grew the most during
+    the stage are stored too; later passes only read counters, so the
+    training loop stays fast. Until start() all calls return at once.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.stages = collections.OrderedDict()
+
+    # --------------------------------------------------------------------------
+    def start(self, n_top=10, n_snapshots=1, n_frames=1):
+        self.enabled = True
+        self.n_top = n_top
+        self.n_snapshots = n_snapshots
+        self.n_passes = {} # prefix -> passes started
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(n_frames)
+        self.reset()
+
+    # --------------------------------------------------------------------------
+    def snapshot(self):
+        return tracemalloc.take_snapshot().filter_traces(
+            [tracemalloc.Filter(False, tracemalloc.__file__)])
+
+    # --------------------------------------------------------------------------
+    def reset(self, prefix=None):
+        if not self.enabled:
+            return
+        self.prefix = prefix
+        self.n_passes[prefix] = self.n_passes.get(prefix, 0) + 1
+        self.mark()
+
+    # --------------------------------------------------------------------------
+    def mark(self):
+        if hasattr(tracemalloc, 'reset_peak'): # python >= 3.9
+            tracemalloc.reset_peak()
+        self.last_traced = tracemalloc.get_traced_memory()[0]
+        self.last_max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024
+        self.last_snapshot = self.snapshot() \
+            if self.n_passes[self.prefix] <= self.n_snapshots else None
+
+    # --------------------------------------------------------------------------
+    def lap(self, name):
+        if not self.enabled:
+            return
+        traced, peak = tracemalloc.get_traced_memory()
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024
+        stage = self.stages.setdefault(name, {'calls': 0, 'peak_traced_mb': 0.,
+            'net_traced_mb': 0., 'rss_mb': 0., 'max_rss_mb': 0.,
+            'max_rss_growth_mb': 0., 'top_sites': {}})
+        stage['calls'] += 1
+        stage['peak_traced_mb'] = max(stage['peak_traced_mb'], peak/2**20)
+        stage['net_traced_mb'] += (traced - self.last_traced)/2**20
+        stage['rss_mb'] = max(stage['rss_mb'], rss_mb())
+        stage['max_rss_mb'] = max_rss
+        stage['max_rss_growth_mb'] += max_rss - self.last_max_rss
+        if self.last_snapshot is not None:
+            diff = self.snapshot().compare_to(self.last_snapshot, 'lineno')
+            for s in diff[:self.n_top]:
+                frame = s.traceback[0]
+                site = '{}:{}'.format(os.path.relpath(frame.filename), frame.lineno)
+                stage['top_sites'][site] = stage['top_sites'].get(site, 0.) \
+                    + s.size_diff/2**20
+        self.mark()
+
+    # --------------------------------------------------------------------------
+    def report(self):
+        # numbers rounded so that reports of two runs diff line by line
+        res = collections.OrderedDict()
+        for name, stage in self.stages.items():
+            r = {k: round(v, 1) if isinstance(v, float) else v
+                 for k, v in stage.items() if k != 'top_sites'}
+            r['top_sites'] = collections.OrderedDict(
+                (site, round(mb, 2)) for site, mb in sorted(
+                    stage['top_sites'].items(), key=lambda s: -s[1])[:self.n_top])
+            res[name] = r
+        return res
+
+    # --------------------------------------------------------------------------
+    def write_report(self, path):
+        if not self.enabled:
+            return
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump(self.report(), f, indent=1)
+        self.print_report()
+        print('Memory report saved in file: %s' % path)
+
+    # --------------------------------------------------------------------------
+    def print_report(self, file=sys.stdout):
+        print('\n{:<28}{:>7}{:>12}{:>10}{:>10}{:>12}'.format('stage', 'calls',
+            'peak MB', 'net MB', 'RSS MB', 'RSS grew'), file=file)
+        for name, r in self.report().items():
+            print('{:<28}{:>7}{:>12.1f}{:>10.1f}{:>10.1f}{:>12.1f}'.format(name,
+                r['calls'], r['peak_traced_mb'], r['net_traced_mb'],
+                r['rss_mb'], r['max_rss_growth_mb']), file=file)
+            for site, mb in r['top_sites'].items():
+                print('    {:<50}{:>10.2f} MB'.format(site, mb), file=file)
+
+
+memory_profiler = MemoryProfiler()
+
+
+class OpTracer(object):
+    """ Runs chosen sess.run calls with FULL_TRACE and saves the results.
+
+    For every traced (tag, iteration) writes a Chrome trace
+    (chrome://tracing) and a table of op time aggregated by op type and by
+    top-level scope (compress_frames, decode_Z_l, deconv_1d, ...).
+
+    Args:
+        iterations: iterable of iteration numbers to trace.
+        save_dir: directory for *.json traces and *.tsv tables.
+    """
+
+    def __init__(self, iterations, save_dir='traces'):
+        self.iterations = set(iterations)
+        self.save_dir = save_dir
+        os.makedirs(save_dir, exist_ok=True)
+
+    # --------------------------------------------------------------------------
+    def run(self, sess, fetches, feed_dict, tag, iteration):
+        import tensorflow as tf
+        from tensorflow.python.client import timeline
+
+        options = tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE)
+        run_metadata = tf.RunMetadata()
+        res = sess.run(fetches, feed_dict=feed_dict, options=options,
+                       run_metadata=run_metadata)
+
+        name = os.path.join(self.save_dir, '{}_{}'.format(tag, iteration))
+        trace = timeline.Timeline(run_metadata.step_stats)
+        with open(name + '.json', 'w') as f:
+            f.write(trace.generate_chrome_trace_format())
+        self.write_op_table(run_metadata.step_stats, name + '.tsv')
+        print('\tTrace saved in files: %s.json, %s.tsv' % (name, name))
+        return res
+
+    # --------------------------------------------------------------------------
+    @staticmethod
+    def write_op_table(step_stats, path):
+        by_type = collections.Counter()
+        by_scope = collections.Counter()
+        calls = collections.Counter()
+        for dev_stats in step_stats.dev_stats:
+            for node in dev_stats.node_stats:
+                # timeline_label looks like "node_name = OpType(inputs)"
+                label = node.timeline_label
+                op_type = label.split(' = ')[1].split('(')[0] \
+                    if ' = ' in label else node.node_name
+                micros = node.op_end_rel_micros - node.op_start_rel_micros
+                by_type[op_type] += micros
+                calls[op_type] += 1
+                by_scope[node.node_name.split('/')[0]] += micros
+
+        total = max(sum(by_type.values()), 1)
+        with open(path, 'w') as f:
+            f.write('kind\tname\tcalls\ttotal_ms\tratio\n')
+            for op_type, micros in by_type.most_common():
+                f.write('op\t{}\t{}\t{:.3f}\t{:.4f}\n'.format(op_type,
+                    calls[op_type], micros/1000, micros/total))
+            for scope, micros in by_scope.most_common():
+                f.write('scope\t{}\t\t{:.3f}\t{:.4f}\n'.format(scope,
+                    micros/1000, micros/total))
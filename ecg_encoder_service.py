@@ -0,0 +1,257 @@
+""" Local Z-encoding service.
+
+Keeps one ECGEncoder session with a restored checkpoint and answers
+HTTP requests over TCP or a Unix socket:
+
+    POST /encode  {"samples": [[c0, c1, c2], ...], "beats": [b0, b1, ...]}
+        -> {"Z": [[...], ...], "first_beat": n_frames//2}
+    GET /stats    -> latency and batch-size histograms
+
+Z[i] is the code of beat first_beat + i (as in ECGEncoder.get_Z without the
+zero padding); a request with len(beats) beat marks gets
+len(beats) - n_frames codes. The session runs the inference graph of
+ECGEncoder, strips of beats of concurrent requests are merged into one
+sess.run of at most max_batch beats, waiting at most max_wait seconds for
+more requests once the first one arrived.
+
+    python ecg_encoder_service.py --path_to_model models --unix_socket z.sock
+"""
+import os
+import json
+import time
+import asyncio
+import argparse
+import bisect
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import ecg_encoder_tools as utils
+
+
+class Histogram(object):
+    # counts of values in [edges[i-1], edges[i]), the last bucket is open
+
+    def __init__(self, edges):
+        self.edges = list(edges)
+        self.counts = [0]*(len(self.edges) + 1)
+        self.total = 0.
+        self.n = 0
+
+    def add(self, value):
+        self.counts[bisect.bisect_right(self.edges, value)] += 1
+        self.total += value
+        self.n += 1
+
+    def to_dict(self):
+        labels = ['<{}'.format(self.edges[0])] + ['{}-{}'.format(a, b)
+            for a, b in zip(self.edges[:-1], self.edges[1:])] \
+            + ['>={}'.format(self.edges[-1])]
+        return {'count': self.n, 'mean': self.total/self.n if self.n else 0.,
+                'buckets': dict(zip(labels, self.counts))}
+
+
+class ZBatcher(object):
+    """ Collects encode requests and runs them in micro-batches.
+
+    encode() returns the Z-codes of one request. The beats of a request are
+    one strip for the inference graph, which compresses every beat once and
+    gathers the windows of n_frames beats inside the graph; requests longer
+    than max_batch beats are split into strips overlapping n_frames-1 beats.
+    A single worker task merges the strips of queued requests into one
+    sess.run of at most max_batch beats, waiting up to max_wait seconds
+    after the first, and runs the session in a thread, so the event loop
+    keeps accepting requests meanwhile.
+    """
+
+    def __init__(self, ecg_encoder, use_delta_coding=False, max_batch=1024,
+        max_wait=0.005):
+        assert ecg_encoder.n_parts is not None, 'Needs the inference graph'
+        assert max_batch >= ecg_encoder.n_frames, \
+            'max_batch must be at least n_frames beats'
+        self.ecg_encoder = ecg_encoder
+        self.use_delta_coding = use_delta_coding
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.queue = asyncio.Queue()
+        self.executor = ThreadPoolExecutor(1) # the session is used by one thread
+        self.latency_ms = Histogram([1, 2, 5, 10, 20, 50, 100, 200, 500, 1000])
+        self.batch_size = Histogram([16, 32, 64, 128, 256, 512, 1024, 2048])
+        self.strips_per_batch = Histogram([1, 2, 4, 8, 16, 32, 64])
+
+    # --------------------------------------------------------------------------
+    def strips(self, samples, beats):
+        # strips of at most max_batch beats, n_beats - n_frames + 1 Z-codes each
+        record = {'samples': np.asarray(samples, np.float32),
+                  'beats': np.asarray(beats, np.int64)}
+        assert record['samples'].ndim == 2 and \
+            record['samples'].shape[1] == self.ecg_encoder.n_channel, \
+            'samples must be n_samples x {}'.format(self.ecg_encoder.n_channel)
+        overlap = self.ecg_encoder.n_frames-1
+        return list(utils.step_generator(record,
+            n_frames=self.max_batch - overlap,
+            overlap=overlap,
+            get_data=not self.use_delta_coding,
+            get_delta_coded_data=self.use_delta_coding,
+            rr=self.ecg_encoder.reduction_ratio,
+            cover_all=True))
+
+    # --------------------------------------------------------------------------
+    async def encode(self, samples, beats):
+        start_time = time.perf_counter()
+        strips = self.strips(samples, beats)
+        if not strips:
+            return np.empty([0, 2*self.ecg_encoder.n_hidden_RNN], np.float32)
+        loop = asyncio.get_event_loop()
+        futures = [loop.create_future() for strip in strips]
+        for strip, future in zip(strips, futures):
+            await self.queue.put((strip, future))
+        Z = np.concatenate(await asyncio.gather(*futures), 0)
+        self.latency_ms.add((time.perf_counter() - start_time)*1000)
+        return Z
+
+    # --------------------------------------------------------------------------
+    def run_batch(self, strips):
+        # strips are concatenated, windows across two strips are dropped
+        batch = utils.merge_batches(strips)
+        key = 'delta_coded_data' if self.use_delta_coding else 'normal_data'
+        Z = self.ecg_encoder.sess.run(self.ecg_encoder.Z, feed_dict={
+            self.ecg_encoder.inputs : batch[key],
+            self.ecg_encoder.sequence_length : batch['sequence_length'],
+            self.ecg_encoder.keep_prob : 1})
+        res, start = [], 0
+        for strip in strips:
+            n_beats = len(strip['sequence_length'])
+            res.append(Z[start:start + n_beats - self.ecg_encoder.n_frames + 1])
+            start += n_beats
+        return res
+
+    # --------------------------------------------------------------------------
+    async def worker(self):
+        loop = asyncio.get_event_loop()
+        n_beats = lambda item: len(item[0]['sequence_length'])
+        carry = None # strip that did not fit in the previous batch
+        while True:
+            items = [carry if carry is not None else await self.queue.get()]
+            carry = None
+            size = n_beats(items[0])
+            deadline = loop.time() + self.max_wait
+            while size < self.max_batch:
+                try:
+                    item = await asyncio.wait_for(self.queue.get(),
+                                                  deadline - loop.time())
+                except asyncio.TimeoutError:
+                    break
+                if size + n_beats(item) > self.max_batch:
+                    carry = item
+                    break
+                items.append(item)
+                size += n_beats(item)
+
+            self.batch_size.add(size)
+            self.strips_per_batch.add(len(items))
+            try:
+                Z = await loop.run_in_executor(self.executor, self.run_batch,
+                                               [strip for strip, _ in items])
+            except Exception as e:
+                for _, future in items:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            for (_, future), z in zip(items, Z):
+                if not future.done():
+                    future.set_result(z)
+
+    # --------------------------------------------------------------------------
+    def stats(self):
+        return {'latency_ms': self.latency_ms.to_dict(),
+                'batch_size': self.batch_size.to_dict(),
+                'strips_per_batch': self.strips_per_batch.to_dict()}
+
+
+async def handle_http(batcher, reader, writer):
+    # one request per connection
+    try:
+        method, path, _ = (await reader.readline()).decode().split(' ', 2)
+        headers = {}
+        while True:
+            line = (await reader.readline()).decode().strip()
+            if not line:
+                break
+            k, v = line.split(':', 1)
+            headers[k.strip().lower()] = v.strip()
+        body = await reader.readexactly(int(headers.get('content-length', 0)))
+
+        if method == 'POST' and path == '/encode':
+            request = json.loads(body.decode())
+            Z = await batcher.encode(request['samples'], request['beats'])
+            status, res = '200 OK', {'Z': Z.tolist(),
+                'first_beat': batcher.ecg_encoder.n_frames//2}
+        elif method == 'GET' and path == '/stats':
+            status, res = '200 OK', batcher.stats()
+        else:
+            status, res = '404 Not Found', {'error': 'unknown ' + path}
+    except (ValueError, KeyError, AssertionError) as e:
+        status, res = '400 Bad Request', {'error': str(e)}
+    except Exception as e:
+        status, res = '500 Internal Server Error', {'error': str(e)}
+
+    out = json.dumps(res).encode()
+    writer.write('HTTP/1.1 {}\r\nContent-Type: application/json\r\n'
+                 'Content-Length: {}\r\nConnection: close\r\n\r\n'.format(
+                     status, len(out)).encode() + out)
+    await writer.drain()
+    writer.close()
+
+
+async def serve(batcher, host=None, port=None, unix_socket=None):
+    handler = lambda r, w: handle_http(batcher, r, w)
+    if unix_socket is not None:
+        if os.path.exists(unix_socket):
+            os.remove(unix_socket)
+        server = await asyncio.start_unix_server(handler, unix_socket)
+        print('Serving Z-codes on unix socket %s' % unix_socket)
+    else:
+        server = await asyncio.start_server(handler, host, port)
+        print('Serving Z-codes on http://%s:%d' % (host, port))
+    worker = asyncio.ensure_future(batcher.worker())
+    async with server:
+        await server.serve_forever()
+    worker.cancel()
+
+
+if __name__ == '__main__':
+    from ecg_encoder_parameters import parameters as PARAM
+    from ecg_encoder import ECGEncoder
+
+    parser = argparse.ArgumentParser(
+                    formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--path_to_model', type=str, required=True,
+        help='checkpoint dir')
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--unix_socket', type=str, default=None,
+        help='serve on this socket instead of host:port')
+    parser.add_argument('--max_batch', type=int, default=1024,
+        help='beats per sess.run')
+    parser.add_argument('--max_wait_ms', type=float, default=5.)
+    parser.add_argument('--n_threads', type=int, default=None)
+    args = parser.parse_args()
+
+    with ECGEncoder(
+        n_frames=PARAM['n_frames'],
+        n_channel=PARAM['n_channels'],
+        n_hidden_RNN=PARAM['n_hidden_RNN'],
+        reduction_ratio=PARAM['rr'],
+        frame_weights=PARAM['frame_weights'],
+        architecture=PARAM['architecture'],
+        n_parts=1, # inference graph, the strips come from the requests
+        n_threads=args.n_threads,
+        do_train=False) as ecg_encoder:
+
+        ecg_encoder.load_model(args.path_to_model)
+        loop = asyncio.get_event_loop()
+        batcher = ZBatcher(ecg_encoder, PARAM['use_delta_coding'],
+                           args.max_batch, args.max_wait_ms/1000)
+        loop.run_until_complete(serve(batcher, args.host, args.port,
+                                      args.unix_socket))
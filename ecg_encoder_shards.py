@@ -0,0 +1,99 @@
+import os
+import json
+import argparse
+from multiprocessing import Pool
+
+import numpy as np
+
+import ecg_encoder_tools as utils
+import ecg_encoder_cache as cache
+
+
+SHARD_MANIFEST = 'shards.json'
+
+
+def beat_shard(record, first_beat, last_beat):
+    # compact record of beats [first_beat, last_beat), beginning at the first
+    # beat and ending at the next beat (or the end of the record)
+    beats = record['beats']
+    start = beats[first_beat]
+    end = beats[last_beat] if last_beat < len(beats) else len(record['samples'])
+    shard = dict(record)
+    shard['samples'] = record['samples'][start:end]
+    shard['beats'] = beats[first_beat:last_beat] - start
+    if 'events' in record:
+        shard['events'] = record['events'][first_beat:last_beat]
+    return shard
+
+
+def shard_record(args):
+    # split one *.npy record into shards of shard_beats beats, consecutive
+    # shards share overlap_beats beats so that windows over a cut are kept
+    path, save_dir, shard_beats, overlap_beats = args
+
+    record = utils.compact_record(np.load(path).item())
+    n_beats = len(record['beats'])
+    name = cache.record_name(path)
+    shards = []
+    if n_beats == 0:
+        return shards
+    for i, first_beat in enumerate(range(0, max(n_beats - overlap_beats, 1),
+                                         shard_beats)):
+        last_beat = min(first_beat + shard_beats + overlap_beats, n_beats)
+        shard = beat_shard(record, first_beat, last_beat)
+        shard_name = '{}.{:04d}'.format(name, i)
+        cache.write_compact_record(save_dir, shard_name, shard)
+        shards.append({'name': shard_name, 'path': path,
+                       'first_beat': first_beat,
+                       'n_beats': len(shard['beats']),
+                       'n_samples': len(shard['samples'])})
+    return shards
+
+
+def write_shards(path_to_data, save_dir, shard_beats=2000, overlap_beats=20,
+    n_workers=None):
+    """ Split every record of path_to_data into beat-aligned shards.
+
+    Each shard is a record in the ecg_encoder_cache format (samples,
+    beats, bit-packed events), so the loader reads it memory-mapped instead
+    of unpickling a whole file. shards.json lists the shards with their
+    source record, first beat, beat and sample counts.
+    """
+    os.makedirs(save_dir, exist_ok=True)
+    paths = utils.find_files(path_to_data, '*.npy')
+    with Pool(n_workers) as pool:
+        shards = sum(pool.map(shard_record,
+            [(p, save_dir, shard_beats, overlap_beats) for p in paths]), [])
+    manifest = {'shard_beats': shard_beats, 'overlap_beats': overlap_beats,
+                'n_beats': sum(s['n_beats'] for s in shards),
+                'n_samples': sum(s['n_samples'] for s in shards),
+                'shards': shards}
+    with open(os.path.join(save_dir, SHARD_MANIFEST), 'w') as f:
+        json.dump(manifest, f, indent=1)
+    print('Wrote {} shards of {} records, {} beats in {}'.format(len(shards),
+        len(paths), manifest['n_beats'], save_dir))
+    return manifest
+
+
+def load_shard_manifest(save_dir):
+    # None if save_dir has no shards
+    path = os.path.join(save_dir, SHARD_MANIFEST)
+    if not os.path.isfile(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+                    formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--path_to_data', type=str, required=True)
+    parser.add_argument('--save_dir', type=str, required=True)
+    parser.add_argument('--shard_beats', type=int, default=2000)
+    parser.add_argument('--overlap_beats', type=int, default=20,
+        help='beats repeated at the start of the next shard, >= n_frames')
+    parser.add_argument('--n_workers', type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    write_shards(args.path_to_data, args.save_dir, args.shard_beats,
+                 args.overlap_beats, args.n_workers)
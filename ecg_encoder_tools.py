@@ -1,21 +1,19 @@
 import os, fnmatch
 import time
 from random import shuffle
-import functools
 import itertools
 
 import numpy as np
-import pandas as pd
-from tensorflow.python.framework import ops
-import tensorflow as tf
-import matplotlib
-import matplotlib.pyplot as plt
-import tqdm as tqdm
-from sklearn.metrics import confusion_matrix
-import ecg
 
+from packed_labels import PackedLabels
+
+# The data path (loader, step_generator) needs only NumPy. TensorFlow,
+# pandas, matplotlib, sklearn and ecg are imported inside the functions
+# that use them, so loader and encoding workers start fast.
 
 def simple_decoder_fn_train_(encoder_state, name=None):
+    import tensorflow as tf
+    from tensorflow.python.framework import ops
 
     with ops.name_scope(name, "simple_decoder_fn_train", [encoder_state]):
         pass
@@ -66,17 +64,50 @@ class LoadDataFileShuffling:
                  gen_params,
                  file_max_len, #two hours None if no limit
                  file_min_len, #one hour None if no limit
-                 verbose = False):
+                 verbose = False,
+                 shard = None, #(shard_index, n_shards) to use a part of files
+                 memory_budget = None, #bytes of resident records, None if no limit
+                 mmap_dir = None): #window cache dir, read records memory-mapped
+        """
+        Every one of batch_size slots reads windows from a record. With
+        memory_budget set, records are kept compact (compact_record) and once
+        the resident records reach the budget, a slot that needs a new record
+        shares an already resident one starting at a random window. With
+        mmap_dir set, records are read from the ecg_encoder_cache format
+        (decoded there on first use), so only the pages of the windows that
+        are actually read become resident.
+
+        If path_to_data has a manifest (ecg_encoder_manifest) or shards
+        (ecg_encoder_shards), the records are taken from it without walking
+        the directory. A slot reads all windows of its record, so whole
+        records are drawn once per epoch, which gives every beat the same
+        weight. Records cropped to file_min_len..file_max_len samples are
+        drawn in proportion to their beat count instead; an epoch is then
+        as many beats as the manifest lists.
+        """
 
         self.batch_size = batch_size
         self.path_to_data = path_to_data      
         self.verbose = verbose
         self.gen_params = gen_params
-        self.current_list_of_data = []
-        self.paths_to_data = find_files(path = path_to_data, file_type = '*.npy')
+        self.shard = shard
+        # directory written by ecg_encoder_shards: records are its shards
+        from ecg_encoder_shards import load_shard_manifest
+        from ecg_encoder_manifest import load_manifest
+        self.shard_manifest = load_shard_manifest(path_to_data)
+        self.manifest = load_manifest(path_to_data) \
+            if self.shard_manifest is None else None
+        self.n_beats = self.find_beat_counts()
+        if self.n_beats is not None:
+            self.record_paths = list(self.n_beats)
+            self.p = np.array([self.n_beats[p] for p in self.record_paths],
+                              np.float64)
+            self.total_beats = self.p.sum()
+            self.p = self.p/self.total_beats
+            self.epoch_beats = 0
+        self.paths_to_data = self.find_paths()
         shuffle(self.paths_to_data)
         print(self.paths_to_data[0])
-        self.use_chunked_data = np.load(self.paths_to_data[0]).size > 1
 
         self.file_max_len = file_max_len #two hours None if no limit
         self.file_min_len = file_min_len #one hour None if no limit
@@ -86,51 +117,149 @@ class LoadDataFileShuffling:
         self.n_epoch = 0
         self.n_batches = 0
 
+        self.memory_budget = memory_budget
+        self.mmap_dir = mmap_dir
+        self.resident = {} # record id -> dict(record, n_slots, nbytes)
+        self.slot_records = [None]*batch_size
+        self.n_loaded_records = 0
+
         if verbose == True:
             print('Find ' + str(len(self.paths_to_data)) + ' files.')
         
-        self.generators = [self.get_gen() for b in range(batch_size)]            
+        self.generators = [self.get_gen(b) for b in range(batch_size)]            
             
     ############################################################################
-    def get_gen(self):
+    def find_paths(self):
+        if self.n_beats is not None:
+            return list(self.n_beats)
+        paths = find_files(path = self.path_to_data, file_type = '*.npy')
+        if self.shard is not None:
+            paths = paths[self.shard[0]::self.shard[1]]
+        return paths
+
+    ############################################################################
+    def find_beat_counts(self):
+        # path (shard name) -> number of beats, None without a manifest
+        if self.shard_manifest is not None:
+            records = [(s['name'], s['n_beats'])
+                       for s in self.shard_manifest['shards']]
+        elif self.manifest is not None:
+            records = [(os.path.join(self.path_to_data, r['path']), r['n_beats'])
+                       for r in self.manifest['records']]
+        else:
+            return None
+        if self.shard is not None:
+            records = records[self.shard[0]::self.shard[1]]
+        return dict(r for r in records if r[1] > 0)
+
+    ############################################################################
+    def memory_footprint(self):
+        # mapped records are counted with their full size, an upper bound
+        return {'resident_records': len(self.resident),
+                'bytes': sum(r['nbytes'] for r in self.resident.values()),
+                'budget': self.memory_budget}
+
+    ############################################################################
+    def release(self, slot):
+        record_id = self.slot_records[slot]
+        if record_id is None:
+            return
+        self.slot_records[slot] = None
+        self.resident[record_id]['n_slots'] -= 1
+        if self.resident[record_id]['n_slots'] == 0:
+            del self.resident[record_id]
+
+    ############################################################################
+    def needs_sharing(self):
+        # True if loading one more record (of average size) exceeds the budget
+        if self.memory_budget is None or not self.resident:
+            return False
+        footprint = self.memory_footprint()['bytes']
+        return footprint + footprint/len(self.resident) > self.memory_budget
+
+    ############################################################################
+    def load_record(self, path):
+        if self.shard_manifest is not None:
+            import ecg_encoder_cache as cache
+            return cache.load_cached_record(self.path_to_data, path)
+        if self.mmap_dir is not None:
+            import ecg_encoder_cache as cache
+            name = cache.record_name(path)
+            if not os.path.isfile(os.path.join(self.mmap_dir, name + '.samples.npy')):
+                os.makedirs(self.mmap_dir, exist_ok=True)
+                cache.decode_record((path, self.mmap_dir))
+            return cache.load_cached_record(self.mmap_dir, name)
+        return np.load(path).item()
+
+    ############################################################################
+    def get_gen(self, slot=None):
+        if slot is not None:
+            self.release(slot)
+
+        if self.needs_sharing():
+            record_id = np.random.choice(list(self.resident))
+            data = self.resident[record_id]['record']
+            n_windows = (len(data['beats']) - self.gen_params['overlap'])\
+                // self.gen_params['n_frames'] - 1
+            gen = step_generator(data, first_batch=np.random.randint(max(n_windows, 1)),
+                **self.gen_params)
+        else:
+            data = self.load_data()
+            record_id = self.n_loaded_records
+            self.n_loaded_records += 1
+            nbytes = record_nbytes(data) if 'samples' in data else \
+                sum(c.nbytes for c in get_record_channels(data))
+            self.resident[record_id] = {'record': data, 'n_slots': 0,
+                                        'nbytes': nbytes}
+            gen = step_generator(data, **self.gen_params)
+
+        if slot is not None:
+            self.resident[record_id]['n_slots'] += 1
+            self.slot_records[slot] = record_id
+        return gen
+
+    ############################################################################
+    def next_path(self):
+        # a crop has about the same number of beats whatever the record, so
+        # cropped records are drawn by beat count; whole records are not
+        crops = (self.file_max_len is not None) and (self.file_min_len is not None)
+        if self.n_beats is not None and crops:
+            path = self.record_paths[np.random.choice(len(self.p), p=self.p)]
+            self.epoch_beats += self.n_beats[path]
+            if self.epoch_beats >= self.total_beats:
+                print('Epoch was finished')
+                self.n_epoch += 1
+                self.epoch_beats = 0
+            return path
+
         if not(self.paths_to_data):
             print('Epoch was finished')
             self.n_epoch += 1
-            self.paths_to_data = find_files(path = self.path_to_data,
-                file_type = '*.npy')
+            self.paths_to_data = self.find_paths()
             shuffle(self.paths_to_data)
+        return self.paths_to_data.pop()
 
-        if self.use_chunked_data:
-            if len(self.current_list_of_data) == 0:
-                self.current_list_of_data = np.load(self.paths_to_data[0])
-                shuffle(self.current_list_of_data)
-                n_ch = np.random.randint(10,20)
-                if len(self.current_list_of_data) >= n_ch:
-                    self.current_list_of_data = self.current_list_of_data[:n_ch]
-                self.paths_to_data.remove(self.paths_to_data[0])
-            data = self.current_list_of_data[-1]
-            self.current_list_of_data = self.current_list_of_data[:-1]
-        else:
-            data = np.load(self.paths_to_data.pop()).item()
+    ############################################################################
+    def load_data(self):
+        data = self.load_record(self.next_path())
+
+        if self.gen_params.get('get_events') and \
+            not isinstance(data['events'], PackedLabels):
+            data['events'] = PackedLabels.from_dense(data['events'])
 
         if (self.file_max_len is not None) and (self.file_min_len is not None):
-            channels = ecg.utils.get_channels(data)
             file_len = np.random.randint(self.file_min_len, self.file_max_len + 1)
-            if len(channels[0]) <= (file_len + 1):
+            n_samples = record_len(data)
+            if n_samples <= (file_len + 1):
                 print('Warning! Len of file too small!')
             else:
-                file_start = np.random.randint(0, len(channels[0]) - file_len - 1)
-                beats_arr = np.zeros_like(channels[0])
-                beats_arr[data['beats']] = 1
-                beats_arr = beats_arr[file_start : file_start + file_len]
-                data['beats'] = np.nonzero(beats_arr)[0]
-                channels = [channel[file_start : file_start + file_len]\
-                    for channel in channels]
-                data = ecg.utils.write_channels(data, channels)
-        
-        gen = step_generator(data, **self.gen_params)
+                file_start = np.random.randint(0, n_samples - file_len - 1)
+                data = crop_record(data, file_start, file_len)
 
-        return gen
+        if self.memory_budget is not None and 'samples' not in data:
+            data = compact_record(data)
+
+        return data
     
     ############################################################################
     def get_batch(self):
@@ -144,7 +273,7 @@ class LoadDataFileShuffling:
                     break
   
                 except StopIteration:
-                    generator = self.get_gen()
+                    generator = self.get_gen(g)
                     self.generators[g] = generator
                     n_attempts += 1
 
@@ -158,7 +287,8 @@ class LoadDataFileShuffling:
     ############################################################################
     def batch_preprocessing(self, batch):
         # batch is a list of entities that were returned from generator.
-        # return events shape is [b*(n_frames+overlap), len(PARAM['required_diseases'])]
+        # return events is PackedLabels of shape
+        #   [b*(n_frames+overlap), len(PARAM['required_diseases'])]
         # return normal_data shape is [b*(n_frames+overlap), x, n_channel]
         # return sequence_length shape is [b*(n_frames+overlap)]
         p_batch = {}
@@ -198,14 +328,14 @@ class LoadDataFileShuffling:
             p_batch['delta_coded_data'] = None
 
 
-        p_batch['events'] = np.concatenate(
-            [d['events'] for d in batch], 0) \
+        p_batch['events'] = PackedLabels.concatenate(
+            [d['events'] for d in batch]) \
         if self.gen_params['get_events'] else None
         
         
         if self.gen_params['get_events']:
             mask = np.in1d(batch[0]['disease_name'], PARAM['required_diseases'])
-            p_batch['events'] = p_batch['events'][:, mask]
+            p_batch['events'] = p_batch['events'].select_labels(mask)
             #a = ~np.in1d(PARAM['required_diseases'], batch['disease_name'][mask])
             #print(np.array(PARAM['required_diseases'])[a])
             assert len(PARAM['required_diseases']) == mask.sum(), \
@@ -213,6 +343,25 @@ class LoadDataFileShuffling:
         
         return p_batch
 
+################################################################################
+def merge_batches(batches):
+    # concatenate batches of several loaders (e.g. one loader shard per tower),
+    # zero-padding data to the longest beat of all of them
+    merged = {}
+    for key in ['normal_data', 'delta_coded_data']:
+        if batches[0][key] is None:
+            merged[key] = None
+            continue
+        max_len = max(b[key].shape[1] for b in batches)
+        merged[key] = np.concatenate([np.pad(b[key],
+            ((0, 0), (0, max_len - b[key].shape[1]), (0, 0)), 'constant')
+            for b in batches], 0)
+    merged['sequence_length'] = np.concatenate(
+        [b['sequence_length'] for b in batches], 0)
+    merged['events'] = None if batches[0]['events'] is None else \
+        PackedLabels.concatenate([b['events'] for b in batches])
+    return merged
+
 ################################################################################
 def find_files(path, file_type):
     #find all files of type file_type in directory and subdirectory path
@@ -227,9 +376,66 @@ def find_files(path, file_type):
 
 ################################################################################
 def XavierRandomMatrixInitializer(in_dim, out_dim, constant=1):
+	import tensorflow as tf
 	w = constant * np.sqrt(6.0 / (in_dim + out_dim))
 	return tf.random_uniform_initializer(minval=-w, maxval=w, dtype=tf.float32)
 
+################################################################################
+def get_record_channels(data):
+    # list of 1-d channel arrays of a record dict or of a compact record
+    if 'samples' in data:
+        return [data['samples'][:, c] for c in range(data['samples'].shape[1])]
+    import ecg
+    return ecg.utils.get_channels(data)
+
+################################################################################
+def compact_record(data):
+    """ Keep only what step_generator needs: samples (float16, n x c),
+    beats, events and disease_name. The rest of the record dict is dropped.
+    """
+    record = {'samples': np.stack(get_record_channels(data), 1).astype(np.float16),
+              'beats': np.asarray(data['beats'])}
+    for key in ['events', 'disease_name']:
+        if key in data:
+            record[key] = data[key]
+    return record
+
+################################################################################
+def record_len(record):
+    # number of samples of a record dict or a compact record
+    if 'samples' in record:
+        return len(record['samples'])
+    return len(get_record_channels(record)[0])
+
+################################################################################
+def crop_record(record, file_start, file_len):
+    """ Samples [file_start, file_start + file_len) of a record with its beats
+    (found by searchsorted) and events. Memory-mapped samples are only sliced,
+    so reading the crop touches only its pages; channels held in memory are
+    copied so that the full record can be freed.
+    """
+    b = np.searchsorted(record['beats'], [file_start, file_start + file_len])
+    cropped = dict(record)
+    if 'samples' in record:
+        cropped['samples'] = record['samples'][file_start : file_start + file_len]
+    else:
+        import ecg
+        channels = [np.array(c[file_start : file_start + file_len])
+                    for c in get_record_channels(record)]
+        cropped = ecg.utils.write_channels(cropped, channels)
+    cropped['beats'] = np.asarray(record['beats'][b[0]:b[1]]) - file_start
+    if 'events' in record:
+        cropped['events'] = record['events'][b[0]:b[1]]
+    return cropped
+
+################################################################################
+def record_nbytes(record):
+    # bytes of a compact record, for memory-mapped samples the mapped size
+    events = record.get('events')
+    events_nbytes = events.bits.nbytes if isinstance(events, PackedLabels) \
+        else getattr(events, 'nbytes', 0)
+    return record['samples'].nbytes + record['beats'].nbytes + events_nbytes
+
 ################################################################################
 #@profile
 def step_generator(data,
@@ -239,12 +445,20 @@ def step_generator(data,
                    get_delta_coded_data = False,
                    get_events = False,
                    convert_to_channels = None,
-                   rr = 1):
-    """ rr is reduction ratio """
+                   rr = 1,
+                   first_batch = 0,
+                   cover_all = False):
+    """ rr is reduction ratio
+    data is a record dict or a compact record (see compact_record).
+    first_batch skips windows, to start in the middle of a record.
+    cover_all adds windows up to the last beat, the last one may be shorter
+    (it has at least overlap+1 beats).
+    """
     
     #---------------------------------------------------------------------------
-    def format_data(channels, start_beat, end_beat):
-        # padded data shape [n_frames+overlap, max_len, len(channels)]
+    def format_data(channels, start_beat, end_beat, delta=False):
+        # padded data shape [end_beat-start_beat, max_len, len(channels)],
+        # n_frames+overlap except for the last window of cover_all
         # sequence_length: ndarray of shape [n_frames+overlap]. Len of padded data
         # seq_l: ndarray of shape [n_frames+overlap]. Len of original
         #   data (not padded)
@@ -252,8 +466,18 @@ def step_generator(data,
         channels_part_list = []
         for b in range(start_beat, end_beat):
             bea = data['beats'][b:b+2]
-            channels_part = np.concatenate([channel[bea[0]:bea[1]][:,None]\
-                for channel in channels], 1) #h x c (where h is variable value)
+            if delta:
+                # delta coding per beat, x[i] - x[i-1] and 0 for the first
+                # sample of the record, without a coded copy of the record
+                lo = max(bea[0] - 1, 0)
+                channels_part = np.concatenate([channel[lo:bea[1]][:,None]\
+                    for channel in channels], 1).astype(np.float32)
+                channels_part = np.diff(channels_part, axis=0) if bea[0] > 0 else\
+                    np.concatenate([np.zeros_like(channels_part[:1]),
+                                    np.diff(channels_part, axis=0)], 0)
+            else:
+                channels_part = np.concatenate([channel[bea[0]:bea[1]][:,None]\
+                    for channel in channels], 1) #h x c (where h is variable value)
             
             seq_l = np.append(seq_l, channels_part.shape[0])
 
@@ -266,7 +490,7 @@ def step_generator(data,
 
             sequence_length = np.append(sequence_length, channels_part.shape[0])
         max_len = sequence_length.max()
-        padded_data = np.zeros([n_frames+overlap, max_len, len(channels)], np.float16)
+        padded_data = np.zeros([end_beat-start_beat, max_len, len(channels)], np.float16)
         for i, channel_part in enumerate(channels_part_list):
             padded_data[i, 0:channel_part.shape[0], :] = channel_part
 
@@ -274,22 +498,23 @@ def step_generator(data,
     #---------------------------------------------------------------------------
 
     # channels converting
-    channels = ecg.utils.get_channels(data)
+    channels = get_record_channels(data)
     # if convert_to_channels is not None:
         # channels =  .convert_channels_from_easi(channels, convert_to_channels)
     
-    n_batches = (data['beats'].shape[0] - overlap) // n_frames - 1
-
-    if get_delta_coded_data:
-        channels_coded = [np.hstack([[0], np.ediff1d(channel)]).astype(np.float16)\
-            for channel in channels]
+    # beat b ends at the mark b+1, so the last mark ends the last beat
+    n_beats = data['beats'].shape[0] - 1
+    if cover_all:
+        n_batches = -(-(n_beats - overlap) // n_frames)
+    else:
+        n_batches = (n_beats + 1 - overlap) // n_frames - 1
 
-    for current_batch in range(n_batches):
+    for current_batch in range(first_batch, n_batches):
         yield_res = {'normal_data':None, 'delta_coded_data':None, 'events':None,
-            'disease_name':data['disease_name'], 'sequence_length':None}
+            'disease_name':data.get('disease_name'), 'sequence_length':None}
 
         start_beat = current_batch*(n_frames)
-        end_beat = start_beat + n_frames + overlap
+        end_beat = min(start_beat + n_frames + overlap, n_beats)
         
         if get_data:
             yield_res['normal_data'], yield_res['sequence_length'],\
@@ -297,7 +522,8 @@ def step_generator(data,
 
         if get_delta_coded_data:
             yield_res['delta_coded_data'], yield_res['sequence_length'],\
-            yield_res['seq_l'] = format_data(channels_coded, start_beat, end_beat)
+            yield_res['seq_l'] = format_data(channels, start_beat, end_beat,
+                                             delta=True)
 
         if get_events:
             yield_res['events'] = data['events'][start_beat:end_beat,:]
@@ -334,7 +560,68 @@ def metrics(matrix):
 	return np.array([tp, tn, fp, fn, num_events, accuracy, precision, recall, fscore])
 
 #-----------------------------------------------------------------------
-def save_log(path, file_name, diseases, lbs, pred, cost, threshold):
+METRIC_NAMES = ['tp', 'tn', 'fp', 'fn', 'num_events', 'accuracy', 'precision',
+				'recall', 'fscore', 'cost']
+
+#-----------------------------------------------------------------------
+def confusion_counts(lbs, pred, threshold):
+
+	"""Confusion counts of all labels at once.
+
+	Args:
+
+		lbs: true labels, n_beats x n_labels (0/1 or PackedLabels).
+		pred: predicted labels, n_beats x n_labels.
+		threshold: threshold for sigmoidal prediction.
+
+	Returns: int64 array n_labels x 4 with columns tp, tn, fp, fn.
+	"""
+	lbs = lbs.to_dense() if isinstance(lbs, PackedLabels) else np.asarray(lbs)
+	lbs = lbs.astype(bool)
+	pred = np.asarray(pred) > threshold
+	tp = np.count_nonzero(lbs & pred, 0)
+	fp = np.count_nonzero(~lbs & pred, 0)
+	fn = np.count_nonzero(lbs & ~pred, 0)
+	tn = len(lbs) - tp - fp - fn
+	return np.stack([tp, tn, fp, fn], 1).astype(np.int64)
+
+#-----------------------------------------------------------------------
+def metrics_from_counts(counts):
+
+	"""Vectorized metrics(): counts is n_labels x 4 (tp, tn, fp, fn).
+
+	Returns: array n_labels x 9 with the columns of metrics().
+	"""
+	tp, tn, fp, fn = [counts[:, i].astype(np.float64) for i in range(4)]
+	with np.errstate(divide='ignore', invalid='ignore'):
+		accuracy  = (tp + tn)/(tp + tn + fp + fn)
+		precision = np.where(tp + fp > 0, tp/(tp + fp), -1)
+		recall    = np.where(tp + fn > 0, tp/(tp + fn), -1)
+		fscore    = np.where(precision + recall > 0,
+						2*precision*recall/(precision + recall), -1)
+	return np.stack([tp, tn, fp, fn, tp + fn, accuracy, precision, recall,
+					 fscore], 1)
+
+#-----------------------------------------------------------------------
+def write_metrics_table(path, diseases, scores):
+
+	# same layout as the former DataFrame.to_csv(sep='\t', float_format='%.3f')
+	with open(path, 'w') as f:
+		f.write('\t'.join([''] + ['{:^12}'.format(n) for n in METRIC_NAMES]) + '\n')
+		for disease, row in zip(diseases, scores):
+			f.write('\t'.join([str(disease)] + ['%.3f' % v for v in row]) + '\n')
+
+#-----------------------------------------------------------------------
+def read_metrics_table(path):
+
+	# scores of a table written by write_metrics_table, n_labels x 10
+	with open(path) as f:
+		rows = [line.rstrip('\n').split('\t')[1:] for line in f][1:]
+	return np.array(rows, np.float64)
+
+#-----------------------------------------------------------------------
+def save_log(path, file_name, diseases, lbs, pred, cost, threshold,
+	summary=None):
 
 	"""Given labels and prediction, evaluates metrics and saves results to the csv file
 
@@ -348,22 +635,19 @@ def save_log(path, file_name, diseases, lbs, pred, cost, threshold):
 		pred: predicted labels.
 		cost: cost function. Must have the same len as diseases.
 		threshold: threshold for sigmoidal prediction.
+		summary: MetricsSummary adding the counts of this file to its
+			running totals, so no table has to be read back.
 
 	Saves metrics to /path/file_name/
 	""" 
-
 	cost = np.reshape(cost, [len(diseases), 1])
-	pred = (pred > threshold)
-	scores = np.array([metrics(confusion_matrix(l, p, labels=[0, 1])) for l, p in zip(lbs.T, pred.T)])
-	scores = np.hstack([scores, cost])
-	
-	names = ['{:^12}'.format(n) for n in ['tp', 'tn', 'fp', 'fn', 'num_events',
-                                                'accuracy', 'precision', 'recall', 'fscore', 'cost']]
+	counts = confusion_counts(lbs, pred, threshold)
+	if summary is not None:
+		summary.add_counts(counts, cost)
+	scores = np.hstack([metrics_from_counts(counts), cost])
 	
-	df = pd.DataFrame(scores, diseases, names)
-	p = os.path.join(path, file_name)
 	os.makedirs(path, exist_ok=True)
-	df.to_csv(p, sep='\t', float_format='%.3f')
+	write_metrics_table(os.path.join(path, file_name), diseases, scores)
 
 #-----------------------------------------------------------------------
 def save_summary(path, diseases):
@@ -378,78 +662,56 @@ def save_summary(path, diseases):
 
 	Saves summarized csv to the parent directory of path.
 	"""
-	
 	files = find_files(path, '*.csv')
 	
-	dframes         = [pd.read_csv(f, index_col=0, sep='\t') for f in files]
-	summary_frame   = functools.reduce(lambda x, y: y + x, dframes)
-	names           = list(summary_frame.keys())
-
-	cost    = np.reshape(summary_frame[names[-1]].as_matrix()/len(files), (len(diseases), 1))
-	scores  = np.array([metrics([[tn, fp], [fn, tp]]) for (tp, tn, fp, fn) in 
-										summary_frame[names[:4]].as_matrix()])   
-	scores  = np.hstack([scores, cost])                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                                     
-	
-	#head, tail = os.path.split(path)
-	averaged_frame  = pd.DataFrame(scores, diseases, names)
-
-	#maybe_create_dirs(os.path.join(head, 'summary_' + tail))
-
-	averaged_frame.to_csv(path+'summary.csv', sep='\t', float_format='%.3f')
-	
-	print('\nLogs saved.\n')
-
-def chunking_data(data, n_chunks=128, overlap = 700):
-    # |--------------len_of_chunk--------------|
-    # |****************************|***********|
-    # |                            |--overlap--|
-    channels = ecg.utils.get_channels(data)
-    len_of_chunk = (len(channels[0])-overlap)//n_chunks + 1 + overlap
-    padding_size = (len_of_chunk - overlap)*n_chunks + overlap - len(channels[0])
-    channels = [np.concatenate((channel, np.linspace(channel[-1], 0, padding_size)), axis = 0) for channel in channels]
-
-    list_of_cunks = []
-    for c in range(n_chunks):
-        chunked_data = data.copy()
-        chunk_begin = c*(len_of_chunk - overlap)
-        chunk_end = chunk_begin + len_of_chunk
-        
-        chanked_channels = [channel[chunk_begin:chunk_end] for channel in channels]
-        chunked_data = ecg.utils.write_channels(chunked_data, chanked_channels)
-
-        inds = (data['beats']>=chunk_begin) & (data['beats']<chunk_end)
-        chunked_data['beats'] = data['beats'][inds]
-        chunked_data['beats'] = chunked_data['beats'] - chunk_begin
+	summary = MetricsSummary(diseases)
+	for f in files:
+		table = read_metrics_table(f)
+		summary.add_counts(table[:, :4], table[:, -1])
+	summary.write(path+'summary.csv')
 
-        chunked_data['events'] = data['events'][inds,:]
-        list_of_cunks.append(chunked_data)
+#-----------------------------------------------------------------------
+class MetricsSummary:
 
-    return list_of_cunks
+	"""Running totals of confusion counts and cost across files.
 
-def gathering_data_from_chunks(data, list_of_res, overlap=700, n_chunks=32):
-    predicted_events = list_of_res[0]
-    channels = ecg.utils.get_channels(data)
-    len_of_chunk = (len(channels[0])-overlap)//n_chunks + 1 + overlap
+	Pass it to save_log for every file, write() then saves one summary with
+	the columns of metrics() and the cost averaged over files, as
+	save_summary does from the per-file logs on disk.
+	"""
 
-    for c in range(1, n_chunks):
-        chunk_begin = c*(len_of_chunk - overlap)
+	def __init__(self, diseases):
+		self.diseases = diseases
+		self.counts = np.zeros([len(diseases), 4], np.int64)
+		self.cost = np.zeros(len(diseases))
+		self.n_files = 0
 
-        start_ind = np.sum((data['beats']>=chunk_begin) & (data['beats']<chunk_begin + overlap))
-        predicted_events = np.concatenate((predicted_events, list_of_res[c][start_ind:,:]), 0)
+	def add_counts(self, counts, cost):
+		self.counts += np.asarray(counts, np.int64)
+		self.cost += np.reshape(cost, [len(self.diseases)])
+		self.n_files += 1
 
-    assert data['events'].shape[0] == predicted_events.shape[0], 'Original shape not equal reconstarct shape {0} != {1}'.format(data['events'].shape[0], predicted_events.shape[0])
-    return predicted_events
+	def scores(self):
+		cost = self.cost/max(self.n_files, 1)
+		return np.hstack([metrics_from_counts(self.counts), cost[:, None]])
 
+	def write(self, path):
+		write_metrics_table(path, self.diseases, self.scores())
+		print('\nLogs saved.\n')
 
 def plot_confusion_matrix(true_labels, pred_labels, classes,
                           normalize=False,
                           title='Confusion matrix',
-                          cmap=plt.cm.Blues,
+                          cmap=None,
                           save_path = None):
     """
     This function prints and plots the confusion matrix.
     Normalization can be applied by setting `normalize=True`.
+    cmap defaults to plt.cm.Blues.
     """
+    import matplotlib.pyplot as plt
+    from sklearn.metrics import confusion_matrix
+    cmap = plt.cm.Blues if cmap is None else cmap
 
     cm = np.around(confusion_matrix(true_labels, pred_labels), 3)
     plt.figure(figsize=(17, 17))
@@ -483,6 +745,7 @@ def plot_confusion_matrix(true_labels, pred_labels, classes,
 
 #-------------------------------------------------------------------------------
 def test(pred_path, path_save):
+    import matplotlib.pyplot as plt
     list_of_res = np.load(pred_path)
     for i, res in enumerate(list_of_res):
         plt.figure(figsize=(25,10))
@@ -660,3 +923,30 @@ if __name__ == '__main__':
 
     save_log(path='test_metrics', epoch = 1, fl = 'fl', diseases = REQUIRED_DISEASES, lbs = events, pred = events, cost = [1,2], threshold = 0.5)
     """
+
+
+    # every beat is read about as often, whatever the length of its record
+    import tempfile
+    from ecg_encoder_manifest import build_manifest
+    path_to_data = tempfile.mkdtemp()
+    n_beats = [200, 4000]
+    for i, n in enumerate(n_beats):
+        beats = np.arange(n + 1)*100
+        np.save(os.path.join(path_to_data, 'record_{}.npy'.format(i)),
+                {'samples': np.full([beats[-1] + 100, 3], i + 1, np.float16),
+                 'beats': beats})
+    build_manifest(path_to_data, 1)
+    data_loader = LoadDataFileShuffling(batch_size=4,
+        path_to_data=path_to_data, gen=step_generator,
+        gen_params=dict(n_frames=10, overlap=0, get_data=True,
+                        get_delta_coded_data=False, get_events=False, rr=1),
+        file_max_len=None, file_min_len=None)
+    n_windows = np.zeros(len(n_beats))
+    for i in range(5000):
+        b = data_loader.get_batch()
+        # samples of a window are its record number + 1
+        n_windows += np.bincount(b['normal_data'][::10, 0, 0].astype(int) - 1,
+                                 minlength=len(n_beats))
+    beat_freq = n_windows/np.array(n_beats)
+    print('windows per beat', beat_freq)
+    assert beat_freq.max()/beat_freq.min() < 1.2
@@ -0,0 +1,147 @@
+import os
+import time
+import queue
+import multiprocessing
+
+import numpy as np
+
+
+def load_validation_batches(path_to_data, gen_params, batch_size, max_batches):
+    # fixed held-out batches, built once per validation process
+    import ecg_encoder_tools as utils
+
+    windows = []
+    for path in utils.find_files(path_to_data, '*.npy'):
+        data = np.load(path).item()
+        windows += list(utils.step_generator(data, **gen_params))
+        if len(windows) >= batch_size*max_batches:
+            break
+    windows = windows[:batch_size*max_batches]
+    return [utils.merge_batches(windows[s:s+batch_size])
+            for s in range(0, len(windows), batch_size)]
+
+
+def validation_worker(encoder_params, path_to_data, path_to_model, summary_dir,
+    gen_params, batch_size, max_batches, poll_interval, results, stop_event):
+    # runs in a separate process with its own graph and session
+    import tensorflow as tf
+    from ecg_encoder import ECGEncoder
+
+    key = 'delta_coded_data' if gen_params['get_delta_coded_data'] \
+        else 'normal_data'
+    batches = load_validation_batches(path_to_data, gen_params, batch_size,
+                                      max_batches)
+    print('Validation on {} batches from {}'.format(len(batches), path_to_data))
+
+    model_dir = os.path.dirname(path_to_model)
+    validated = set()
+    # own FileWriter, next to the trainer's event files
+    with ECGEncoder(do_train=False,
+                    summary_dir=os.path.join(summary_dir, 'validation'),
+                    **encoder_params) as ecg_encoder:
+        while True:
+            stopping = stop_event.is_set()
+            state = tf.train.get_checkpoint_state(model_dir)
+            paths = state.all_model_checkpoint_paths if state else []
+            for p in paths:
+                if p in validated:
+                    continue
+                validated.add(p)
+                try:
+                    ecg_encoder.saver.restore(ecg_encoder.sess, p)
+                except (tf.errors.NotFoundError, ValueError):
+                    continue # removed by the retention policy meanwhile
+                step = int(p.rsplit('-', 1)[1])
+
+                # frame-weighted MSE, weighted by the number of beats per batch
+                mse, n_beats = 0., 0
+                for batch in batches:
+                    n = len(batch['sequence_length'])
+                    mse += n*ecg_encoder.sess.run(ecg_encoder.mse, feed_dict={
+                        ecg_encoder.inputs : batch[key],
+                        ecg_encoder.sequence_length : batch['sequence_length'],
+                        ecg_encoder.keep_prob : 1})
+                    n_beats += n
+                mse = mse/n_beats
+
+                summary = tf.Summary(value=[tf.Summary.Value(
+                    tag='validation/MSE', simple_value=mse)])
+                ecg_encoder.train_writer.add_summary(summary, step)
+                ecg_encoder.train_writer.flush()
+                results.put((step, mse))
+            if stopping:
+                break
+            time.sleep(poll_interval)
+
+
+class ConcurrentValidator(object):
+    """ Validates fresh checkpoints on held-out records in a separate process.
+
+    The worker watches the checkpoint state of path_to_model, computes the
+    frame-weighted MSE of every new checkpoint and writes it as
+    validation/MSE to summary_dir/validation. poll() collects the results
+    without blocking, reports them to the checkpoint writer for
+    best-checkpoint retention and tracks early stopping.
+
+    Args:
+        encoder_params: ECGEncoder arguments except do_train (n_frames,
+            n_channel, n_hidden_RNN, reduction_ratio, frame_weights).
+        gen_params: step_generator arguments, as for training.
+        patience: stop after this many validations without improvement,
+            None to never stop early.
+    """
+
+    def __init__(self, encoder_params, path_to_data, path_to_model, summary_dir,
+        gen_params, batch_size=64, max_batches=50, patience=None,
+        poll_interval=10):
+
+        self.patience = patience
+        self.best_loss = np.inf
+        self.best_step = None
+        self.n_bad = 0
+        self.history = []
+
+        # spawn: the training process already owns a TF session
+        ctx = multiprocessing.get_context('spawn')
+        self.results = ctx.Queue()
+        self.stop_event = ctx.Event()
+        self.process = ctx.Process(target=validation_worker,
+            args=(encoder_params, path_to_data, path_to_model, summary_dir,
+                  gen_params, batch_size, max_batches, poll_interval,
+                  self.results, self.stop_event),
+            daemon=True)
+        self.process.start()
+
+    # --------------------------------------------------------------------------
+    def poll(self, checkpoint_writer=None):
+        new_results = []
+        while True:
+            try:
+                new_results.append(self.results.get_nowait())
+            except queue.Empty:
+                break
+        for step, loss in sorted(new_results):
+            print('\tValidation MSE at step {}: {:.6f}'.format(step, loss))
+            self.history.append((step, loss))
+            if checkpoint_writer is not None:
+                checkpoint_writer.report_loss(step, loss)
+            if loss < self.best_loss:
+                self.best_loss, self.best_step, self.n_bad = loss, step, 0
+            else:
+                self.n_bad += 1
+        return new_results
+
+    # --------------------------------------------------------------------------
+    def should_stop(self):
+        return self.patience is not None and self.n_bad >= self.patience
+
+    # --------------------------------------------------------------------------
+    def close(self, checkpoint_writer=None):
+        """ Validate the remaining checkpoints and stop the worker. """
+        self.stop_event.set()
+        while self.process.is_alive():
+            self.poll(checkpoint_writer)
+            self.process.join(timeout=1)
+        self.poll(checkpoint_writer)
+        print('Best validation MSE {} at step {}'.format(self.best_loss,
+                                                         self.best_step))
@@ -0,0 +1,123 @@
+import os
+import json
+import time
+import argparse
+import itertools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from ecg_encoder_parameters import parameters as PARAM
+import ecg_encoder_cache as cache
+
+
+def make_trials(grid):
+    # grid: dict parameter -> list of values, returns list of parameter dicts
+    keys = sorted(grid)
+    trials = []
+    for values in itertools.product(*[grid[k] for k in keys]):
+        param = dict(PARAM)
+        param.update(zip(keys, values))
+        assert param['n_frames'] == len(param['frame_weights']), \
+            'Number of frames must match with number of frame weights'
+        trials.append(param)
+    return trials
+
+
+def run_trial(args):
+    # one training in its own process, reading batches from the shared cache
+    trial_id, param, cache_dir, save_dir, n_iter, n_threads = args
+    from ecg_encoder import ECGEncoder
+
+    trial_dir = os.path.join(save_dir, 'trial_{}'.format(trial_id))
+    data_loader = cache.WindowCacheLoader(cache_dir,
+        batch_size=param['batch_size'],
+        n_frames=param['n_frames'],
+        rr=param['rr'],
+        use_delta_coding=param['use_delta_coding'],
+        seed=trial_id)
+
+    start_time = time.time()
+    with ECGEncoder(
+        n_frames=param['n_frames'],
+        n_channel=param['n_channels'],
+        n_hidden_RNN=param['n_hidden_RNN'],
+        reduction_ratio=param['rr'],
+        frame_weights=param['frame_weights'],
+        architecture=param['architecture'],
+        summary_dir=os.path.join(trial_dir, 'summary'),
+        n_threads=n_threads,
+        inter_op_threads=1, # n_threads cores per trial
+        do_train=True) as ecg_encoder:
+
+        history = ecg_encoder.train_(
+            data_loader=data_loader,
+            keep_prob=param['keep_prob'],
+            weight_decay=param['weight_decay'],
+            learn_rate_start=param['learn_rate_start'],
+            learn_rate_end=param['learn_rate_end'],
+            n_iter=n_iter,
+            save_model_every_n_iter=n_iter,
+            path_to_model=os.path.join(trial_dir, 'models', 'ecg_encoder'),
+            summary_every_n_iter=param['summary_every_n_iter'])
+    return trial_id, time.time() - start_time, history
+
+
+def write_results(save_dir, grid, trials, results):
+    keys = sorted(grid)
+    with open(os.path.join(save_dir, 'sweep_results.tsv'), 'w') as f:
+        f.write('\t'.join(['trial'] + keys + ['wall_time', 'final_mse',
+                                              'min_mse']) + '\n')
+        for trial_id, wall_time, history in sorted(results):
+            mse = np.array([h[2] for h in history])
+            final_mse = mse[-max(1, len(mse)//10):].mean()
+            f.write('\t'.join([str(trial_id)]
+                + [json.dumps(trials[trial_id][k]) for k in keys]
+                + ['{:.1f}'.format(wall_time), '{:.6f}'.format(final_mse),
+                   '{:.6f}'.format(mse.min())]) + '\n')
+
+    # loss against wall time for every trial
+    with open(os.path.join(save_dir, 'sweep_curves.tsv'), 'w') as f:
+        f.write('trial\titeration\twall_time\tmse\n')
+        for trial_id, _, history in sorted(results):
+            for it, t, mse in history:
+                f.write('{}\t{}\t{:.2f}\t{:.6f}\n'.format(trial_id, it, t, mse))
+
+    print(open(os.path.join(save_dir, 'sweep_results.tsv')).read())
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+                    formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--grid', type=str, required=True,
+        help='JSON dict of parameter lists, e.g. '
+             '\'{"n_hidden_RNN": [128, 256], "weight_decay": [1e-5, 1e-4]}\'')
+    parser.add_argument('--path_to_data', type=str, default=None,
+        help='records to decode when cache_dir has no index yet')
+    parser.add_argument('--cache_dir', type=str, default='window_cache')
+    parser.add_argument('--save_dir', type=str, default='sweep')
+    parser.add_argument('--n_iter', type=int, default=2000)
+    parser.add_argument('--cpu_budget', type=int, default=os.cpu_count())
+    parser.add_argument('--threads_per_trial', type=int, default=4)
+    args = parser.parse_args()
+
+    if not os.path.isfile(os.path.join(args.cache_dir, cache.INDEX_FILE)):
+        cache.build_window_cache(args.path_to_data, args.cache_dir,
+                                 n_workers=args.cpu_budget)
+
+    grid = json.loads(args.grid)
+    trials = make_trials(grid)
+    n_concurrent = max(1, args.cpu_budget//args.threads_per_trial)
+    print('{} trials, {} at once with {} threads each'.format(len(trials),
+        n_concurrent, args.threads_per_trial))
+
+    os.makedirs(args.save_dir, exist_ok=True)
+    jobs = [(i, t, args.cache_dir, args.save_dir, args.n_iter,
+             args.threads_per_trial) for i, t in enumerate(trials)]
+    # spawn: every trial builds its own TensorFlow graph and session
+    with ProcessPoolExecutor(max_workers=n_concurrent,
+            mp_context=multiprocessing.get_context('spawn')) as executor:
+        results = list(executor.map(run_trial, jobs))
+
+    write_results(args.save_dir, grid, trials, results)
@@ -0,0 +1,106 @@
+import numpy as np
+
+
+class PackedLabels(object):
+    """ Bit-packed multi-label matrix for per-beat disease events.
+
+    Row i holds the events of beat i packed 8 labels per byte (np.packbits
+    order), so a corpus of beats with dozens of diseases costs a few bytes
+    per beat instead of a dense int row.
+
+    Args:
+        bits: uint8 array of shape [n_beats, ceil(n_labels/8)].
+        n_labels: number of label columns.
+    """
+
+    def __init__(self, bits, n_labels):
+        self.bits = np.asarray(bits, np.uint8)
+        self.n_labels = n_labels
+
+    # --------------------------------------------------------------------------
+    @classmethod
+    def from_dense(cls, events):
+        events = np.asarray(events)
+        return cls(np.packbits(events != 0, axis=1), events.shape[1])
+
+    # --------------------------------------------------------------------------
+    @classmethod
+    def concatenate(cls, list_of_labels):
+        list_of_labels = [l if isinstance(l, cls) else cls.from_dense(l)
+                          for l in list_of_labels]
+        n_labels = list_of_labels[0].n_labels
+        assert all(l.n_labels == n_labels for l in list_of_labels), \
+            'All labels must have the same number of columns'
+        return cls(np.concatenate([l.bits for l in list_of_labels], 0), n_labels)
+
+    # --------------------------------------------------------------------------
+    @property
+    def shape(self):
+        return (self.bits.shape[0], self.n_labels)
+
+    def __len__(self):
+        return self.bits.shape[0]
+
+    def __getitem__(self, rows):
+        # supports events[rows] and events[rows, :] like the dense matrix
+        if isinstance(rows, tuple):
+            rows, cols = rows
+            assert cols == slice(None), 'Use select_labels to take columns'
+        if isinstance(rows, (int, np.integer)):
+            rows = slice(rows, rows + 1)
+        return PackedLabels(self.bits[rows], self.n_labels)
+
+    # --------------------------------------------------------------------------
+    def to_dense(self, dtype=np.int8):
+        return np.unpackbits(self.bits, axis=1)[:, :self.n_labels].astype(dtype)
+
+    # --------------------------------------------------------------------------
+    def mask(self, label):
+        """ Boolean mask of beats that have the label. """
+        return ((self.bits[:, label >> 3] >> (7 - (label & 7))) & 1) == 1
+
+    # --------------------------------------------------------------------------
+    def bit_planes(self):
+        # yields (label indexes, 0/1 uint8 array [n_beats, n_bytes]) per bit
+        # position, so counting never unpacks the whole matrix
+        labels = np.arange(self.bits.shape[1])*8
+        for b in range(8):
+            yield labels + b, (self.bits >> (7 - b)) & 1
+
+    # --------------------------------------------------------------------------
+    def counts(self):
+        """ Number of beats per label, shape [n_labels]. """
+        counts = np.zeros([self.bits.shape[1]*8], np.int64)
+        for labels, plane in self.bit_planes():
+            counts[labels] = plane.sum(0, dtype=np.int64)
+        return counts[:self.n_labels]
+
+    # --------------------------------------------------------------------------
+    def counts_by(self, groups, n_groups=None):
+        """ Number of beats per (group, label), shape [n_groups, n_labels].
+
+        Args:
+            groups: int array of shape [n_beats], e.g. cluster labels.
+        """
+        groups = np.asarray(groups)
+        n_groups = groups.max() + 1 if n_groups is None else n_groups
+        counts = np.zeros([n_groups, self.bits.shape[1]*8], np.int64)
+        for labels, plane in self.bit_planes():
+            for j, label in enumerate(labels):
+                counts[:, label] = np.bincount(groups, weights=plane[:, j],
+                                               minlength=n_groups)
+        return counts[:, :self.n_labels]
+
+    # --------------------------------------------------------------------------
+    def first_label(self):
+        """ Index of the first label of every beat, -1 if the beat has none. """
+        dense = np.unpackbits(self.bits, axis=1)[:, :self.n_labels]
+        first = np.argmax(dense, 1)
+        first[~dense.any(1)] = -1
+        return first
+
+    # --------------------------------------------------------------------------
+    def select_labels(self, columns):
+        """ Keep only the given label columns (bool mask or indexes). """
+        dense = np.unpackbits(self.bits, axis=1)[:, :self.n_labels][:, columns]
+        return PackedLabels(np.packbits(dense, axis=1), dense.shape[1])
@@ -8,118 +8,162 @@ import matplotlib.pyplot as plt
 from ecg_encoder_parameters import parameters as PARAM
 import ecg_encoder_tools as utils
 from ecg_encoder import ECGEncoder
+from ecg_encoder_validation import ConcurrentValidator
+from ecg_encoder_pipeline import run_pipeline
+from ecg_encoder_profiling import load_execution_profile, memory_profiler
 import ecg
 
-parser = argparse.ArgumentParser()
-for k,v in PARAM.items():
-    parser.add_argument('--'+k, default=v)
-
-args = parser.parse_args()
-
-print('\n\n\n\t----==== Import parameters ====----')
-for arg in vars(args):
-    PARAM[arg] = getattr(args, arg)
-    print(arg, getattr(args, arg))
-
-os.makedirs('summary/', exist_ok = True)
-
-
-
-# path_to_train_data = '../data/little/'
-# path_to_train_data = '../data/interesting_chunk_files/'
-path_to_train_data = '/data/Work/processed_ecg/chunked_data/'
-# path_to_train_data = '../data/small_set/'
-# path_to_train_data     = '../../ECG_DATA/ECG_DATA_1000samples_2/'
-# path_to_predict_data    = path_to_train_data
-path_to_predictions     = 'predictions/'
-os.makedirs(path_to_predictions, exist_ok = True)
-n_iter_train            = 100000
-save_model_every_n_iter = 10000
-path_to_model = 'models/ecg_encoder'
-
-
-gen_params = dict(n_frames = PARAM['n_frames'],
-                overlap = 0,
-                get_data = not(PARAM['use_delta_coding']),
-                get_delta_coded_data = PARAM['use_delta_coding'],
-                get_events = False,
-                rr = PARAM['rr'])
-"""
-# Initialize data loader for training
-data_loader = utils.LoadDataFileShuffling(batch_size=PARAM['batch_size'],
-                                    path_to_data=path_to_train_data,
-                                    gen=utils.step_generator,
-                                    gen_params=gen_params,
-                                    file_max_len=PARAM['file_max_len'],
-                                    file_min_len=PARAM['file_min_len'],
-                                    verbose=PARAM['verbose'])
-
-
-
-with ECGEncoder(
-    n_frames=PARAM['n_frames'],
-    n_channel=PARAM['n_channels'],
-    n_hidden_RNN=PARAM['n_hidden_RNN'],
-    reduction_ratio=PARAM['rr'],
-    frame_weights=PARAM['frame_weights'],
-    do_train=True) as ecg_encoder:
-    
-    
-    ecg_encoder.train_(
-        data_loader = data_loader,
-        keep_prob=PARAM['keep_prob'],
-        weight_decay=PARAM['weight_decay'],
-        learn_rate_start=PARAM['learn_rate_start'],
-        learn_rate_end=PARAM['learn_rate_end'],
-        n_iter=n_iter_train,
-        save_model_every_n_iter=save_model_every_n_iter,
-        path_to_model=path_to_model)
-
-
-
-
-# Predictions
-path='../data/little/AAO1CMED2K865.npy'
-f_name = ecg.utils.get_file_name(path)
-dir_name = path_to_predictions+f_name+'/'
-os.makedirs(dir_name, exist_ok=True)
-with ECGEncoder(
-    n_frames=PARAM['n_frames'],
-    n_channel=PARAM['n_channels'],
-    n_hidden_RNN=PARAM['n_hidden_RNN'],
-    reduction_ratio=PARAM['rr'],
-    frame_weights=PARAM['frame_weights'],
-    do_train=False) as ecg_encoder:
-
-    ecg_encoder.predict(
-        path_to_file=path,
-        path_to_save=path_to_predictions+f_name+'_pred.npy',
-        path_to_model=os.path.dirname(path_to_model),
-        use_delta_coding=False)
-
-utils.test(pred_path=path_to_predictions+f_name+'_pred.npy',
-    path_save=dir_name)
-"""
-
-# Get Z-code
-paths = ecg.utils.find_files('/data/Work/processed_ecg/valid_files/', '*.npy')
-paths = paths[1:21]
-with ECGEncoder(
-    n_frames=PARAM['n_frames'],
-    n_channel=PARAM['n_channels'],
-    n_hidden_RNN=PARAM['n_hidden_RNN'],
-    reduction_ratio=PARAM['rr'],
-    frame_weights=PARAM['frame_weights'],
-    n_parts=10,
-    do_train=False) as ecg_encoder:
-    
-    for path in paths:
-        f_name = ecg.utils.get_file_name(path)
-        ecg_encoder.get_Z(
-            data=path,
-            path_to_save=path_to_predictions+f_name+'_Z.npy',
+
+def int_or_none(v):
+    # parameters overridden from the command line arrive as strings
+    return None if v is None or v == 'None' else int(v)
+
+
+# spawned processes (validation) import this module, the run is guarded
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    for k,v in PARAM.items():
+        parser.add_argument('--'+k, default=v)
+    parser.add_argument('--train', default=False, action='store_true',
+        help='train with concurrent validation before encoding')
+
+    args = parser.parse_args()
+
+    # batch size and towers tuned by autotune.py, unless given on the command line
+    profile = load_execution_profile()
+    if profile is not None:
+        for k in ['batch_size', 'n_towers']:
+            if getattr(args, k) == PARAM[k]:
+                setattr(args, k, profile[k])
+
+    print('\n\n\n\t----==== Import parameters ====----')
+    for arg in vars(args):
+        if arg in PARAM:
+            PARAM[arg] = getattr(args, arg)
+        print(arg, getattr(args, arg))
+
+    os.makedirs('summary/', exist_ok = True)
+    if PARAM['memory_profile'] is not None:
+        memory_profiler.start()
+
+
+
+    # path_to_train_data = '../data/little/'
+    # path_to_train_data = '../data/interesting_chunk_files/'
+    # beat-aligned shards written by ecg_encoder_shards.py --save_dir
+    path_to_train_data = '/data/Work/processed_ecg/shards/'
+    # path_to_train_data = '../data/small_set/'
+    # path_to_train_data     = '../../ECG_DATA/ECG_DATA_1000samples_2/'
+    # path_to_predict_data    = path_to_train_data
+    path_to_predictions     = 'predictions/'
+    os.makedirs(path_to_predictions, exist_ok = True)
+    n_iter_train            = 100000
+    save_model_every_n_iter = 10000
+    path_to_model = 'models/ecg_encoder'
+    path_to_valid_data = '/data/Work/processed_ecg/valid_files/'
+
+
+    gen_params = dict(n_frames = PARAM['n_frames'],
+                    overlap = 0,
+                    get_data = not(PARAM['use_delta_coding']),
+                    get_delta_coded_data = PARAM['use_delta_coding'],
+                    get_events = False,
+                    rr = PARAM['rr'])
+    if args.train:
+        # Initialize data loader for training
+        data_loader = utils.LoadDataFileShuffling(batch_size=int(PARAM['batch_size']),
+                                            path_to_data=path_to_train_data,
+                                            gen=utils.step_generator,
+                                            gen_params=gen_params,
+                                            file_max_len=PARAM['file_max_len'],
+                                            file_min_len=PARAM['file_min_len'],
+                                            verbose=PARAM['verbose'],
+                                            memory_budget=int_or_none(PARAM['loader_memory_budget']),
+                                            mmap_dir=PARAM['loader_mmap_dir'])
+
+
+
+        with ECGEncoder(
+            n_frames=PARAM['n_frames'],
+            n_channel=PARAM['n_channels'],
+            n_hidden_RNN=PARAM['n_hidden_RNN'],
+            reduction_ratio=PARAM['rr'],
+            frame_weights=PARAM['frame_weights'],
+            architecture=PARAM['architecture'],
+            n_towers=int(PARAM['n_towers']),
+            do_train=True) as ecg_encoder:
+
+            ecg_encoder.set_async_checkpointing(
+                keep_last=int(PARAM['keep_last_checkpoints']),
+                keep_every=int_or_none(PARAM['keep_every_n_checkpoint_steps']),
+                keep_best=int(PARAM['keep_best_checkpoints']))
+
+            validator = ConcurrentValidator(
+                encoder_params=dict(n_frames=PARAM['n_frames'],
+                                    n_channel=PARAM['n_channels'],
+                                    n_hidden_RNN=PARAM['n_hidden_RNN'],
+                                    reduction_ratio=PARAM['rr'],
+                                    frame_weights=PARAM['frame_weights'],
+                                    architecture=PARAM['architecture']),
+                path_to_data=path_to_valid_data,
+                path_to_model=path_to_model,
+                summary_dir=ecg_encoder.train_writer.get_logdir(),
+                gen_params=gen_params,
+                patience=int_or_none(PARAM['early_stopping_patience']))
+
+            ecg_encoder.train_(
+                data_loader = data_loader,
+                keep_prob=PARAM['keep_prob'],
+                weight_decay=PARAM['weight_decay'],
+                learn_rate_start=PARAM['learn_rate_start'],
+                learn_rate_end=PARAM['learn_rate_end'],
+                n_iter=n_iter_train,
+                save_model_every_n_iter=save_model_every_n_iter,
+                path_to_model=path_to_model,
+                summary_every_n_iter=int(PARAM['summary_every_n_iter']),
+                validator=validator)
+
+
+
+
+    """
+    # Predictions
+    path='../data/little/AAO1CMED2K865.npy'
+    f_name = ecg.utils.get_file_name(path)
+    dir_name = path_to_predictions+f_name+'/'
+    os.makedirs(dir_name, exist_ok=True)
+    with ECGEncoder(
+        n_frames=PARAM['n_frames'],
+        n_channel=PARAM['n_channels'],
+        n_hidden_RNN=PARAM['n_hidden_RNN'],
+        reduction_ratio=PARAM['rr'],
+        frame_weights=PARAM['frame_weights'],
+        architecture=PARAM['architecture'],
+        do_train=False) as ecg_encoder:
+
+        ecg_encoder.predict(
+            path_to_file=path,
+            path_to_save=path_to_predictions+f_name+'_pred.npy',
             path_to_model=os.path.dirname(path_to_model),
             use_delta_coding=False)
 
-
-os.system("python3 clustering.py --save_dir \"clustering_plots_kmeans\" --n_clusters 50")
+    utils.test(pred_path=path_to_predictions+f_name+'_pred.npy',
+        path_save=dir_name)
+    """
+
+    if PARAM['memory_profile'] is not None:
+        memory_profiler.write_report(PARAM['memory_profile'])
+
+    # Z-codes, Z store, clustering, stats and plots; every stage runs in its
+    # own process and only when its inputs changed
+    run_pipeline({'path_to_data': path_to_valid_data,
+                  'path_to_model': os.path.dirname(path_to_model),
+                  'work_dir': 'pipeline',
+                  'n_parts': profile['n_parts'] if profile is not None else 10,
+                  'n_components': None,
+                  'n_clusters': 50,
+                  'use_snn': False,
+                  'n_workers': os.cpu_count(),
+                  'encode_workers': None, # from the execution profile
+                  'n_concurrent': 2,
+                  'memory_profile': PARAM['memory_profile']})